@@ -1,8 +1,9 @@
 from flask import Flask, request, jsonify
-import asyncio
 from semantic_kernel import Kernel
 from semantic_kernel.connectors.ai.open_ai import OpenAIChatCompletion
+from semantic_kernel.functions import KernelFunctionFromPrompt
 from semantic_kernel.prompt_template import PromptTemplateConfig
+from kernel_runtime import BackgroundLoop, FunctionRegistry
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -33,14 +34,20 @@ def setup_prompt_config(prompt):
         execution_settings=req_settings,
     )
 
-# Add function to kernel
-def add_function_to_kernel(prompt_template_config):
-    return kernel.add_function(
-        function_name="tldr_function",
+# Compile a function for a prompt template; it is invoked directly, so the kernel's plugins don't grow
+def compile_function(prompt, function_name):
+    return KernelFunctionFromPrompt(
+        function_name=function_name,
         plugin_name="tldr_plugin",
-        prompt_template_config=prompt_template_config,
+        prompt_template_config=setup_prompt_config(prompt),
     )
 
+# Each distinct template is compiled once; the least recently used are dropped past FUNCTION_CACHE_SIZE
+function_registry = FunctionRegistry(compile_function)
+
+# Kernel calls run on one long-lived event loop instead of a new loop per request
+kernel_loop = BackgroundLoop()
+
 # API endpoint
 @app.route('/generate-tldr', methods=['POST'])
 def generate_tldr():
@@ -52,20 +59,13 @@ def generate_tldr():
         if not prompt:
             return jsonify({"error": "Prompt is required"}), 400
 
-        # Setup the prompt template configuration
-        prompt_template_config = setup_prompt_config(prompt)
-
-        # Add function to kernel
-        function = add_function_to_kernel(prompt_template_config)
-
-        # Async execution of the function
-        async def invoke_kernel():
-            return await kernel.invoke(function)
+        # Reuse the compiled function for this template, compiling it on first use
+        function = function_registry.get(prompt)
 
-        # Run the async function
-        result = asyncio.run(invoke_kernel())
+        # Run the invocation on the shared event loop thread
+        result = kernel_loop.run(kernel.invoke(function))
 
-        return jsonify({"result": result}), 200
+        return jsonify({"result": str(result)}), 200
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
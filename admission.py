@@ -0,0 +1,221 @@
+import os
+import math
+import time
+import heapq
+import struct
+import itertools
+import threading
+from metrics import register_collector
+from context_builder import count_tokens, COMPLETION_MAX_TOKENS
+
+try:
+    import fcntl
+except ImportError:  # Windows: the budget is shared between threads only
+    fcntl = None
+
+# Azure OpenAI deployment quota; 0 disables admission control
+OPENAI_TPM_LIMIT = int(os.environ.get("OPENAI_TPM_LIMIT", "0"))
+OPENAI_RPM_LIMIT = int(os.environ.get("OPENAI_RPM_LIMIT", "0"))
+# Every process using the same file draws from the same budget
+ADMISSION_STATE_PATH = os.environ.get("ADMISSION_STATE_PATH", "output/openai_budget.bin")
+
+
+def _priority_setting(name, default):
+    raw = os.environ.get(name, default)
+    return {key.strip(): float(value) for key, value in (item.split(":") for item in raw.split(","))}
+
+
+# Longest a request of each class may queue before it is shed with a 429
+PRIORITY_MAX_WAIT = _priority_setting("ADMISSION_MAX_WAIT", "high:10,normal:3,low:0")
+# Share of each budget a class must leave untouched, keeping headroom for higher classes
+PRIORITY_RESERVE = _priority_setting("ADMISSION_RESERVE", "high:0,normal:0.05,low:0.25")
+PRIORITIES = ("high", "normal", "low")
+
+_STATE = struct.Struct("ddd")  # tokens available, requests available, last refill (epoch seconds)
+
+
+def estimate_tokens(messages, completion_tokens=COMPLETION_MAX_TOKENS):
+    """Prompt tokens of a chat conversation (with per-message framing) plus the completion's max_tokens."""
+    return sum(count_tokens(message["content"]) + 4 for message in messages) + 3 + completion_tokens
+
+
+class AdmissionRejected(Exception):
+    """The budget cannot cover the request within its priority's wait limit."""
+
+    def __init__(self, retry_after):
+        self.retry_after = max(1, math.ceil(retry_after))
+        super().__init__(f"OpenAI token budget exhausted, retry after {self.retry_after}s")
+
+
+class Ticket:
+    """Budget held by an admitted request; `settle(used)` refunds the unused completion reservation.
+
+    `settle(0)` means the call was never sent: its request slot is returned too.
+    """
+
+    def __init__(self, controller, reserved):
+        self.controller = controller
+        self.reserved = reserved
+        self._settled = False
+
+    def settle(self, used_tokens=None):
+        if self._settled or self.controller is None:
+            return
+        self._settled = True
+        if used_tokens == 0:
+            self.controller._refund(self.reserved, requests=1)
+        elif used_tokens is not None and used_tokens < self.reserved:
+            self.controller._refund(self.reserved - used_tokens)
+
+
+class TokenBucketController:
+    """Admission control for Azure OpenAI calls against tokens- and requests-per-minute budgets.
+
+    Both budgets are token buckets refilled continuously at limit/60 per
+    second, kept in a small file and updated under an fcntl lock so every
+    worker process on the host shares them. A request reserves its prompt
+    tokens plus max_tokens; `Ticket.settle` returns what the completion did
+    not use. Within a process, waiters are served by priority then arrival.
+    A request that cannot be admitted within its class's wait limit is
+    rejected at once with the estimated wait, for a 429 Retry-After.
+    """
+
+    def __init__(self, tpm=OPENAI_TPM_LIMIT, rpm=OPENAI_RPM_LIMIT, path=ADMISSION_STATE_PATH,
+                 max_wait=PRIORITY_MAX_WAIT, reserve=PRIORITY_RESERVE):
+        self.tpm = tpm
+        self.rpm = rpm
+        self.path = path
+        self.max_wait = max_wait
+        self.reserve = reserve
+        self.stats = {"admitted": 0, "shed": 0, "waited": 0}
+        self._lock = threading.Lock()
+        self._condition = threading.Condition()
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._fd = None
+
+    @property
+    def enabled(self):
+        return self.tpm > 0 or self.rpm > 0
+
+    def _open(self):
+        if self._fd is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        return self._fd
+
+    def _update(self, change):
+        """Apply `change(tokens, requests) -> (tokens, requests, result)` to the refilled shared state."""
+        with self._lock:
+            fd = self._open()
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                raw = os.pread(fd, _STATE.size, 0)
+                if len(raw) == _STATE.size:
+                    tokens, requests, last = _STATE.unpack(raw)
+                    elapsed = max(0.0, now - last)
+                    tokens = min(self.tpm, tokens + elapsed * self.tpm / 60)
+                    requests = min(self.rpm, requests + elapsed * self.rpm / 60)
+                else:
+                    tokens, requests = float(self.tpm), float(self.rpm)
+                tokens, requests, result = change(tokens, requests)
+                os.pwrite(fd, _STATE.pack(tokens, requests, now), 0)
+                return result
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def _try_take(self, tokens, priority):
+        """Take the budget if available; otherwise return the seconds until it would be."""
+        reserve = self.reserve.get(priority, 0)
+
+        def take(available_tokens, available_requests):
+            wait = 0.0
+            if self.tpm > 0:
+                floor = reserve * self.tpm
+                # A request larger than the whole budget is admitted once the bucket is full
+                needed = min(tokens, self.tpm - floor)
+                if available_tokens - floor < needed:
+                    wait = max(wait, (needed - (available_tokens - floor)) * 60 / self.tpm)
+            if self.rpm > 0:
+                floor = reserve * self.rpm
+                if available_requests - floor < 1:
+                    wait = max(wait, (1 - (available_requests - floor)) * 60 / self.rpm)
+            if wait > 0:
+                return available_tokens, available_requests, wait
+            return available_tokens - tokens, available_requests - 1, 0.0
+
+        return self._update(take)
+
+    def _refund(self, tokens, requests=0):
+        def refund(available_tokens, available_requests):
+            return min(self.tpm, available_tokens + tokens), min(self.rpm, available_requests + requests), None
+        if self.tpm > 0 or (requests and self.rpm > 0):
+            self._update(refund)
+        with self._condition:
+            self._condition.notify_all()
+
+    def acquire(self, tokens, priority="normal", max_wait=None):
+        """Admit a call estimated at `tokens` or raise AdmissionRejected; returns a Ticket.
+
+        `max_wait` (e.g. the seconds left of the request's deadline) shortens
+        the priority class's wait limit.
+        """
+        if not self.enabled:
+            return Ticket(None, tokens)
+        if priority not in PRIORITIES:
+            priority = "normal"
+        wait_limit = self.max_wait.get(priority, 0)
+        if max_wait is not None:
+            wait_limit = min(wait_limit, max(max_wait, 0))
+        deadline = time.monotonic() + wait_limit
+        entry = (PRIORITIES.index(priority), next(self._sequence))
+        with self._condition:
+            heapq.heappush(self._waiters, entry)
+            waited = False
+            try:
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if self._waiters[0] == entry:
+                        wait = self._try_take(tokens, priority)
+                        if not wait:
+                            self.stats["admitted"] += 1
+                            self.stats["waited"] += waited
+                            return Ticket(self, tokens)
+                    else:
+                        # Behind other waiters: woken when the head is admitted or gives up
+                        wait = max(remaining, 0) or 1
+                    if wait > remaining:
+                        self.stats["shed"] += 1
+                        raise AdmissionRejected(wait)
+                    waited = True
+                    self._condition.wait(min(wait, remaining, 0.25))
+            finally:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._condition.notify_all()
+
+    def snapshot(self):
+        with self._condition:
+            return {**self.stats, "queued": len(self._waiters)}
+
+    def collect(self):
+        """Exposition lines for /metrics."""
+        snapshot = self.snapshot()
+        return [
+            "# HELP openai_admission_total Azure OpenAI calls by admission outcome.",
+            "# TYPE openai_admission_total counter",
+            f'openai_admission_total{{outcome="admitted"}} {snapshot["admitted"]}',
+            f'openai_admission_total{{outcome="shed"}} {snapshot["shed"]}',
+            f'openai_admission_total{{outcome="waited"}} {snapshot["waited"]}',
+            "# HELP openai_admission_queued Calls waiting for budget in this process.",
+            "# TYPE openai_admission_queued gauge",
+            f"openai_admission_queued {snapshot['queued']}",
+        ]
+
+
+admission_controller = TokenBucketController()
+if admission_controller.enabled:
+    register_collector(admission_controller.collect)
@@ -0,0 +1,154 @@
+import os
+import re
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", "1024"))
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", "3600"))
+# Cosine similarity above which two questions are treated as the same question
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("ANSWER_CACHE_SIMILARITY", "0.95"))
+
+
+def normalize_question(question):
+    question = re.sub(r"\s+", " ", question.strip().lower())
+    return question.rstrip("?!. ")
+
+
+class AnswerCache:
+    """Two-tier cache of streamed completions for repeated questions.
+
+    The exact tier is keyed on the normalized question plus the IDs of the
+    retrieved documents. The semantic tier, enabled when `embed` is given,
+    matches on question-embedding cosine similarity above `threshold`.
+    Entries expire after `ttl` seconds and the least recently used entry is
+    evicted once `max_entries` is reached. Answers are stored as the list of
+    chunks that were streamed so a hit can be replayed chunk for chunk.
+    The latest answer to each normalized question is also kept past expiry
+    and eviction (up to `max_entries` questions) for `last_answer`, the
+    fallback served while an upstream's circuit breaker is open.
+    """
+
+    def __init__(self, max_entries=ANSWER_CACHE_MAX_ENTRIES, ttl=ANSWER_CACHE_TTL,
+                 threshold=ANSWER_CACHE_SIMILARITY, embed=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.embed = embed
+        self.stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0, "fallbacks": 0}
+        self._entries = OrderedDict()
+        self._last_answers = OrderedDict()
+        self._lock = threading.Lock()
+        # Semantic tier: one normalized embedding row per slot, reused after eviction
+        self._matrix = None
+        self._slot_keys = [None] * max_entries
+        self._free_slots = list(range(max_entries - 1, -1, -1))
+
+    def _key(self, question, doc_ids):
+        raw = normalize_question(question) + "\x1f" + "\x1f".join(doc_ids)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        slot = entry["slot"]
+        if slot is not None:
+            self._slot_keys[slot] = None
+            self._free_slots.append(slot)
+
+    def _live(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry["expires"] < now:
+            self._remove(key)
+            self.stats["expired"] += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def lookup(self, question, doc_ids, deadline=None):
+        """Return (chunks, embedding); chunks is None on a miss.
+
+        The question embedding is returned so the caller can pass it back to
+        `store` without embedding the question twice. Given a request
+        `deadline`, it is passed on as `embed(question, deadline)`; an embed
+        call that fails or runs out of time skips the semantic tier.
+        """
+        key = self._key(question, doc_ids)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._live(key, now)
+            if entry is not None:
+                self.stats["exact_hits"] += 1
+                return entry["chunks"], None
+
+        embedding = None
+        if self.embed is not None:
+            try:
+                vector = self.embed(question) if deadline is None else self.embed(question, deadline)
+                embedding = np.asarray(vector, dtype=np.float32)
+                embedding /= np.linalg.norm(embedding) or 1
+            except Exception as e:
+                logging.error(f"Question embedding failed, skipping semantic cache: {e}")
+                embedding = None
+
+        with self._lock:
+            if embedding is not None and self._matrix is not None:
+                scores = self._matrix @ embedding
+                for slot in np.argsort(-scores):
+                    if scores[slot] < self.threshold:
+                        break
+                    match = self._slot_keys[slot]
+                    entry = self._live(match, now) if match is not None else None
+                    if entry is not None:
+                        self.stats["semantic_hits"] += 1
+                        return entry["chunks"], embedding
+            self.stats["misses"] += 1
+        return None, embedding
+
+    def store(self, question, doc_ids, chunks, embedding=None):
+        key = self._key(question, doc_ids)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            while len(self._entries) >= self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.stats["evictions"] += 1
+
+            slot = None
+            if embedding is not None:
+                if self._matrix is None:
+                    self._matrix = np.zeros((self.max_entries, len(embedding)), dtype=np.float32)
+                slot = self._free_slots.pop()
+                self._matrix[slot] = embedding
+                self._slot_keys[slot] = key
+
+            self._entries[key] = {"chunks": list(chunks), "expires": time.monotonic() + self.ttl, "slot": slot}
+            self.stats["stores"] += 1
+
+            question = normalize_question(question)
+            self._last_answers[question] = self._entries[key]["chunks"]
+            self._last_answers.move_to_end(question)
+            while len(self._last_answers) > self.max_entries:
+                self._last_answers.popitem(last=False)
+
+    def last_answer(self, question):
+        """The most recent answer stored for the question, whatever documents it was built from, or None."""
+        with self._lock:
+            chunks = self._last_answers.get(normalize_question(question))
+            if chunks is not None:
+                self.stats["fallbacks"] += 1
+            return chunks
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+            self._last_answers.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.stats, "entries": len(self._entries)}
@@ -1,32 +1,152 @@
 import re
 import os
 import json
-import base64
+import time
 import logging
 import openai
-import http.client, urllib.parse
-from azure.search.documents import SearchClient
 from azure.search.documents.models import QueryType
-from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.models import VectorizedQuery
-from tenacity import retry, stop_after_attempt, wait_fixed
 from azure.core.exceptions import HttpResponseError, ServiceRequestError  
 from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS, cross_origin
+from werkzeug.exceptions import RequestEntityTooLarge
+from clients import get_search_client, get_openai_client, warm_up_in_background, search_options, is_transient_search_error
+from clients import is_search_outage, is_openai_outage
+from vision import get_vision_client, get_embedding_cache, MODEL_VERSION, MAX_IMAGE_BYTES
+from index_sync import sync_images, image_documents
+from batch_upload import upload_in_batches
+from answer_cache import AnswerCache
+from micro_batch import MicroBatcher
+from retrieval_cache import retrieval_cache
+from context_builder import build_context, count_tokens, COMPLETION_MAX_TOKENS
+from admission import admission_controller, estimate_tokens, AdmissionRejected
+from hybrid_search import hybrid_search, HYBRID_VECTOR_FIELD
+from profiler import register_profiler
+from deadline import register_deadline, current_deadline, call_upstream, DeadlineExceeded
+from circuit_breaker import get_breaker, CircuitOpen
+from metrics import register_metrics, stage_timer, observe_stage, timed
+from thumbnails import ThumbnailCache, build_thumbnails, image_result, register_image_routes
 from azure_openai import *  
 from config import *  
 
-credential = AzureKeyCredential(searchkey)
-text_search_client = SearchClient(endpoint=service_endpoint, index_name=index, credential=credential)
-image_search_client = SearchClient(endpoint=service_endpoint, index_name=index_image, credential=credential)
+# Long-lived, pooled clients shared by every request in this worker
+text_search_client = get_search_client(service_endpoint, index, searchkey)
+image_search_client = get_search_client(service_endpoint, index_image, searchkey)
+openai_client = get_openai_client()
+
+# One circuit breaker per upstream (Vision's lives in vision.py): while open, calls fail fast
+# instead of each request waiting out timeouts and retries against an outage
+text_index_breaker = get_breaker("text_index", is_failure=is_search_outage)
+image_index_breaker = get_breaker("image_index", is_failure=is_search_outage)
+openai_breaker = get_breaker("openai", is_failure=is_openai_outage)
+
+# Define field mappings for Azure Search
+KB_FIELDS_CONTENT = os.environ.get("KB_FIELDS_CONTENT", "content")
+KB_FIELDS_CATEGORY = os.environ.get("KB_FIELDS_CATEGORY", "category")
+KB_FIELDS_SOURCEPAGE = os.environ.get("KB_FIELDS_SOURCEPAGE", "sourcepage")
+KB_FIELDS_ID = os.environ.get("KB_FIELDS_ID", "id")
+
+# Optional in-process vector index answering /imagesearch without a round trip to Azure
+LOCAL_IMAGE_INDEX = os.environ.get("LOCAL_IMAGE_INDEX", "false").lower() == "true"
+local_image_index = None
+if LOCAL_IMAGE_INDEX:
+    from local_index import LocalIndexHolder, load_local_index
+    local_image_index = LocalIndexHolder(lambda: load_local_index(FILE_PATH_IMG, get_embedding_cache(), MODEL_VERSION))
 
 
 app = Flask(__name__)
 CORS(app, supports_credentials=True)
+app.config['MAX_CONTENT_LENGTH'] = MAX_IMAGE_BYTES
+
+# Search hits are served as precomputed thumbnails, inline from an LRU or via /images
+thumbnail_cache = ThumbnailCache(FILE_PATH_IMG)
+register_image_routes(app, FILE_PATH_IMG)
+
+# Per-stage latency histograms on /metrics; SERVER_TIMING=true also sets a Server-Timing header
+register_metrics(app)
+
+# Opt-in sampling profiler: PROFILE_REQUESTS=true honours X-Profile / ?profile=1, PROFILE_SAMPLE_RATE samples traffic
+# Hedged upstream calls and uploads run on pool threads, so sample every thread
+register_profiler(app, all_threads=True)
+
+# Every request gets a time budget (REQUEST_DEADLINE_SECONDS, or less via X-Request-Timeout) shared by its upstream calls
+register_deadline(app)
 
 
 logging.basicConfig(level=logging.INFO)
 
+# Deployment used to embed questions for the semantic answer-cache tier; unset disables that tier
+ANSWER_CACHE_EMBEDDING_DEPLOYMENT = os.environ.get("ANSWER_CACHE_EMBEDDING_DEPLOYMENT")
+
+def embed_questions(questions, deployment=ANSWER_CACHE_EMBEDDING_DEPLOYMENT, deadline=None):
+    # A batch is bounded by the latest deadline among the questions in it
+    timeout = {} if deadline is None else {"timeout": deadline.timeout()}
+    response = openai_breaker.call(openai_client.embeddings.create, model=deployment, input=questions, **timeout)
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+# Questions embedded within a few milliseconds of each other share one embeddings call
+embed_question = MicroBatcher(dispatch_batch=embed_questions, name="embed-question")
+
+answer_cache = AnswerCache(embed=embed_question if ANSWER_CACHE_EMBEDDING_DEPLOYMENT else None)
+
+# Hybrid retrieval (BM25 + vector, fused with RRF) is enabled by setting HYBRID_VECTOR_FIELD
+HYBRID_EMBEDDING_DEPLOYMENT = os.environ.get("HYBRID_EMBEDDING_DEPLOYMENT", ANSWER_CACHE_EMBEDDING_DEPLOYMENT)
+if HYBRID_EMBEDDING_DEPLOYMENT == ANSWER_CACHE_EMBEDDING_DEPLOYMENT:
+    embed_query = embed_question
+else:
+    embed_query = MicroBatcher(dispatch_batch=lambda questions, **kwargs: embed_questions(questions, HYBRID_EMBEDDING_DEPLOYMENT, **kwargs),
+                               name="embed-query")
+
+
+def search_documents(name, deadline, **kwargs):
+    """Run a text-index query within the deadline, hedged at `name`'s p95 and retried; returns the hits as dicts."""
+    return call_upstream(
+        name,
+        lambda timeout: [dict(doc) for doc in text_search_client.search(**kwargs, **search_options(timeout))],
+        deadline=deadline,
+        hedge=True,
+        retryable=is_transient_search_error,
+        breaker=text_index_breaker,
+    )
+
+
+def bm25_search(query, filter_condition, top, deadline=None):
+    return search_documents("bm25_search", deadline, search_text=query, filter=filter_condition, top=top)
+
+
+def vector_search(query, filter_condition, top, deadline=None):
+    vectorized_query = VectorizedQuery(vector=embed_query(query, deadline), k_nearest_neighbors=top, fields=HYBRID_VECTOR_FIELD)
+    return search_documents("vector_search", deadline, search_text=None, filter=filter_condition, vector_queries=[vectorized_query], top=top)
+
+
+def retrieve(query, filter_condition, top, timings, deadline=None):
+    """Top documents for the question: hybrid RRF when configured, semantic search otherwise."""
+    if not HYBRID_VECTOR_FIELD:
+        return search_documents(
+            "search",
+            deadline,
+            search_text=query,
+            filter=filter_condition,
+            query_type=QueryType.SEMANTIC,
+            #query_language="en-us",
+            #query_speller="lexicon",
+            semantic_configuration_name="default",
+            top=top
+        )
+    # The retrievers run on hybrid_search's threads, so the deadline is passed explicitly
+    return hybrid_search(
+        query,
+        lambda n: bm25_search(query, filter_condition, n, deadline),
+        lambda n: vector_search(query, filter_condition, n, deadline),
+        key=lambda doc: doc.get(KB_FIELDS_ID) or doc[KB_FIELDS_SOURCEPAGE],
+        content_field=KB_FIELDS_CONTENT,
+        top=top,
+        timings=timings,
+    )
+
+warm_up_in_background([text_search_client, image_search_client], openai_client)
+
+
 @app.route('/devedgesearch', methods=['POST'])
 @cross_origin(supports_credentials=True)
 def text_search():
@@ -35,24 +155,33 @@ def text_search():
         if not user_input:
             raise ValueError("Prompt is required")
 
-        # Define field mappings for Azure Search
-        KB_FIELDS_CONTENT = os.environ.get("KB_FIELDS_CONTENT", "content")
-        KB_FIELDS_CATEGORY = os.environ.get("KB_FIELDS_CATEGORY", "category")
-        KB_FIELDS_SOURCEPAGE = os.environ.get("KB_FIELDS_SOURCEPAGE", "sourcepage")
         exclude_category = None
         filter_condition = f"category ne '{exclude_category.replace("'", "''")}'" if exclude_category else None
+        deadline = current_deadline()
+        mode = "hybrid" if HYBRID_VECTOR_FIELD else "semantic"
 
-        # Search query to Azure Search with error handling
+        # Search query to Azure Search with error handling; identical queries share one cached search
         try:
-            results = text_search_client.search(
-                user_input,
-                filter=filter_condition,
-                query_type=QueryType.SEMANTIC,
-                #query_language="en-us",
-                #query_speller="lexicon",
-                semantic_configuration_name="default",
-                top=3
-            )
+            timings = {}
+            with stage_timer("text_search") as search_timer:
+                results = retrieval_cache.get_or_search(
+                    index, user_input, filter_condition, 3,
+                    lambda: retrieve(user_input, filter_condition, 3, timings, deadline),
+                    mode=mode,
+                )
+            timings["retrieval"] = round(search_timer.elapsed * 1000, 2)
+        except CircuitOpen as e:
+            # Search is down: answer from the last results for this query, else replay the last answer, else fail fast
+            logging.warning(f"Serving fallback: {e}")
+            results = retrieval_cache.last_results(index, user_input, filter_condition, 3, mode=mode)
+            if results is None:
+                fallback = answer_cache.last_answer(user_input)
+                if fallback is not None:
+                    return Response(stream_with_context(iter(fallback)), content_type="event-stream")
+                def error_stream():
+                    yield f"status: 503 \ncode: SERVICE_UNAVAILABLE \nerror: {str(e)}\n"
+                return Response(stream_with_context(error_stream()), status=503, content_type="event-stream",
+                                headers={"Retry-After": str(e.retry_after)})
         except HttpResponseError as e:
             logging.error(f"Azure Search API error: {e.message}")
             if e.status_code == 400:
@@ -106,110 +235,200 @@ def text_search():
                 yield f"status: 504 \ncode: SERVICE_REQUEST_ERROR \nerror: {str(e)}\n"
             return Response(stream_with_context(error_stream()), content_type="event-stream")
 
+        except DeadlineExceeded as e:
+            logging.error(f"Search deadline exceeded: {e}")
+            def error_stream():
+                yield f"status: 504 \ncode: DEADLINE_EXCEEDED \nerror: {str(e)}\n"
+            return Response(stream_with_context(error_stream()), content_type="event-stream")
+
         except Exception as e:
             logging.error(f"Unexpected error: {e}")
             def error_stream():
                 yield f"status: 500 \ncode: INTERNAL_ERROR \nerror: {str(e)}\n"
             return Response(stream_with_context(error_stream()), content_type="event-stream")
 
-        content = "\n".join([f"{doc[KB_FIELDS_SOURCEPAGE]}: {doc[KB_FIELDS_CONTENT].replace('\n', '').replace('\r', '')}" for doc in results])
-    
-
-        def generate_response():
+        # One pass over the top-k results builds the cache key and references together
+        doc_ids, references = [], []
+        for doc in results:
+            doc_ids.append(str(doc.get(KB_FIELDS_ID) or doc[KB_FIELDS_SOURCEPAGE]))
+            if doc[KB_FIELDS_SOURCEPAGE] not in references:
+                references.append(doc[KB_FIELDS_SOURCEPAGE])
+        # Chunk, rank, dedupe and pack the retrieved passages into the prompt's token budget
+        with stage_timer("build_context") as context_timer:
+            content = build_context(user_input, results, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT)
+        timings["context"] = round(context_timer.elapsed * 1000, 2)
+
+        # Opt-in: send the references before the answer so clients can render them at search latency
+        preamble = []
+        if request.json.get("include_references"):
+            preamble.append(f"event: references\ndata: {json.dumps(references)}\n\n")
+        # Opt-in: per-stage retrieval timings in milliseconds (text/vector/fusion/rerank when hybrid)
+        if request.json.get("include_timings"):
+            preamble.append(f"event: timings\ndata: {json.dumps(timings)}\n\n")
+
+        def start_answer():
+            """Everything between the references and the completion: returns (replay, error, admitted).
+
+            `replay` is a cached or fallback answer to send as-is, `error` a
+            (status, code, exception) to fail with, and `admitted` the
+            (conversation, reserved, ticket, question_embedding) of a completion
+            that passed admission.
+            """
+            # Replay a cached answer for the same (or a near-identical) question over the same documents
+            cached_chunks, question_embedding = answer_cache.lookup(user_input, doc_ids, deadline)
+            if cached_chunks is not None:
+                return cached_chunks, None, None
+
+            # OpenAI is down: replay the last answer to this question, else fail fast
             try:
-                conversation = [{"role": "system", "content": "Assistant is a great language model formed by OpenAI."}]
+                openai_breaker.allow()
+            except CircuitOpen as e:
+                logging.warning(f"Serving fallback: {e}")
+                fallback = answer_cache.last_answer(user_input)
+                if fallback is not None:
+                    return fallback, None, None
+                return None, (503, "SERVICE_UNAVAILABLE", e), None
+
+            conversation = [{"role": "system", "content": "Assistant is a great language model formed by OpenAI."}]
+            with stage_timer("create_prompt"):
                 prompt = create_prompt(content, user_input)
-                conversation.append({"role": "assistant", "content": prompt})
-                conversation.append({"role": "user", "content": user_input})
-                reply = client.chat.completions.create(
-                    model=deployment_id_gpt4,
-                    messages=conversation,
-                    temperature=0,
-                    max_tokens=1000,
-                    top_p=1,
-                    frequency_penalty=0,
-                    presence_penalty=0,
-                    stream=True,
-                    stop = [' END']
-                    )
+            conversation.append({"role": "assistant", "content": prompt})
+            conversation.append({"role": "user", "content": user_input})
+
+            # Reserve prompt + max_tokens against the shared TPM/RPM budget; shed with a 429 rather than queue unbounded
+            reserved = estimate_tokens(conversation)
+            try:
+                with stage_timer("admission"):
+                    ticket = admission_controller.acquire(reserved, request.headers.get("X-Priority", "normal"),
+                                                          max_wait=deadline.remaining())
+            except AdmissionRejected as e:
+                logging.warning(f"Shedding request: {e}")
+                openai_breaker.release()
+                return None, (429, "QUOTA_EXCEEDED", e), None
+            return None, None, (conversation, reserved, ticket, question_embedding)
+
+        def generate_response(started):
+            replay, error, admitted = started
+            if replay is not None:
+                yield from replay
+                return
+            if error is not None:
+                status, code, e = error
+                yield f"status: {status} \ncode: {code} \nerror: {str(e)}\n"
+                return
+            conversation, reserved, ticket, question_embedding = admitted
+            chunks = []
+            requested = False
+            try:
+                # The breaker hears how the call ended once the stream is done
+                with openai_breaker.track():
+                    completion_start = time.perf_counter()
+                    with stage_timer("completion_open"):
+                        timeout = deadline.timeout()
+                        requested = True
+                        reply = openai_client.chat.completions.create(
+                            model=deployment_id_gpt4,
+                            messages=conversation,
+                            temperature=0,
+                            max_tokens=COMPLETION_MAX_TOKENS,
+                            top_p=1,
+                            frequency_penalty=0,
+                            presence_penalty=0,
+                            stream=True,
+                            stop = [' END'],
+                            # Bounds connecting and each read of the stream, not the whole answer
+                            timeout=timeout,
+                            )
                 
-                for chunk in reply:
-                    if chunk.choices[0].delta.content is not None:
-                        yield chunk.choices[0].delta.content
+                    for chunk in reply:
+                        if chunk.choices[0].delta.content is not None:
+                            if not chunks:
+                                observe_stage("first_chunk", time.perf_counter() - completion_start)
+                            chunks.append(chunk.choices[0].delta.content)
+                            yield chunk.choices[0].delta.content
+                    observe_stage("stream_end", time.perf_counter() - completion_start)
+                answer_cache.store(user_input, doc_ids, chunks, question_embedding)
 
             except ValueError as e:
                 logging.error(f"Value error: {e}")
-                def error_stream():
-                    yield f"status: 400 \ncode: INVALID_ARGUMENT \nerror: {str(e)}\n"
-                return Response(stream_with_context(error_stream()), content_type="event-stream")
+                yield f"status: 400 \ncode: INVALID_ARGUMENT \nerror: {str(e)}\n"
 
             except openai.APIConnectionError as e:
                 logging.error(f"API connection error: {e}")
-                def error_stream():
-                    yield f"status: 503 \ncode: API_CONNECTION_ERROR \nerror: {str(e)}\n"
-                return Response(stream_with_context(error_stream()), content_type="event-stream")
+                yield f"status: 503 \ncode: API_CONNECTION_ERROR \nerror: {str(e)}\n"
 
-            except openai.APITimeoutError as e:
+            except (openai.APITimeoutError, DeadlineExceeded) as e:
                 logging.error(f"API timeout error: {e}")
-                def error_stream():
-                    yield f"status: 504 \ncode: TIMEOUT \nerror: {str(e)}\n"
-                return Response(stream_with_context(error_stream()), content_type="event-stream")
+                yield f"status: 504 \ncode: TIMEOUT \nerror: {str(e)}\n"
 
             except openai.AuthenticationError as e:
                 logging.error(f"Authentication error: {e}")
-                def error_stream():
-                    yield f"status: 401 \ncode: UNAUTHENTICATED \nerror: {str(e)}\n"
-                return Response(stream_with_context(error_stream()), content_type="event-stream")
+                yield f"status: 401 \ncode: UNAUTHENTICATED \nerror: {str(e)}\n"
 
             except openai.BadRequestError as e:
                 logging.error(f"Bad request error: {e}")
-                def error_stream():
-                    yield f"status: 400 \ncode: BAD_REQUEST_ERROR \nerror: {str(e)}\n"
-                return Response(stream_with_context(error_stream()), content_type="event-stream")
+                yield f"status: 400 \ncode: BAD_REQUEST_ERROR \nerror: {str(e)}\n"
 
             except openai.ConflictError as e:
                 logging.error(f"Conflict error: {e}")
-                def error_stream():
-                    yield f"status: 409 \ncode: CONFLICT \nerror: {str(e)}\n"
-                return Response(stream_with_context(error_stream()), content_type="event-stream")
+                yield f"status: 409 \ncode: CONFLICT \nerror: {str(e)}\n"
 
             except openai.InternalServerError as e:
                 logging.error(f"Internal server error: {e}")
-                def error_stream():
-                    yield f"status: 500 \ncode: INTERNAL_SERVER_ERROR \nerror: {str(e)}\n"
-                return Response(stream_with_context(error_stream()), content_type="event-stream")
+                yield f"status: 500 \ncode: INTERNAL_SERVER_ERROR \nerror: {str(e)}\n"
 
             except openai.NotFoundError as e:
                 logging.error(f"Not found error: {e}")
-                def error_stream():
-                    yield f"status: 404 \ncode: NOT_FOUND \nerror: {str(e)}\n"
-                return Response(stream_with_context(error_stream()), content_type="event-stream")
+                yield f"status: 404 \ncode: NOT_FOUND \nerror: {str(e)}\n"
 
             except openai.PermissionDeniedError as e:
                 logging.error(f"Permission denied error: {e}")
-                def error_stream():
-                    yield f"status: 403 \ncode: PERMISSION_DENIED \nerror: {str(e)}\n"
-                return Response(stream_with_context(error_stream()), content_type="event-stream")
+                yield f"status: 403 \ncode: PERMISSION_DENIED \nerror: {str(e)}\n"
 
             except openai.RateLimitError as e:
                 logging.error(f"Rate limit exceeded: {e}")
-                def error_stream():
-                    yield f"status: 429 \ncode: QUOTA_EXCEEDED \nerror: {str(e)}\n"
-                return Response(stream_with_context(error_stream()), content_type="event-stream")
+                yield f"status: 429 \ncode: QUOTA_EXCEEDED \nerror: {str(e)}\n"
 
             except openai.UnprocessableEntityError as e:
                 logging.error(f"Unprocessable entity error: {e}")
-                def error_stream():
-                    yield f"status: 422 \ncode: UNIDENTIFIABLE_DEVICE \nerror: {str(e)}\n"
-                return Response(stream_with_context(error_stream()), content_type="event-stream")
+                yield f"status: 422 \ncode: UNIDENTIFIABLE_DEVICE \nerror: {str(e)}\n"
 
             except Exception as e:
                 logging.error(f"Unexpected error: {e}")
-                def error_stream():
-                    yield f"status: 500 \ncode: INTERNAL_ERROR \nerror: {str(e)}\n"
-                return Response(stream_with_context(error_stream()), content_type="event-stream")
+                yield f"status: 500 \ncode: INTERNAL_ERROR \nerror: {str(e)}\n"
+            finally:
+                # Hand back the unused part of the max_tokens reservation, or all of it if nothing was sent
+                if requested:
+                    ticket.settle(reserved - COMPLETION_MAX_TOKENS + count_tokens("".join(chunks)))
+                else:
+                    ticket.settle(0)
                     
-            return Response(stream_with_context(generate_response()),content_type="event-stream")  
+        if preamble:
+            # References and timings go out at search latency; the answer-cache lookup and admission wait follow
+            def stream():
+                yield from preamble
+                try:
+                    started = start_answer()
+                except Exception as e:
+                    logging.error(f"Unexpected error: {e}")
+                    yield f"status: 500 \ncode: INTERNAL_ERROR \nerror: {str(e)}\n"
+                    return
+                yield from generate_response(started)
+            return Response(stream_with_context(stream()), content_type="event-stream")
+
+        started = start_answer()
+        _, error, admitted = started
+        if error is not None:
+            status, code, e = error
+            def error_stream():
+                yield f"status: {status} \ncode: {code} \nerror: {str(e)}\n"
+            return Response(stream_with_context(error_stream()), status=status, content_type="event-stream",
+                            headers={"Retry-After": str(e.retry_after)})
+        response = Response(stream_with_context(generate_response(started)), content_type="event-stream")
+        if admitted is not None:
+            # A client that disconnects before the stream starts never runs the generator's finally
+            response.call_on_close(lambda: admitted[2].settle(0))
+        return response
 
     except ValueError as e:
         logging.error(f"Value error: {e}")
@@ -224,84 +443,69 @@ def text_search():
             return Response(stream_with_context(error_stream()),content_type="event-stream")
 
 
-def sanitize_id(filename):
-    return re.sub(r'[^a-zA-Z0-9_-]', '_', filename)
+@app.route('/cache/stats', methods=['GET'])
+@cross_origin(supports_credentials=True)
+def cache_stats():
+    return jsonify({"answer_cache": answer_cache.snapshot(), "retrieval_cache": retrieval_cache.snapshot()})
 
 
-@retry(stop=stop_after_attempt(5), wait=wait_fixed(1))
-def get_image_vector(image_path, key, region):
-    headers = {'Ocp-Apim-Subscription-Key': key}
-    params = urllib.parse.urlencode({'model-version': '2023-04-15'})
-    
-    try:
-        if image_path.startswith(('http://', 'https://')):
-            headers['Content-Type'] = 'application/json'
-            body = json.dumps({"url": image_path})
-        else:
-            headers['Content-Type'] = 'application/octet-stream'
-            with open(image_path, "rb") as filehandler:
-                image_data = filehandler.read()
-                body = image_data
-
-        conn = http.client.HTTPSConnection(f'{region}.api.cognitive.microsoft.com', timeout=3)
-        conn.request("POST", "/computervision/retrieval:vectorizeImage?api-version=2023-04-01-preview&%s" % params, body, headers)
-        response = conn.getresponse()
-        data = json.load(response)
-        conn.close()
-
-        if response.status == 200:
-            return data.get("vector")
-        elif response.status == 401:
-            raise PermissionError("Unauthorized: Check API Key")
-        elif response.status == 400:
-            raise ValueError("Bad Request")
-        elif response.status == 429:
-            raise ConnectionError("Too many requests")
-        elif response.status == 503:
-            raise PermissionError("Service Unavailable")
-        else:
-            raise Exception(f"Unexpected Error:{response.status} {response.reason}")
-       
-    except FileNotFoundError:
-        raise FileNotFoundError(f"Image not found {image_path}")
-    except http.client.HTTPException as e:
-        raise ConnectionError(f"HTTP Error: {str(e)}")
-    except Exception as e:
-        raise Exception(f"Unexpected error: {str(e)}")
+@app.route('/cache/invalidate', methods=['POST'])
+@cross_origin(supports_credentials=True)
+def cache_invalidate():
+    # Called by the indexing job after the text index is re-uploaded
+    index_name = (request.get_json(silent=True) or {}).get("index", index)
+    retrieval_cache.invalidate(index_name)
+    return jsonify({"message": f"Retrieval cache invalidated for {index_name}."})
 
 
-def image_to_base64(image_path):
-    with open(image_path, "rb") as img_file:
-        return base64.b64encode(img_file.read()).decode('utf-8')
+def sanitize_id(filename):
+    return re.sub(r'[^a-zA-Z0-9_-]', '_', filename)
+
+
+@timed("get_image_vector")
+def get_image_vector(image, key, region):
+    # Hedged attempts run on the shared upstream pool, so the request thread only waits
+    return get_vision_client(key, region).vectorize(image, deadline=current_deadline())
 
 
 @app.route('/upload_images', methods=['POST'])
 @cross_origin(supports_credentials=True)
 def upload_all_images():
+    mode = request.args.get("mode") or (request.get_json(silent=True) or {}).get("mode")
+    if mode == "sync":
+        try:
+            vision_client = get_vision_client(aiVisionApiKey, aiVisionRegion)
+            with stage_timer("upload_documents"):
+                counts = sync_images(image_search_client, FILE_PATH_IMG, vision_client)
+            build_thumbnails(FILE_PATH_IMG, os.listdir(FILE_PATH_IMG))
+            if local_image_index:
+                local_image_index.reload()
+        except Exception as e:
+            return jsonify({ "Error processing files": str(e)})
+        return jsonify({"message": "Image index synchronised.", **counts})
+
     files = os.listdir(FILE_PATH_IMG)
-    image_embeddings = {}
-    documents = []
+    vectorize_errors = []
 
     try:
-        for file in files:
-            file_path = os.path.join(FILE_PATH_IMG, file)
-            image_embeddings[file] = get_image_vector(file_path, aiVisionApiKey, aiVisionRegion)
-        
-        for counter, file in enumerate(files):
-            sanitized_id = sanitize_id(file)
-            document = {
-                "id": sanitized_id,
-                "description": file,
-                "image_vector": image_embeddings[file]
-            }
-            documents.append(document)
+        # Documents are streamed from the vectorizer straight into the batched uploader
+        vision_client = get_vision_client(aiVisionApiKey, aiVisionRegion)
+        documents = image_documents(vision_client, FILE_PATH_IMG, files, vectorize_errors)
+        with stage_timer("upload_documents"):
+            report = upload_in_batches(image_search_client, documents)
+        build_thumbnails(FILE_PATH_IMG, files)
+        if local_image_index:
+            local_image_index.reload()
     except Exception as e:
          return jsonify({ "Error processing files": str(e)})
-    
 
-    if documents:
-        result = image_search_client.upload_documents(documents)
-        return jsonify({"message":f"Uploaded {len(documents)} documents successfully."})
+    report["failed"] += len(vectorize_errors)
+    report["errors"].extend(vectorize_errors)
+
+    if report["submitted"]:
+        return jsonify({"message":f"Uploaded {report['succeeded']} documents successfully.", "report": report})
+    elif vectorize_errors:
+        return jsonify({"Error processing files": report})
     else:
         return jsonify("No files to upload")
 
@@ -313,63 +517,75 @@ def image_search():
         if not file:
             return jsonify({"error": "No image file provided"}), 400
         
-        # Save the uploaded file temporarily
-        uploaded_image_path = os.path.join('uploads', file.filename)
-        file.save(uploaded_image_path)
-
-        # Get vector for the uploaded image
-        query_vector = get_image_vector(uploaded_image_path, aiVisionApiKey, aiVisionRegion)
-
-        # Create VectorizedQuery for similarity search
-        vectorized_query = VectorizedQuery(
-            kind="vector",
-            vector=query_vector,
-            k_nearest_neighbors=2,  
-            fields="image_vector", 
-        )
-        try:
-        # Perform the search using VectorizedQuery
-            results = image_search_client.search(
-                search_text=None, 
-                vector_queries=[vectorized_query],
-                select=["description"]
+        # Werkzeug spools uploads to a SpooledTemporaryFile; read it (bounded by MAX_CONTENT_LENGTH)
+        query_vector = get_image_vector(file.read(), aiVisionApiKey, aiVisionRegion)
+
+        index = local_image_index.get() if local_image_index else None
+        if index is not None and len(index):
+            with stage_timer("local_image_search"):
+                results = index.search(query_vector, k=2)
+        else:
+            # Create VectorizedQuery for similarity search
+            vectorized_query = VectorizedQuery(
+                kind="vector",
+                vector=query_vector,
+                k_nearest_neighbors=2,  
+                fields="image_vector", 
             )
-        except HttpResponseError as e:
-            if e.status_code == 400:
-                return jsonify({"status": 400, "code": "BAD_REQUEST", "message": e.message}), 400
-            elif e.status_code == 401:
-                return jsonify({"status": 401, "code": "UNAUTHORIZED", "message": e.message}), 401
-            elif e.status_code == 403:
-                return jsonify({"status": 403, "code": "FORBIDDEN", "message": e.message}), 403
-            elif e.status_code == 404:
-                return jsonify({"status": 404, "code": "NOT_FOUND", "message": e.message}), 404
-            elif e.status_code == 409:
-                return jsonify({"status": 409, "code": "CONFLICT", "message": e.message}), 409
-            elif e.status_code == 422:
-                return jsonify({"status": 422, "code": "UNPROCESSABLE_ENTITY", "message": e.message}), 422
-            elif e.status_code == 500:
-                return jsonify({"status": 500, "code": "INTERNAL_SERVER_ERROR", "message": e.message}), 500
-            elif e.status_code == 503:
-                return jsonify({"status": 503, "code": "SERVICE_UNAVAILABLE", "message": e.message}), 503
-            else:
-                return jsonify({"status": e.status_code, "code": "UNEXPECTED_ERROR", "message": e.message}), e.status_code
-        except ServiceRequestError as e:
-            return jsonify({"status": 504, "code": "SERVICE_REQUEST_ERROR", "message": str(e)}), 504
-        except Exception as e:
-            return jsonify({"status": 500, "code": "INTERNAL_ERROR", "message": str(e)}), 500
+            try:
+            # Perform the search using VectorizedQuery; the pager is read here so the timing covers the call
+                with stage_timer("image_search"):
+                    results = call_upstream(
+                        "image_search",
+                        lambda timeout: list(image_search_client.search(
+                            search_text=None, 
+                            vector_queries=[vectorized_query],
+                            select=["description"],
+                            **search_options(timeout)
+                        )),
+                        hedge=True,
+                        retryable=is_transient_search_error,
+                        breaker=image_index_breaker,
+                    )
+            except HttpResponseError as e:
+                if e.status_code == 400:
+                    return jsonify({"status": 400, "code": "BAD_REQUEST", "message": e.message}), 400
+                elif e.status_code == 401:
+                    return jsonify({"status": 401, "code": "UNAUTHORIZED", "message": e.message}), 401
+                elif e.status_code == 403:
+                    return jsonify({"status": 403, "code": "FORBIDDEN", "message": e.message}), 403
+                elif e.status_code == 404:
+                    return jsonify({"status": 404, "code": "NOT_FOUND", "message": e.message}), 404
+                elif e.status_code == 409:
+                    return jsonify({"status": 409, "code": "CONFLICT", "message": e.message}), 409
+                elif e.status_code == 422:
+                    return jsonify({"status": 422, "code": "UNPROCESSABLE_ENTITY", "message": e.message}), 422
+                elif e.status_code == 500:
+                    return jsonify({"status": 500, "code": "INTERNAL_SERVER_ERROR", "message": e.message}), 500
+                elif e.status_code == 503:
+                    return jsonify({"status": 503, "code": "SERVICE_UNAVAILABLE", "message": e.message}), 503
+                else:
+                    return jsonify({"status": e.status_code, "code": "UNEXPECTED_ERROR", "message": e.message}), e.status_code
+            except ServiceRequestError as e:
+                return jsonify({"status": 504, "code": "SERVICE_REQUEST_ERROR", "message": str(e)}), 504
+            except DeadlineExceeded as e:
+                return jsonify({"status": 504, "code": "DEADLINE_EXCEEDED", "message": str(e)}), 504
+            except CircuitOpen as e:
+                return jsonify({"status": 503, "code": "SERVICE_UNAVAILABLE", "message": str(e)}), 503, {"Retry-After": str(e.retry_after)}
+            except Exception as e:
+                return jsonify({"status": 500, "code": "INTERNAL_ERROR", "message": str(e)}), 500
 
 
-        similar_images = []
-        for result in results:
-            image_path = os.path.join(FILE_PATH_IMG, result["description"])
-            encoded_image = image_to_base64(image_path) 
-            similar_images.append({
-                "image_name": result["description"],
-                "image_base64": encoded_image
-            })
+        # Hits carry a cached thumbnail, or just URLs to /images when ?mode=url
+        mode = request.args.get("mode", "inline")
+        similar_images = [image_result(result["description"], thumbnail_cache, mode) for result in results]
 
         return jsonify({"similar_images": similar_images})
     
+    except RequestEntityTooLarge as e:
+        return jsonify({ "status": 413 ,"code": "PAYLOAD_TOO_LARGE","message": str(e)}), 413
+    except CircuitOpen as e:
+        return jsonify({ "status": 503 ,"code": "SERVICE_UNAVAILABLE","message": str(e)}), 503, {"Retry-After": str(e.retry_after)}
     except TimeoutError as e:
         return jsonify({ "status": 504 ,"code": "INVALID_ARGUMENT","message": str(e)}), 504
     except Exception as e:
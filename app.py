@@ -8,6 +8,7 @@ from azure.core.credentials import AzureKeyCredential
 from azure.search.documents import SearchClient
 from azure.search.documents.models import RawVectorQuery
 from dotenv import load_dotenv
+from thumbnails import thumbnail_path
 
 load_dotenv()
 
@@ -43,4 +44,5 @@ if uploaded_image:
         st.write(result["description"])
         image_path = os.path.join("images", result["description"])
         if os.path.exists(image_path):
-            st.image(image_path, caption=result["description"], use_column_width=True)
+            # Show the precomputed thumbnail rather than the full-size original
+            st.image(thumbnail_path("images", result["description"]), caption=result["description"], use_column_width=True)
@@ -0,0 +1,540 @@
+import re
+import os
+import json
+import time
+import asyncio
+import logging
+import openai
+from openai import AsyncAzureOpenAI
+from quart import Quart, request, jsonify, Response, url_for, abort, send_from_directory
+from quart_cors import cors
+from werkzeug.security import safe_join
+from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
+from azure.search.documents.models import QueryType, VectorizedQuery
+from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError, ServiceRequestError
+from vision import get_vision_client, get_embedding_cache, MODEL_VERSION, MAX_IMAGE_BYTES
+from index_sync import sync_images, image_documents
+from batch_upload import upload_in_batches
+from answer_cache import AnswerCache
+from micro_batch import MicroBatcher
+from retrieval_cache import retrieval_cache
+from context_builder import build_context, count_tokens, COMPLETION_MAX_TOKENS
+from clients import search_options, is_transient_search_error, is_search_outage, is_openai_outage
+from admission import admission_controller, estimate_tokens, AdmissionRejected
+from deadline import register_async_deadline, current_deadline, acall_upstream, DeadlineExceeded
+from circuit_breaker import get_breaker, CircuitOpen
+from metrics import register_async_metrics, stage_timer, observe_stage
+from thumbnails import ThumbnailCache, build_thumbnails, image_result, thumbnail_path, thumbnail_name, THUMBNAIL_DIR
+from azure_openai import *
+from config import *
+
+# Async server mode for api.py: same routes and payloads, served with
+#   hypercorn asgi:app   (or uvicorn asgi:app)
+# Each streaming answer is a coroutine rather than a worker thread.
+
+credential = AzureKeyCredential(searchkey)
+text_search_client = AsyncSearchClient(endpoint=service_endpoint, index_name=index, credential=credential)
+image_search_client = AsyncSearchClient(endpoint=service_endpoint, index_name=index_image, credential=credential)
+# Uploads reuse the thread-pooled batch uploader, which drives the sync client
+image_upload_client = SearchClient(endpoint=service_endpoint, index_name=index_image, credential=credential)
+# While an upstream's circuit is open, calls fail fast instead of waiting out timeouts and retries;
+# the breakers are per process and shared with any sync code loaded alongside
+text_index_breaker = get_breaker("text_index", is_failure=is_search_outage)
+image_index_breaker = get_breaker("image_index", is_failure=is_search_outage)
+openai_breaker = get_breaker("openai", is_failure=is_openai_outage)
+
+async_client = AsyncAzureOpenAI(
+    azure_endpoint=os.environ.get("AZURE_OPENAI_ENDPOINT"),
+    api_key=os.environ.get("AZURE_OPENAI_API_KEY"),
+    api_version=os.environ.get("AZURE_OPENAI_API_VERSION", "2024-02-01"),
+)
+
+LOCAL_IMAGE_INDEX = os.environ.get("LOCAL_IMAGE_INDEX", "false").lower() == "true"
+local_image_index = None
+if LOCAL_IMAGE_INDEX:
+    from local_index import LocalIndexHolder, load_local_index
+    local_image_index = LocalIndexHolder(lambda: load_local_index(FILE_PATH_IMG, get_embedding_cache(), MODEL_VERSION))
+
+app = Quart(__name__)
+app = cors(app, allow_origin=re.compile(r".*"), allow_credentials=True)
+app.config['MAX_CONTENT_LENGTH'] = MAX_IMAGE_BYTES
+# Answers stream for as long as the completion runs
+app.config['RESPONSE_TIMEOUT'] = None
+
+thumbnail_cache = ThumbnailCache(FILE_PATH_IMG)
+
+# Per-stage latency histograms on /metrics; SERVER_TIMING=true also sets a Server-Timing header
+register_async_metrics(app)
+
+# Every request gets a time budget (REQUEST_DEADLINE_SECONDS, or less via X-Request-Timeout) shared by its upstream calls
+register_async_deadline(app)
+
+logging.basicConfig(level=logging.INFO)
+
+# Field mappings of the text index, read once per worker
+KB_FIELDS_CONTENT = os.environ.get("KB_FIELDS_CONTENT", "content")
+KB_FIELDS_SOURCEPAGE = os.environ.get("KB_FIELDS_SOURCEPAGE", "sourcepage")
+KB_FIELDS_ID = os.environ.get("KB_FIELDS_ID", "id")
+
+ANSWER_CACHE_EMBEDDING_DEPLOYMENT = os.environ.get("ANSWER_CACHE_EMBEDDING_DEPLOYMENT")
+
+def embed_questions(questions, deadline=None):
+    # A batch is bounded by the latest deadline among the questions in it
+    timeout = {} if deadline is None else {"timeout": deadline.timeout()}
+    response = openai_breaker.call(client.embeddings.create, model=ANSWER_CACHE_EMBEDDING_DEPLOYMENT, input=questions, **timeout)
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+# Questions embedded within a few milliseconds of each other share one embeddings call
+embed_question = MicroBatcher(dispatch_batch=embed_questions, name="embed-question")
+
+answer_cache = AnswerCache(embed=embed_question if ANSWER_CACHE_EMBEDDING_DEPLOYMENT else None)
+
+SEARCH_ERROR_CODES = {
+    400: "BAD_REQUEST",
+    401: "UNAUTHORIZED",
+    403: "FORBIDDEN",
+    404: "NOT_FOUND",
+    409: "CONFLICT",
+    422: "UNPROCESSABLE_ENTITY",
+    500: "INTERNAL_SERVER_ERROR",
+    503: "SERVICE_UNAVAILABLE",
+}
+
+# Checked in order: APITimeoutError subclasses APIConnectionError
+OPENAI_ERRORS = [
+    (openai.APITimeoutError, 504, "TIMEOUT"),
+    (DeadlineExceeded, 504, "TIMEOUT"),
+    (openai.APIConnectionError, 503, "API_CONNECTION_ERROR"),
+    (openai.AuthenticationError, 401, "UNAUTHENTICATED"),
+    (openai.BadRequestError, 400, "BAD_REQUEST_ERROR"),
+    (openai.ConflictError, 409, "CONFLICT"),
+    (openai.InternalServerError, 500, "INTERNAL_SERVER_ERROR"),
+    (openai.NotFoundError, 404, "NOT_FOUND"),
+    (openai.PermissionDeniedError, 403, "PERMISSION_DENIED"),
+    (openai.RateLimitError, 429, "QUOTA_EXCEEDED"),
+    (openai.UnprocessableEntityError, 422, "UNIDENTIFIABLE_DEVICE"),
+    (ValueError, 400, "INVALID_ARGUMENT"),
+]
+
+
+def error_line(status, code, error):
+    return f"status: {status} \ncode: {code} \nerror: {str(error)}\n"
+
+
+def error_stream_response(status, code, error, retry_after=None):
+    """An event stream carrying one error line; with `retry_after` it is also sent with that HTTP status."""
+    async def error_stream():
+        yield error_line(status, code, error)
+    if retry_after is None:
+        return Response(error_stream(), content_type="event-stream")
+    return Response(error_stream(), status=status, content_type="event-stream",
+                    headers={"Retry-After": str(retry_after)})
+
+
+class ClosingBody:
+    """Async iterator over `body` that calls `on_close(started)` once it ends, fails or is dropped.
+
+    A body generator that is never iterated (the client left before the first
+    chunk) never runs its `finally`; this runs `on_close(False)` for it.
+    """
+
+    def __init__(self, body, on_close):
+        self._body = body
+        self._on_close = on_close
+        self._started = False
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        self._started = True
+        try:
+            return await self._body.__anext__()
+        except BaseException:
+            self._close()
+            raise
+
+    async def aclose(self):
+        try:
+            await self._body.aclose()
+        finally:
+            self._close()
+
+    def _close(self):
+        if not self._closed:
+            self._closed = True
+            self._on_close(self._started)
+
+    def __del__(self):
+        # The server dropped the body without closing it
+        self._close()
+
+
+def replay_response(chunks):
+    async def replay():
+        for chunk in chunks:
+            yield chunk
+    return Response(replay(), content_type="event-stream")
+
+
+async def admit(reserved, priority, max_wait):
+    """`admission_controller.acquire` off the event loop (file lock, queue wait)."""
+    acquire = asyncio.ensure_future(asyncio.to_thread(admission_controller.acquire, reserved, priority, max_wait=max_wait))
+    try:
+        return await asyncio.shield(acquire)
+    except asyncio.CancelledError:
+        # The client left while queued: hand back whatever the worker thread still admits
+        def give_back(future):
+            if not future.cancelled() and future.exception() is None:
+                future.result().settle(0)
+                openai_breaker.release()
+        acquire.add_done_callback(give_back)
+        raise
+
+
+async def search_documents(query, filter_condition, timeout):
+    results = await text_search_client.search(
+        query,
+        filter=filter_condition,
+        query_type=QueryType.SEMANTIC,
+        semantic_configuration_name="default",
+        top=3,
+        **search_options(timeout)
+    )
+    return [doc async for doc in results]
+
+
+@app.route('/devedgesearch', methods=['POST'])
+async def text_search():
+    try:
+        payload = (await request.get_json()) or {}
+        user_input = payload.get("question")
+        if not user_input:
+            raise ValueError("Prompt is required")
+
+        filter_condition = None
+        deadline = current_deadline()
+
+        try:
+            with stage_timer("text_search"):
+                documents = await retrieval_cache.aget_or_search(
+                    index, user_input, filter_condition, 3, lambda: acall_upstream(
+                        "search",
+                        lambda timeout: search_documents(user_input, filter_condition, timeout),
+                        retryable=is_transient_search_error,
+                        breaker=text_index_breaker,
+                    )
+                )
+        except CircuitOpen as e:
+            # Search is down: answer from the last results for this query, else replay the last answer, else fail fast
+            logging.warning(f"Serving fallback: {e}")
+            documents = retrieval_cache.last_results(index, user_input, filter_condition, 3)
+            if documents is None:
+                fallback = answer_cache.last_answer(user_input)
+                if fallback is not None:
+                    return replay_response(fallback)
+                return error_stream_response(503, "SERVICE_UNAVAILABLE", e, retry_after=e.retry_after)
+        except HttpResponseError as e:
+            logging.error(f"Azure Search API error: {e.message}")
+            return error_stream_response(e.status_code, SEARCH_ERROR_CODES.get(e.status_code, "AZURE_SEARCH_API_ERROR"), e)
+        except ServiceRequestError as e:
+            logging.error(f"Service request error: {e}")
+            return error_stream_response(504, "SERVICE_REQUEST_ERROR", e)
+        except DeadlineExceeded as e:
+            logging.error(f"Search deadline exceeded: {e}")
+            return error_stream_response(504, "DEADLINE_EXCEEDED", e)
+        except Exception as e:
+            logging.error(f"Unexpected error: {e}")
+            return error_stream_response(500, "INTERNAL_ERROR", e)
+
+        doc_ids, references = [], []
+        for doc in documents:
+            doc_ids.append(str(doc.get(KB_FIELDS_ID) or doc[KB_FIELDS_SOURCEPAGE]))
+            if doc[KB_FIELDS_SOURCEPAGE] not in references:
+                references.append(doc[KB_FIELDS_SOURCEPAGE])
+        # Chunk, rank, dedupe and pack the retrieved passages into the prompt's token budget
+        with stage_timer("build_context"):
+            content = build_context(user_input, documents, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT)
+
+        preamble = []
+        if payload.get("include_references"):
+            preamble.append(f"event: references\ndata: {json.dumps(references)}\n\n")
+
+        priority = request.headers.get("X-Priority", "normal")
+
+        async def start_answer():
+            """Everything between the references and the completion: returns (replay, error, admitted),
+            as in api.py."""
+            cached_chunks, question_embedding = await asyncio.to_thread(answer_cache.lookup, user_input, doc_ids, deadline)
+            if cached_chunks is not None:
+                return cached_chunks, None, None
+
+            # OpenAI is down: replay the last answer to this question, else fail fast
+            try:
+                openai_breaker.allow()
+            except CircuitOpen as e:
+                logging.warning(f"Serving fallback: {e}")
+                fallback = answer_cache.last_answer(user_input)
+                if fallback is not None:
+                    return fallback, None, None
+                return None, (503, "SERVICE_UNAVAILABLE", e), None
+
+            conversation = [{"role": "system", "content": "Assistant is a great language model formed by OpenAI."}]
+            with stage_timer("create_prompt"):
+                prompt = create_prompt(content, user_input)
+            conversation.append({"role": "assistant", "content": prompt})
+            conversation.append({"role": "user", "content": user_input})
+
+            # Reserve prompt + max_tokens against the shared TPM/RPM budget; shed with a 429 rather than queue unbounded
+            reserved = estimate_tokens(conversation)
+            try:
+                with stage_timer("admission"):
+                    ticket = await admit(reserved, priority, deadline.remaining())
+            except AdmissionRejected as e:
+                logging.warning(f"Shedding request: {e}")
+                openai_breaker.release()
+                return None, (429, "QUOTA_EXCEEDED", e), None
+            return None, None, (conversation, reserved, ticket, question_embedding)
+
+        async def generate_response(started):
+            replay, error, admitted = started
+            if replay is not None:
+                for chunk in replay:
+                    yield chunk
+                return
+            if error is not None:
+                yield error_line(*error)
+                return
+            conversation, reserved, ticket, question_embedding = admitted
+            reply = None
+            chunks = []
+            requested = False
+            try:
+                # The breaker hears how the call ended once the stream is done
+                with openai_breaker.track():
+                    completion_start = time.perf_counter()
+                    with stage_timer("completion_open"):
+                        timeout = deadline.timeout()
+                        requested = True
+                        reply = await async_client.chat.completions.create(
+                            model=deployment_id_gpt4,
+                            messages=conversation,
+                            temperature=0,
+                            max_tokens=COMPLETION_MAX_TOKENS,
+                            top_p=1,
+                            frequency_penalty=0,
+                            presence_penalty=0,
+                            stream=True,
+                            stop=[' END'],
+                            # Bounds connecting and each read of the stream, not the whole answer
+                            timeout=timeout,
+                        )
+
+                    # Each yield waits for the ASGI server to accept the chunk, so a slow
+                    # client slows the read from OpenAI instead of buffering the answer
+                    async for chunk in reply:
+                        if chunk.choices and chunk.choices[0].delta.content is not None:
+                            if not chunks:
+                                observe_stage("first_chunk", time.perf_counter() - completion_start)
+                            chunks.append(chunk.choices[0].delta.content)
+                            yield chunk.choices[0].delta.content
+                    observe_stage("stream_end", time.perf_counter() - completion_start)
+                answer_cache.store(user_input, doc_ids, chunks, question_embedding)
+
+            except Exception as e:
+                for error_type, status, code in OPENAI_ERRORS:
+                    if isinstance(e, error_type):
+                        break
+                else:
+                    status, code = 500, "INTERNAL_ERROR"
+                logging.error(f"Completion error: {e}")
+                yield error_line(status, code, e)
+            finally:
+                # Hand back the unused part of the max_tokens reservation, or all of it if nothing was sent
+                if requested:
+                    ticket.settle(reserved - COMPLETION_MAX_TOKENS + count_tokens("".join(chunks)))
+                else:
+                    ticket.settle(0)
+                # Runs on client disconnect too (the response task is cancelled),
+                # closing the upstream stream so the completion stops
+                if reply is not None:
+                    await reply.close()
+
+        if preamble:
+            # References go out at search latency; the answer-cache lookup and admission wait follow
+            async def stream():
+                for chunk in preamble:
+                    yield chunk
+                try:
+                    started = await start_answer()
+                except Exception as e:
+                    logging.error(f"Unexpected error: {e}")
+                    yield error_line(500, "INTERNAL_ERROR", e)
+                    return
+                async for chunk in generate_response(started):
+                    yield chunk
+            return Response(stream(), content_type="event-stream")
+
+        started = await start_answer()
+        _, error, _ = started
+        if error is not None:
+            return error_stream_response(*error, retry_after=error[2].retry_after)
+        _, _, admitted = started
+        if admitted is None:
+            return Response(generate_response(started), content_type="event-stream")
+
+        def abandon(started_streaming):
+            # Once iterated, generate_response settles the ticket and reports to the breaker itself
+            if not started_streaming:
+                admitted[2].settle(0)
+                openai_breaker.release()
+        return Response(ClosingBody(generate_response(started), abandon), content_type="event-stream")
+
+    except ValueError as e:
+        logging.error(f"Value error: {e}")
+        async def error_stream():
+            yield f"Error: {str(e)}\n"
+        return Response(error_stream(), content_type="event-stream")
+
+    except Exception as e:
+        logging.error(f"Unexpected error: {e}")
+        async def error_stream():
+            yield f"Error: Unexpected error - {str(e)}\n"
+        return Response(error_stream(), content_type="event-stream")
+
+
+def upload_images(mode):
+    # Runs in a worker thread: vectorization and batch uploads are thread-pooled already
+    vision_client = get_vision_client(aiVisionApiKey, aiVisionRegion)
+    if mode == "sync":
+        counts = sync_images(image_upload_client, FILE_PATH_IMG, vision_client)
+        build_thumbnails(FILE_PATH_IMG, os.listdir(FILE_PATH_IMG))
+        if local_image_index:
+            local_image_index.reload()
+        return {"message": "Image index synchronised.", **counts}
+
+    files = os.listdir(FILE_PATH_IMG)
+    vectorize_errors = []
+    documents = image_documents(vision_client, FILE_PATH_IMG, files, vectorize_errors)
+    report = upload_in_batches(image_upload_client, documents)
+    build_thumbnails(FILE_PATH_IMG, files)
+    if local_image_index:
+        local_image_index.reload()
+
+    report["failed"] += len(vectorize_errors)
+    report["errors"].extend(vectorize_errors)
+    if report["submitted"]:
+        return {"message": f"Uploaded {report['succeeded']} documents successfully.", "report": report}
+    elif vectorize_errors:
+        return {"Error processing files": report}
+    return "No files to upload"
+
+
+@app.route('/upload_images', methods=['POST'])
+async def upload_all_images():
+    mode = request.args.get("mode") or ((await request.get_json(silent=True)) or {}).get("mode")
+    try:
+        result = await asyncio.to_thread(upload_images, mode)
+    except Exception as e:
+        return jsonify({"Error processing files": str(e)})
+    return jsonify(result)
+
+
+@app.route('/imagesearch', methods=['POST'])
+async def image_search():
+    try:
+        file = (await request.files).get('image')
+        if not file:
+            return jsonify({"error": "No image file provided"}), 400
+
+        vision_client = get_vision_client(aiVisionApiKey, aiVisionRegion)
+        # Read the spooled upload (bounded by MAX_CONTENT_LENGTH) so Vision gets an in-memory body;
+        # the request deadline bounds the call and its retries, as in api.py
+        query_vector = await asyncio.to_thread(vision_client.vectorize, file.read(), deadline=current_deadline())
+
+        local_index = local_image_index.get() if local_image_index else None
+        if local_index is not None and len(local_index):
+            with stage_timer("local_image_search"):
+                results = local_index.search(query_vector, k=2)
+        else:
+            vectorized_query = VectorizedQuery(
+                kind="vector",
+                vector=query_vector,
+                k_nearest_neighbors=2,
+                fields="image_vector",
+            )
+
+            async def search(timeout):
+                pager = await image_search_client.search(
+                    search_text=None,
+                    vector_queries=[vectorized_query],
+                    select=["description"],
+                    **search_options(timeout)
+                )
+                return [result async for result in pager]
+
+            try:
+                with stage_timer("image_search"):
+                    results = await acall_upstream(
+                        "image_search", search, retryable=is_transient_search_error, breaker=image_index_breaker,
+                    )
+            except (CircuitOpen, DeadlineExceeded):
+                raise
+            except HttpResponseError as e:
+                code = SEARCH_ERROR_CODES.get(e.status_code, "UNEXPECTED_ERROR")
+                return jsonify({"status": e.status_code, "code": code, "message": e.message}), e.status_code
+            except ServiceRequestError as e:
+                return jsonify({"status": 504, "code": "SERVICE_REQUEST_ERROR", "message": str(e)}), 504
+            except Exception as e:
+                return jsonify({"status": 500, "code": "INTERNAL_ERROR", "message": str(e)}), 500
+
+        if request.args.get("mode", "inline") == "url":
+            similar_images = [image_result(result["description"], thumbnail_cache, "url", url_for=url_for) for result in results]
+        else:
+            # Thumbnail reads may touch the disk; keep them off the event loop
+            similar_images = await asyncio.to_thread(
+                lambda: [image_result(result["description"], thumbnail_cache) for result in results]
+            )
+
+        return jsonify({"similar_images": similar_images})
+
+    except CircuitOpen as e:
+        # Vision or the image index is down: fail fast rather than let the request wait out the outage
+        return jsonify({"error": str(e)}), 503, {"Retry-After": str(e.retry_after)}
+    except TimeoutError as e:
+        return jsonify({"status": 504, "code": "INVALID_ARGUMENT", "message": str(e)}), 504
+    except Exception as e:
+        return jsonify({"status": 500, "code": "INTERNAL", "message": str(e)}), 500
+
+
+@app.route('/images/<path:image_name>', methods=['GET'])
+async def serve_image(image_name):
+    source = safe_join(FILE_PATH_IMG, image_name)
+    if source is None or not os.path.isfile(source):
+        abort(404)
+    if request.args.get("size", "thumb") == "thumb":
+        await asyncio.to_thread(thumbnail_path, FILE_PATH_IMG, image_name)
+        return await send_from_directory(os.path.abspath(THUMBNAIL_DIR), thumbnail_name(image_name))
+    return await send_from_directory(os.path.abspath(FILE_PATH_IMG), image_name)
+
+
+@app.route('/cache/invalidate', methods=['POST'])
+async def cache_invalidate():
+    # Called by the indexing job after the text index is re-uploaded; reaches every worker on the host
+    index_name = ((await request.get_json(silent=True)) or {}).get("index", index)
+    retrieval_cache.invalidate(index_name)
+    return jsonify({"message": f"Retrieval cache invalidated for {index_name}."})
+
+
+@app.after_serving
+async def close_clients():
+    await text_search_client.close()
+    await image_search_client.close()
+    await async_client.close()
+
+
+if __name__ == '__main__':
+    app.run()
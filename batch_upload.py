@@ -0,0 +1,130 @@
+import os
+import json
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+
+# Azure AI Search accepts at most 1000 documents / 16 MB per indexing request
+UPLOAD_BATCH_SIZE = int(os.environ.get("UPLOAD_BATCH_SIZE", "500"))
+UPLOAD_BATCH_BYTES = int(os.environ.get("UPLOAD_BATCH_BYTES", str(8 * 1024 * 1024)))
+UPLOAD_MAX_WORKERS = int(os.environ.get("UPLOAD_MAX_WORKERS", "4"))
+UPLOAD_MAX_RETRIES = int(os.environ.get("UPLOAD_MAX_RETRIES", "3"))
+
+# Per-document status codes that are worth sending again
+RETRYABLE_STATUS = (409, 422, 503)
+
+ACTIONS = {
+    "upload": "upload_documents",
+    "merge_or_upload": "merge_or_upload_documents",
+    "delete": "delete_documents",
+}
+
+
+def iter_batches(documents, max_docs=UPLOAD_BATCH_SIZE, max_bytes=UPLOAD_BATCH_BYTES):
+    """Group a document stream into batches bounded by count and JSON size."""
+    batch, batch_bytes = [], 0
+    for document in documents:
+        size = len(json.dumps(document))
+        if batch and (len(batch) >= max_docs or batch_bytes + size > max_bytes):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(document)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+def _send(search_client, action, batch, key_field, max_retries):
+    """Send one batch, re-sending only documents that failed with a retryable status."""
+    method = getattr(search_client, ACTIONS[action])
+    report = {"succeeded": 0, "retried": 0, "errors": []}
+    pending = batch
+
+    for attempt in range(1, max_retries + 1):
+        try:
+            results = method(pending)
+        except HttpResponseError as e:
+            if e.status_code == 413 and len(pending) > 1:
+                # Payload too large: split in half and send each part on its own
+                middle = len(pending) // 2
+                for part in (pending[:middle], pending[middle:]):
+                    part_report = _send(search_client, action, part, key_field, max_retries)
+                    for name in ("succeeded", "retried"):
+                        report[name] += part_report[name]
+                    report["errors"].extend(part_report["errors"])
+                return report
+            if attempt == max_retries:
+                report["errors"].extend(
+                    {"key": document[key_field], "status_code": e.status_code, "message": e.message}
+                    for document in pending
+                )
+                return report
+            time.sleep(2 ** (attempt - 1))
+            continue
+        except (ServiceRequestError, ServiceResponseError, TimeoutError) as e:
+            # Connection failures and timeouts fail this batch only, never the whole upload
+            if attempt == max_retries:
+                report["errors"].extend(
+                    {"key": document[key_field], "status_code": None, "message": str(e)}
+                    for document in pending
+                )
+                return report
+            report["retried"] += len(pending)
+            time.sleep(2 ** (attempt - 1))
+            continue
+
+        by_key = {document[key_field]: document for document in pending}
+        retry = []
+        for result in results:
+            if result.succeeded:
+                report["succeeded"] += 1
+            elif result.status_code in RETRYABLE_STATUS and attempt < max_retries:
+                retry.append(by_key[result.key])
+            else:
+                report["errors"].append(
+                    {"key": result.key, "status_code": result.status_code, "message": result.error_message}
+                )
+
+        if not retry:
+            return report
+        report["retried"] += len(retry)
+        pending = retry
+        time.sleep(2 ** (attempt - 1))
+    return report
+
+
+def upload_in_batches(search_client, documents, action="upload", key_field="id",
+                      max_docs=UPLOAD_BATCH_SIZE, max_bytes=UPLOAD_BATCH_BYTES,
+                      max_workers=UPLOAD_MAX_WORKERS, max_retries=UPLOAD_MAX_RETRIES):
+    """Index a stream of documents in parallel batches and report per-key outcomes.
+
+    `documents` may be any iterable, e.g. a generator fed by the vectorizer;
+    only `max_workers` batches are held in memory at a time. The returned
+    report counts submitted, succeeded, retried and failed documents and lists
+    the failed keys with their status codes.
+    """
+    report = {"submitted": 0, "succeeded": 0, "retried": 0, "failed": 0, "batches": 0, "errors": []}
+    in_flight = set()
+
+    def collect(done):
+        for future in done:
+            batch_report = future.result()
+            report["succeeded"] += batch_report["succeeded"]
+            report["retried"] += batch_report["retried"]
+            report["errors"].extend(batch_report["errors"])
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="upload") as executor:
+        for batch in iter_batches(documents, max_docs, max_bytes):
+            if len(in_flight) >= max_workers:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            report["submitted"] += len(batch)
+            report["batches"] += 1
+            in_flight.add(executor.submit(_send, search_client, action, batch, key_field, max_retries))
+        collect(wait(in_flight).done)
+
+    report["failed"] = len(report["errors"])
+    for error in report["errors"]:
+        logging.error(f"Failed to index {error['key']}: {error['status_code']} {error['message']}")
+    return report
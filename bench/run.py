@@ -0,0 +1,341 @@
+"""Offline load test for api.py, wsgi.py and image.py.
+
+Starts local stubs for Azure AI Search, Azure OpenAI and Azure AI Vision,
+launches each app against them and drives its endpoints at a fixed
+concurrency. Reports p50/p95/p99 latency, time to first byte of streamed
+answers (TTFT), requests per second and server RSS, and writes them as JSON:
+
+    python -m bench.run --concurrency 16 --requests 200 --first-token-ms 400
+    python -m bench.run --scenario api-devedgesearch --scenario wsgi-search
+
+The apps read `config` and `azure_openai` modules that are not in the repo;
+the harness generates minimal versions pointing at the stubs on a temporary
+PYTHONPATH. Requires the apps' own dependencies (requirements of api.py etc.).
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import zlib
+import socket
+import struct
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from .stubs import start_stub_server, add_stub_arguments, stub_config
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG_SHIM = '''service_endpoint = "{stub_url}"
+searchservice = "bench"
+searchkey = "bench-key"
+index = "bench-text"
+index_image = "bench-images"
+aiVisionApiKey = "bench-key"
+aiVisionRegion = "bench"
+FILE_PATH_IMG = {image_dir!r}
+deployment_id_gpt4 = "bench-gpt4"
+'''
+
+AZURE_OPENAI_SHIM = '''from clients import get_openai_client
+from config import deployment_id_gpt4
+
+client = get_openai_client()
+
+
+def create_prompt(content, question):
+    return f"Answer the question using only these sources.\\nSources:\\n{content}\\nQuestion: {question}"
+
+
+def generate_answer(conversation):
+    response = client.chat.completions.create(model=deployment_id_gpt4, messages=conversation, max_tokens=1000)
+    return response.choices[0].message.content
+'''
+
+# name: (module, method, path, kind)
+SCENARIOS = {
+    "api-devedgesearch": ("api", "POST", "/devedgesearch", "question"),
+    "api-imagesearch": ("api", "POST", "/imagesearch", "image"),
+    "api-upload": ("api", "POST", "/upload_images", "upload"),
+    "wsgi-search": ("wsgi", "POST", "/search", "question"),
+    "image-search": ("image", "POST", "/search?mode=url", "image"),
+}
+
+
+def png_bytes(seed, size=64):
+    """A small, valid RGB PNG whose pixels (and so content hash) depend on `seed`."""
+    rng = random.Random(seed)
+    rows = b"".join(b"\x00" + bytes(rng.randrange(256) for _ in range(size * 3)) for _ in range(size))
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b"")
+
+
+def prepare_workdir(stub_url, images):
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    image_dir = os.path.join(workdir, "images")
+    os.makedirs(image_dir)
+    for i in range(images):
+        with open(os.path.join(image_dir, f"image-{i}.png"), "wb") as f:
+            f.write(png_bytes(i))
+    shim_dir = os.path.join(workdir, "shims")
+    os.makedirs(shim_dir)
+    with open(os.path.join(shim_dir, "config.py"), "w") as f:
+        f.write(CONFIG_SHIM.format(stub_url=stub_url, image_dir=image_dir))
+    with open(os.path.join(shim_dir, "azure_openai.py"), "w") as f:
+        f.write(AZURE_OPENAI_SHIM)
+    return workdir
+
+
+def app_environment(stub_url, workdir, keep_caches):
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": os.pathsep.join([os.path.join(workdir, "shims"), REPO_DIR]),
+        "AZURE_OPENAI_ENDPOINT": stub_url,
+        "AZURE_OPENAI_API_KEY": "bench-key",
+        "AZURE_AI_VISION_ENDPOINT": stub_url,
+        "AZURE_AI_VISION_API_KEY": "bench-key",
+        "AZURE_AI_VISION_REGION": "bench",
+        "AZURE_SEARCH_SERVICE_ENDPOINT": stub_url,
+        "AZURE_SEARCH_INDEX_NAME": "bench-images",
+        "AZURE_SEARCH_ADMIN_KEY": "bench-key",
+        "INDEX_MANIFEST_PATH": os.path.join(workdir, "output", "index_manifest.json"),
+        "THUMBNAIL_DIR": os.path.join(workdir, "output", "thumbnails"),
+        "SESSION_STORE_PATH": os.path.join(workdir, "output", "sessions.sqlite"),
+    })
+    if not keep_caches:
+        # Measure the upstream path, not cache hits
+        env.update({"EMBEDDING_CACHE_PATH": "", "RETRIEVAL_CACHE_TTL": "0", "ANSWER_CACHE_TTL": "0"})
+    else:
+        env["EMBEDDING_CACHE_PATH"] = os.path.join(workdir, "output", "embeddings.sqlite")
+    return env
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_app(module, workdir, env, startup_timeout=60):
+    port = free_port()
+    launcher = (f"from {module} import app; "
+                f"app.run(host='127.0.0.1', port={port}, threaded=True, use_reloader=False)")
+    # The app logs every request to stderr; a file never fills up and block it the way an unread pipe would
+    log_path = os.path.join(workdir, f"{module}.log")
+    with open(log_path, "ab") as log:
+        process = subprocess.Popen([sys.executable, "-c", launcher], cwd=workdir, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=log)
+    deadline = time.monotonic() + startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            with open(log_path, "rb") as log:
+                output = log.read().decode(errors="replace")
+            raise RuntimeError(f"{module}.py exited during startup (log: {log_path}):\n{output[-4000:]}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return process, port
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"{module}.py did not start listening within {startup_timeout}s (log: {log_path})")
+
+
+def stop_app(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def rss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss / (1024 * 1024)
+    except Exception:
+        return None
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, pid, interval=0.2):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.is_set():
+            value = rss_mb(self.pid)
+            if value is not None:
+                self.samples.append(value)
+            self._done.wait(self.interval)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        if not self.samples:
+            return None
+        return {"start": round(self.samples[0], 1), "peak": round(max(self.samples), 1), "end": round(self.samples[-1], 1)}
+
+
+def multipart(field, filename, data):
+    boundary = uuid.uuid4().hex
+    body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"{field}\"; filename=\"{filename}\"\r\n"
+            f"Content-Type: image/png\r\n\r\n").encode("utf-8") + data + f"\r\n--{boundary}--\r\n".encode("utf-8")
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+def request_body(kind, i, args):
+    if kind == "question":
+        number = i % args.distinct_questions if args.distinct_questions else i
+        return json.dumps({"question": f"How do I deploy model {number} to an edge device?"}).encode("utf-8"), "application/json"
+    if kind == "image":
+        return multipart("image", f"query-{i}.png", png_bytes(10_000 + (i % args.images)))
+    return b"{}", "application/json"
+
+
+_local = threading.local()
+
+
+def send(port, method, path, body, content_type, timeout):
+    """One request on this thread's keep-alive connection; returns (status, latency_s, first_byte_s, size)."""
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "port", None) != port:
+        conn = _local.conn = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+        _local.port = port
+    start = time.perf_counter()
+    try:
+        conn.request(method, path, body, {"Content-Type": content_type})
+        response = conn.getresponse()
+        first = response.read(1)
+        first_byte = time.perf_counter() - start
+        size = len(first) + len(response.read())
+        if response.getheader("Connection", "").lower() == "close":
+            conn.close()
+            _local.conn = None
+        return response.status, time.perf_counter() - start, first_byte, size
+    except (http.client.HTTPException, OSError) as e:
+        conn.close()
+        _local.conn = None
+        return type(e).__name__, time.perf_counter() - start, None, 0
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def at(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 1)
+
+    return {"p50": at(0.50), "p95": at(0.95), "p99": at(0.99),
+            "mean": round(sum(values) / len(values) * 1000, 1), "max": round(values[-1] * 1000, 1)}
+
+
+def run_scenario(name, port, pid, args):
+    _, method, path, kind = SCENARIOS[name]
+    total = args.upload_requests if kind == "upload" else args.requests
+    concurrency = 1 if kind == "upload" else args.concurrency
+    bodies = [request_body(kind, i, args) for i in range(total + args.warmup)]
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(lambda b: send(port, method, path, b[0], b[1], args.timeout), bodies[:args.warmup]))
+        sampler = RssSampler(pid)
+        sampler.start()
+        start = time.perf_counter()
+        results = list(executor.map(lambda b: send(port, method, path, b[0], b[1], args.timeout), bodies[args.warmup:]))
+        elapsed = time.perf_counter() - start
+        rss = sampler.stop()
+
+    statuses = Counter(str(status) for status, _, _, _ in results)
+    ok = [result for result in results if result[0] == 200]
+    return {
+        "scenario": name,
+        "app": SCENARIOS[name][0] + ".py",
+        "endpoint": f"{method} {path}",
+        "concurrency": concurrency,
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "status_counts": dict(statuses),
+        "elapsed_s": round(elapsed, 3),
+        "rps": round(len(results) / elapsed, 2) if elapsed else None,
+        "latency_ms": percentiles([latency for _, latency, _, _ in ok]),
+        # First body byte: the first streamed token for /devedgesearch
+        "ttft_ms": percentiles([first for _, _, first, _ in ok if first is not None]),
+        "response_bytes_mean": round(sum(size for _, _, _, size in ok) / len(ok)) if ok else None,
+        "rss_mb": rss,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="Scenario to run; repeat for several (default: all)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=100, help="Measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=5, help="Unmeasured requests sent first")
+    parser.add_argument("--upload-requests", type=int, default=3, help="Measured /upload_images calls (run serially)")
+    parser.add_argument("--images", type=int, default=20, help="Images generated for upload and query")
+    parser.add_argument("--distinct-questions", type=int, default=0,
+                        help="Cycle through this many questions (0: every question is unique)")
+    parser.add_argument("--keep-caches", action="store_true", help="Leave the answer, retrieval and embedding caches on")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--output", default=os.path.join("output", f"bench-{time.strftime('%Y%m%d-%H%M%S')}.json"))
+    add_stub_arguments(parser)
+    args = parser.parse_args(argv)
+
+    stubs, stub_url = start_stub_server(stub_config(args))
+    workdir = prepare_workdir(stub_url, args.images)
+    env = app_environment(stub_url, workdir, args.keep_caches)
+
+    report = {"started": time.strftime("%Y-%m-%dT%H:%M:%S"), "settings": vars(args), "results": []}
+    scenarios = args.scenario or list(SCENARIOS)
+    try:
+        for module in dict.fromkeys(SCENARIOS[name][0] for name in scenarios):
+            try:
+                process, port = start_app(module, workdir, env)
+            except RuntimeError as e:
+                print(e, file=sys.stderr)
+                report["results"].append({"app": f"{module}.py", "error": str(e)})
+                continue
+            try:
+                for name in scenarios:
+                    if SCENARIOS[name][0] != module:
+                        continue
+                    result = run_scenario(name, port, process.pid, args)
+                    report["results"].append(result)
+                    latency = result["latency_ms"] or {}
+                    print(f"{name:20} {result['rps']:>8} rps  p50 {latency.get('p50')} ms  "
+                          f"p95 {latency.get('p95')} ms  p99 {latency.get('p99')} ms  errors {result['errors']}")
+            finally:
+                stop_app(process)
+    finally:
+        stubs.shutdown()
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""Local stand-ins for Azure AI Search, Azure OpenAI and Azure AI Vision.
+
+One threaded HTTP server answers the REST calls the apps make, with
+configurable injected latency, so api.py, wsgi.py and image.py can be
+load-tested without any Azure resources:
+
+    python -m bench.stubs --port 8900 --search-latency-ms 40 --tokens-per-second 60
+"""
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+VECTOR_DIMENSIONS = 1024
+WORDS = ("edge device model deploy inference module container update telemetry camera "
+         "gateway runtime latency network storage security policy sensor stream cloud").split()
+
+
+@dataclass
+class StubConfig:
+    search_latency_ms: float = 40
+    upload_latency_ms: float = 60
+    vision_latency_ms: float = 80
+    embedding_latency_ms: float = 30
+    first_token_ms: float = 300
+    tokens_per_second: float = 50
+    answer_tokens: int = 120
+    # Random extra latency as a fraction of the base latency
+    jitter: float = 0.2
+    documents: int = 50
+    seed: int = 7
+
+
+def _sleep(ms, jitter):
+    if ms > 0:
+        time.sleep(ms / 1000 * (1 + random.uniform(0, jitter)))
+
+
+def make_documents(count, seed):
+    rng = random.Random(seed)
+    documents = []
+    for i in range(count):
+        sentences = [" ".join(rng.choice(WORDS) for _ in range(12)).capitalize() + "." for _ in range(15)]
+        documents.append({
+            "id": f"doc-{i}",
+            "content": " ".join(sentences),
+            "category": "bench",
+            "sourcepage": f"manual-{i // 5}.pdf#page={i % 5 + 1}",
+            "description": f"image-{i}.png",
+        })
+    return documents
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = StubConfig()
+    documents = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = b""
+            while True:
+                size = int(self.rfile.readline().strip() or b"0", 16)
+                if not size:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def _json(self, payload, status=200):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if re.search(r"/docs/\$count", self.path):
+            _sleep(self.config.search_latency_ms, self.config.jitter)
+            data = str(len(self.documents)).encode("ascii")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        elif "/openai/models" in self.path:
+            self._json({"object": "list", "data": []})
+        else:
+            self._json({"error": {"message": f"No stub for GET {self.path}"}}, 404)
+
+    def do_POST(self):
+        body = self._body()
+        config = self.config
+        if "/docs/search.post.search" in self.path:
+            _sleep(config.search_latency_ms, config.jitter)
+            request = json.loads(body or b"{}")
+            top = request.get("top") or (request.get("vectorQueries") or [{}])[0].get("k") or 3
+            hits = random.sample(self.documents, min(top, len(self.documents)))
+            self._json({"value": [{"@search.score": 1.0 - i / 100, **doc} for i, doc in enumerate(hits)]})
+        elif "/docs/search.index" in self.path:
+            _sleep(config.upload_latency_ms, config.jitter)
+            actions = json.loads(body or b"{}").get("value", [])
+            self._json({"value": [
+                {"key": action.get("id"), "status": True, "errorMessage": None, "statusCode": 201}
+                for action in actions
+            ]})
+        elif "retrieval:vectorizeImage" in self.path:
+            _sleep(config.vision_latency_ms, config.jitter)
+            rng = random.Random(hash(body[:4096]))
+            self._json({"modelVersion": "2023-04-15", "vector": [rng.uniform(-1, 1) for _ in range(VECTOR_DIMENSIONS)]})
+        elif re.search(r"/openai/deployments/[^/]+/embeddings", self.path):
+            _sleep(config.embedding_latency_ms, config.jitter)
+            inputs = json.loads(body).get("input")
+            inputs = inputs if isinstance(inputs, list) else [inputs]
+            self._json({
+                "object": "list",
+                "data": [
+                    {"object": "embedding", "index": i, "embedding": [random.uniform(-1, 1) for _ in range(VECTOR_DIMENSIONS)]}
+                    for i in range(len(inputs))
+                ],
+                "model": "bench-embedding",
+                "usage": {"prompt_tokens": 8 * len(inputs), "total_tokens": 8 * len(inputs)},
+            })
+        elif re.search(r"/openai/deployments/[^/]+/chat/completions", self.path):
+            request = json.loads(body)
+            if request.get("stream"):
+                self._stream_completion(request)
+            else:
+                self._completion(request)
+        else:
+            self._json({"error": {"message": f"No stub for POST {self.path}"}}, 404)
+
+    def _tokens(self):
+        return [random.choice(WORDS) + " " for _ in range(self.config.answer_tokens)]
+
+    def _completion(self, request):
+        config = self.config
+        _sleep(config.first_token_ms, config.jitter)
+        tokens = self._tokens()
+        if config.tokens_per_second > 0:
+            time.sleep(len(tokens) / config.tokens_per_second)
+        self._json({
+            "id": "chatcmpl-bench",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "bench"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)},
+        })
+
+    def _stream_completion(self, request):
+        config = self.config
+        _sleep(config.first_token_ms, config.jitter)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        base = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()),
+                "model": request.get("model", "bench")}
+        delay = 1 / config.tokens_per_second if config.tokens_per_second > 0 else 0
+        for i, token in enumerate(self._tokens()):
+            if i and delay:
+                time.sleep(delay)
+            choice = {"index": 0, "delta": {"role": "assistant", "content": token}, "finish_reason": None}
+            self._chunk(f"data: {json.dumps({**base, 'choices': [choice]})}\n\n".encode("utf-8"))
+        done = {"index": 0, "delta": {}, "finish_reason": "stop"}
+        self._chunk(f"data: {json.dumps({**base, 'choices': [done]})}\n\n".encode("utf-8"))
+        self._chunk(b"data: [DONE]\n\n")
+        self._chunk(b"")
+
+
+def start_stub_server(config, host="127.0.0.1", port=0):
+    """Start the stubs on a daemon thread; returns (server, base_url)."""
+    handler = type("ConfiguredStubHandler", (StubHandler,), {
+        "config": config,
+        "documents": make_documents(config.documents, config.seed),
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="bench-stubs", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def add_stub_arguments(parser):
+    defaults = StubConfig()
+    parser.add_argument("--search-latency-ms", type=float, default=defaults.search_latency_ms)
+    parser.add_argument("--upload-latency-ms", type=float, default=defaults.upload_latency_ms)
+    parser.add_argument("--vision-latency-ms", type=float, default=defaults.vision_latency_ms)
+    parser.add_argument("--embedding-latency-ms", type=float, default=defaults.embedding_latency_ms)
+    parser.add_argument("--first-token-ms", type=float, default=defaults.first_token_ms)
+    parser.add_argument("--tokens-per-second", type=float, default=defaults.tokens_per_second)
+    parser.add_argument("--answer-tokens", type=int, default=defaults.answer_tokens)
+    parser.add_argument("--jitter", type=float, default=defaults.jitter)
+    parser.add_argument("--documents", type=int, default=defaults.documents)
+
+
+def stub_config(args):
+    return StubConfig(
+        search_latency_ms=args.search_latency_ms,
+        upload_latency_ms=args.upload_latency_ms,
+        vision_latency_ms=args.vision_latency_ms,
+        embedding_latency_ms=args.embedding_latency_ms,
+        first_token_ms=args.first_token_ms,
+        tokens_per_second=args.tokens_per_second,
+        answer_tokens=args.answer_tokens,
+        jitter=args.jitter,
+        documents=args.documents,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8900)
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+    server, url = start_stub_server(stub_config(args), port=args.port)
+    print(f"Stubs listening on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
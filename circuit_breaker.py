@@ -0,0 +1,152 @@
+import os
+import math
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from metrics import register_collector
+
+# Consecutive upstream failures that open a circuit
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", "5"))
+# Seconds an open circuit rejects calls before letting a probe through
+BREAKER_RESET_SECONDS = float(os.environ.get("BREAKER_RESET_SECONDS", "30"))
+# Calls let through at once while half-open; their outcome closes or re-opens the circuit
+BREAKER_HALF_OPEN_PROBES = int(os.environ.get("BREAKER_HALF_OPEN_PROBES", "1"))
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpen(Exception):
+    """The upstream's circuit is open; the call was rejected without being made."""
+
+    def __init__(self, name, retry_after):
+        self.name = name
+        self.retry_after = max(1, math.ceil(retry_after))
+        super().__init__(f"{name} is unavailable, retry after {self.retry_after}s")
+
+
+class CircuitBreaker:
+    """Closed / open / half-open circuit breaker for one upstream.
+
+    `failure_threshold` consecutive failures open the circuit: calls are then
+    rejected with CircuitOpen for `reset_timeout` seconds. After that up to
+    `half_open_probes` calls are let through; a success closes the circuit, a
+    failure re-opens it. `is_failure(e)` decides which exceptions count
+    against the upstream (e.g. timeouts and 5xx, not a 400 for a bad query);
+    when it returns None (e.g. the caller's own deadline ran out) the outcome
+    says nothing about the upstream and leaves the state alone. Any other
+    outcome counts as a success.
+    """
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_SECONDS,
+                 half_open_probes=BREAKER_HALF_OPEN_PROBES, is_failure=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+        self.is_failure = is_failure or (lambda e: isinstance(e, Exception))
+        self.state = CLOSED
+        self.stats = {"opened": 0, "rejected": 0}
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._probe_started = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Raise CircuitOpen unless a call may go to the upstream now."""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == OPEN:
+                wait = self._opened_at + self.reset_timeout - now
+                if wait > 0:
+                    self.stats["rejected"] += 1
+                    raise CircuitOpen(self.name, wait)
+                self.state, self._probes = HALF_OPEN, 0
+            if self.state == HALF_OPEN:
+                # A probe that never reported back (e.g. an abandoned stream) stops blocking after reset_timeout
+                if self._probes >= self.half_open_probes and now - self._probe_started < self.reset_timeout:
+                    self.stats["rejected"] += 1
+                    raise CircuitOpen(self.name, self.reset_timeout)
+                if self._probes >= self.half_open_probes:
+                    self._probes = 0
+                self._probes += 1
+                self._probe_started = now
+
+    def release(self):
+        """Give back a half-open probe slot when the allowed call was never made."""
+        with self._lock:
+            if self.state == HALF_OPEN and self._probes:
+                self._probes -= 1
+
+    def record(self, error=None):
+        """Report the outcome of an allowed call: `error` is the exception it raised, if any."""
+        failed = error is not None and self.is_failure(error)
+        if failed is None:
+            self.release()
+            return
+        with self._lock:
+            if not failed:
+                self._failures = 0
+                if self.state != CLOSED:
+                    logging.info(f"Circuit {self.name} closed")
+                    self.state = CLOSED
+                return
+            self._failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self._failures >= self.failure_threshold):
+                logging.warning(f"Circuit {self.name} opened after {self._failures} failures: {error}")
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+                self.stats["opened"] += 1
+
+    @contextmanager
+    def track(self):
+        """Record the outcome of the enclosed, already allowed, call."""
+        try:
+            yield
+        except BaseException as e:
+            self.record(e)
+            raise
+        self.record()
+
+    def call(self, fn, *args, **kwargs):
+        self.allow()
+        with self.track():
+            return fn(*args, **kwargs)
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.stats, "state": self.state, "consecutive_failures": self._failures}
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name, **kwargs):
+    """Return the process-wide breaker for an upstream, creating it on first use."""
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(name, **kwargs)
+        return breaker
+
+
+def collect():
+    """Exposition lines for /metrics: state (0 closed, 1 half-open, 2 open) and counters per upstream."""
+    with _breakers_lock:
+        snapshots = sorted((name, breaker.snapshot()) for name, breaker in _breakers.items())
+    lines = ["# HELP upstream_circuit_state Circuit state per upstream: 0 closed, 1 half-open, 2 open.",
+             "# TYPE upstream_circuit_state gauge"]
+    lines += [f'upstream_circuit_state{{upstream="{name}"}} {_STATE_VALUES[s["state"]]}' for name, s in snapshots]
+    lines += ["# HELP upstream_circuit_opened_total Times each circuit opened.",
+              "# TYPE upstream_circuit_opened_total counter"]
+    lines += [f'upstream_circuit_opened_total{{upstream="{name}"}} {s["opened"]}' for name, s in snapshots]
+    lines += ["# HELP upstream_circuit_rejected_total Calls rejected while a circuit was open.",
+              "# TYPE upstream_circuit_rejected_total counter"]
+    lines += [f'upstream_circuit_rejected_total{{upstream="{name}"}} {s["rejected"]}' for name, s in snapshots]
+    return lines
+
+
+register_collector(collect)
@@ -0,0 +1,138 @@
+import os
+import logging
+import threading
+import requests
+import httpx
+import openai
+from requests.adapters import HTTPAdapter
+from openai import AzureOpenAI
+from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+from azure.core.pipeline.transport import RequestsTransport
+from azure.search.documents import SearchClient
+from deadline import DeadlineExceeded
+
+# Connection pool sizing; match SEARCH_POOL_MAXSIZE to the worker's thread count
+SEARCH_POOL_CONNECTIONS = int(os.environ.get("SEARCH_POOL_CONNECTIONS", "10"))
+SEARCH_POOL_MAXSIZE = int(os.environ.get("SEARCH_POOL_MAXSIZE", "32"))
+SEARCH_CONNECTION_TIMEOUT = float(os.environ.get("SEARCH_CONNECTION_TIMEOUT", "5"))
+SEARCH_READ_TIMEOUT = float(os.environ.get("SEARCH_READ_TIMEOUT", "30"))
+OPENAI_MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE = int(os.environ.get("OPENAI_MAX_KEEPALIVE", "32"))
+KEEPALIVE_EXPIRY = float(os.environ.get("KEEPALIVE_EXPIRY", "60"))
+OPENAI_API_VERSION = os.environ.get("AZURE_OPENAI_API_VERSION", "2024-02-01")
+# Search failures worth another attempt
+TRANSIENT_SEARCH_STATUS = (429, 500, 502, 503, 504)
+
+_lock = threading.Lock()
+_search_clients = {}
+_openai_clients = {}
+_session = None
+
+
+def _search_session():
+    # One pooled requests session shared by every SearchClient in the worker
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=SEARCH_POOL_CONNECTIONS, pool_maxsize=SEARCH_POOL_MAXSIZE)
+        _session.mount("https://", adapter)
+        _session.mount("http://", adapter)
+    return _session
+
+
+def get_search_client(endpoint, index_name, key):
+    """Return the worker's shared SearchClient for an index, creating it on first use."""
+    with _lock:
+        client = _search_clients.get((endpoint, index_name, key))
+        if client is None:
+            transport = RequestsTransport(
+                session=_search_session(),
+                session_owner=False,
+                connection_timeout=SEARCH_CONNECTION_TIMEOUT,
+                read_timeout=SEARCH_READ_TIMEOUT,
+            )
+            client = SearchClient(endpoint=endpoint, index_name=index_name,
+                                  credential=AzureKeyCredential(key), transport=transport)
+            _search_clients[(endpoint, index_name, key)] = client
+        return client
+
+
+def search_options(timeout):
+    """Per-call SearchClient options bounding one attempt to `timeout` seconds.
+
+    The SDK's own retries are turned off so `deadline.call_upstream` decides
+    whether another attempt fits in the request's deadline.
+    """
+    if timeout is None:
+        return {}
+    return {
+        "retry_total": 0,
+        "connection_timeout": min(SEARCH_CONNECTION_TIMEOUT, timeout),
+        "read_timeout": timeout,
+    }
+
+
+def is_transient_search_error(e):
+    if isinstance(e, HttpResponseError):
+        return e.status_code in TRANSIENT_SEARCH_STATUS
+    return isinstance(e, (ServiceRequestError, ServiceResponseError))
+
+
+def is_search_outage(e):
+    """Failures that count against a search index's circuit breaker; None for the caller's own deadline."""
+    if isinstance(e, DeadlineExceeded):
+        return None
+    return is_transient_search_error(e) or isinstance(e, TimeoutError)
+
+
+def is_openai_outage(e):
+    """Failures that count against the OpenAI circuit breaker; bad requests and auth errors don't.
+
+    None for the caller's own deadline running out, which says nothing about OpenAI.
+    """
+    if isinstance(e, DeadlineExceeded):
+        return None
+    return isinstance(e, (openai.APIConnectionError, openai.InternalServerError, openai.RateLimitError, TimeoutError))
+
+
+def get_openai_client(endpoint=None, api_key=None, api_version=OPENAI_API_VERSION):
+    """Return the worker's shared AzureOpenAI client backed by a keep-alive httpx pool."""
+    endpoint = endpoint or os.environ.get("AZURE_OPENAI_ENDPOINT")
+    api_key = api_key or os.environ.get("AZURE_OPENAI_API_KEY")
+    with _lock:
+        client = _openai_clients.get((endpoint, api_key, api_version))
+        if client is None:
+            http_client = httpx.Client(limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+            ))
+            client = AzureOpenAI(azure_endpoint=endpoint, api_key=api_key,
+                                 api_version=api_version, http_client=http_client)
+            _openai_clients[(endpoint, api_key, api_version)] = client
+        return client
+
+
+def warm_up(search_clients=(), openai_client=None):
+    """Open pooled connections ahead of the first request so it doesn't pay TLS setup.
+
+    Failures are logged, never raised: a cold connection is still usable.
+    """
+    for search_client in search_clients:
+        try:
+            search_client.get_document_count()
+        except Exception as e:
+            logging.error(f"Search warm-up failed: {e}")
+    if openai_client is not None:
+        try:
+            openai_client.models.list()
+        except Exception as e:
+            logging.error(f"OpenAI warm-up failed: {e}")
+
+
+def warm_up_in_background(search_clients=(), openai_client=None):
+    """Run `warm_up` on a daemon thread at startup unless WARM_UP_CLIENTS=false."""
+    if os.environ.get("WARM_UP_CLIENTS", "true").lower() != "true":
+        return
+    threading.Thread(target=warm_up, args=(search_clients, openai_client), name="warm-up", daemon=True).start()
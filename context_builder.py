@@ -0,0 +1,131 @@
+import os
+import re
+import math
+from collections import Counter
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except ImportError:
+    _encoding = None
+
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "1500"))
+CONTEXT_CHUNK_TOKENS = int(os.environ.get("CONTEXT_CHUNK_TOKENS", "200"))
+# Jaccard similarity of word shingles above which two chunks count as duplicates
+CONTEXT_DEDUPE_THRESHOLD = float(os.environ.get("CONTEXT_DEDUPE_THRESHOLD", "0.8"))
+COMPLETION_MAX_TOKENS = int(os.environ.get("COMPLETION_MAX_TOKENS", "1000"))
+
+_WORD = re.compile(r"\w+")
+_SENTENCE = re.compile(r"(?<=[.!?])\s+")
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have how i in is it of on or that the this to was what when where which who why with".split()
+)
+
+
+def count_tokens(text):
+    """Token count with tiktoken when installed, else a ~4 characters per token estimate."""
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return max(1, len(text) // 4)
+
+
+def _terms(text):
+    return [word for word in _WORD.findall(text.lower()) if word not in STOPWORDS]
+
+
+def _sentences(text, max_tokens):
+    for sentence in _SENTENCE.split(text.replace("\r", " ").replace("\n", " ")):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        tokens = count_tokens(sentence)
+        if tokens <= max_tokens:
+            yield sentence, tokens
+            continue
+        # Run-on text (tables, lists without punctuation) is cut into word windows instead
+        words = sentence.split()
+        step = max(1, len(words) * max_tokens // tokens)
+        for start in range(0, len(words), step):
+            piece = " ".join(words[start:start + step])
+            yield piece, count_tokens(piece)
+
+
+def chunk_text(text, max_tokens=CONTEXT_CHUNK_TOKENS):
+    """Split text into sentence-aligned chunks of at most roughly `max_tokens` tokens."""
+    chunks, current, current_tokens = [], [], 0
+    for sentence, tokens in _sentences(text, max_tokens):
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append(" ".join(current))
+            current, current_tokens = [], 0
+        current.append(sentence)
+        current_tokens += tokens
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+
+def _shingles(text, size=3):
+    words = _WORD.findall(text.lower())
+    return {tuple(words[i:i + size]) for i in range(max(1, len(words) - size + 1))}
+
+
+def score_passages(question, texts):
+    """BM25 score of each text against the question, computed over `texts` alone.
+
+    Cheap and good enough to rank a few dozen retrieved passages.
+    """
+    query_terms = set(_terms(question))
+    passage_terms = [Counter(_terms(text)) for text in texts]
+    count = len(texts)
+    if not count:
+        return []
+    average_length = sum(sum(terms.values()) for terms in passage_terms) / count or 1
+    document_frequency = Counter(term for terms in passage_terms for term in terms if term in query_terms)
+
+    scores = []
+    for terms in passage_terms:
+        length = sum(terms.values())
+        score = 0.0
+        for term in query_terms:
+            frequency = terms.get(term)
+            if not frequency:
+                continue
+            idf = math.log(1 + (count - document_frequency[term] + 0.5) / (document_frequency[term] + 0.5))
+            score += idf * frequency * 2.2 / (frequency + 1.2 * (0.25 + 0.75 * length / average_length))
+        scores.append(score)
+    return scores
+
+
+def build_context(question, documents, source_field, content_field, budget=CONTEXT_TOKEN_BUDGET,
+                  chunk_tokens=CONTEXT_CHUNK_TOKENS, dedupe_threshold=CONTEXT_DEDUPE_THRESHOLD):
+    """Assemble the RAG context for `question` within `budget` tokens.
+
+    Documents are chunked, chunks are ranked against the question, near
+    duplicates are dropped and the best chunks are packed until the budget is
+    spent. Lines keep the "<sourcepage>: <text>" shape that create_prompt
+    expects, with chunks of the same source grouped in their original order.
+    """
+    chunks = []
+    for rank, doc in enumerate(documents):
+        for position, text in enumerate(chunk_text(doc[content_field], chunk_tokens)):
+            chunks.append({"source": doc[source_field], "text": text, "rank": rank, "position": position})
+    if not chunks:
+        return ""
+    for chunk, score in zip(chunks, score_passages(question, [chunk["text"] for chunk in chunks])):
+        # Small bonus for the search engine's own ranking so ties keep the retrieval order
+        chunk["score"] = score + 0.01 / (1 + chunk["rank"])
+
+    selected, selected_shingles, used = [], [], 0
+    for chunk in sorted(chunks, key=lambda chunk: chunk["score"], reverse=True):
+        line_tokens = count_tokens(f"{chunk['source']}: {chunk['text']}")
+        if used + line_tokens > budget:
+            continue
+        shingles = _shingles(chunk["text"])
+        if any(len(shingles & other) / len(shingles | other) >= dedupe_threshold for other in selected_shingles):
+            continue
+        selected.append(chunk)
+        selected_shingles.append(shingles)
+        used += line_tokens
+
+    selected.sort(key=lambda chunk: (chunk["rank"], chunk["position"]))
+    return "\n".join(f"{chunk['source']}: {chunk['text']}" for chunk in selected)
@@ -0,0 +1,138 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from context_builder import count_tokens
+
+SUMMARY_MAX_TOKENS = int(os.environ.get("SUMMARY_MAX_TOKENS", "300"))
+SUMMARY_MAX_WORKERS = int(os.environ.get("SUMMARY_MAX_WORKERS", "2"))
+# Summaries kept in memory; older ones survive only where the caller persists them
+SUMMARY_MAX_SESSIONS = int(os.environ.get("SUMMARY_MAX_SESSIONS", "10000"))
+
+
+def summary_prompt(summary, turns, max_tokens=SUMMARY_MAX_TOKENS):
+    """Prompt asking the model to fold `turns` into the running `summary`."""
+    lines = [
+        f"Update the summary of a conversation between a user and an assistant. Keep names, numbers, "
+        f"preferences and open questions. Reply with the new summary only, in at most {max_tokens} tokens.",
+        "",
+        f"Current summary: {summary or '(none)'}",
+        "",
+        "New lines of conversation:",
+    ]
+    for user, assistant in turns:
+        lines.append(f"User: {user}")
+        lines.append(f"Assistant: {assistant}")
+    return "\n".join(lines)
+
+
+class _State:
+    __slots__ = ("summary", "pending", "running", "idle")
+
+    def __init__(self, summary=""):
+        self.summary = summary
+        self.pending = []
+        self.running = False
+        self.idle = threading.Event()
+        self.idle.set()
+
+
+class RollingSummarizer:
+    """Fold turns evicted from a bounded chat memory into a per-session summary.
+
+    `add(key, turns)` returns immediately; a background worker calls
+    `summarize(prompt)` (any LLM call returning text) with the previous
+    summary and the new turns. Turns evicted while a summary is being written
+    are batched into the next call, and updates for one session are applied
+    in order. Callers put `summary(key)` in front of the recent turns, so the
+    prompt stays roughly constant: the window plus one bounded summary.
+    """
+
+    def __init__(self, summarize, max_tokens=SUMMARY_MAX_TOKENS, max_workers=SUMMARY_MAX_WORKERS,
+                 max_sessions=SUMMARY_MAX_SESSIONS):
+        self.summarize = summarize
+        self.max_tokens = max_tokens
+        self.max_sessions = max_sessions
+        self.stats = {"updates": 0, "turns": 0, "errors": 0}
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="summarize")
+
+    def _state(self, key):
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = _State()
+            # Drop the least recently used idle sessions beyond the cap
+            for old_key in list(self._states):
+                if len(self._states) <= self.max_sessions:
+                    break
+                if old_key != key and not self._states[old_key].running:
+                    del self._states[old_key]
+        self._states.move_to_end(key)
+        return state
+
+    def summary(self, key):
+        with self._lock:
+            state = self._states.get(key)
+            return state.summary if state is not None else ""
+
+    def load(self, key, summary):
+        """Seed a session's summary from storage unless a newer one is already held."""
+        if not summary:
+            return
+        with self._lock:
+            state = self._state(key)
+            if not state.summary and not state.running:
+                state.summary = summary
+
+    def add(self, key, turns):
+        """Queue evicted (user, assistant) turns to be folded into the session's summary."""
+        if not turns:
+            return
+        with self._lock:
+            state = self._state(key)
+            state.pending.extend(turns)
+            if state.running:
+                return
+            state.running = True
+            state.idle.clear()
+        self._executor.submit(self._run, key, state)
+
+    def _run(self, key, state):
+        while True:
+            with self._lock:
+                turns, state.pending = state.pending, []
+                if not turns:
+                    state.running = False
+                    state.idle.set()
+                    return
+                summary = state.summary
+            try:
+                updated = str(self.summarize(summary_prompt(summary, turns, self.max_tokens))).strip()
+                if count_tokens(updated) > self.max_tokens * 2:
+                    # The model ignored the length limit; keep the prompt bounded anyway
+                    updated = updated[:self.max_tokens * 8]
+            except Exception as e:
+                logging.error(f"Summarizing {len(turns)} turns for session {key} failed: {e}")
+                with self._lock:
+                    self.stats["errors"] += 1
+                continue
+            with self._lock:
+                state.summary = updated
+                self.stats["updates"] += 1
+                self.stats["turns"] += len(turns)
+
+    def wait(self, key, timeout=None):
+        """Block until pending turns for `key` are summarized; returns False on timeout."""
+        with self._lock:
+            state = self._states.get(key)
+        return state is None or state.idle.wait(timeout)
+
+    def forget(self, key):
+        with self._lock:
+            self._states.pop(key, None)
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.stats, "sessions": len(self._states)}
@@ -0,0 +1,312 @@
+import os
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from flask import request
+from metrics import Counter, register_collector
+from circuit_breaker import OPEN
+
+# Time budget of one request across all its upstream calls; clients may ask for less with X-Request-Timeout
+REQUEST_DEADLINE_SECONDS = float(os.environ.get("REQUEST_DEADLINE_SECONDS", "10"))
+# Floor for X-Request-Timeout, so a client can't ask for a budget no upstream call can meet
+REQUEST_DEADLINE_MIN_SECONDS = float(os.environ.get("REQUEST_DEADLINE_MIN_SECONDS", "0.5"))
+# Attempts per upstream call, including the first
+UPSTREAM_MAX_ATTEMPTS = int(os.environ.get("UPSTREAM_MAX_ATTEMPTS", "4"))
+# Full-jitter exponential backoff between attempts: uniform(0, min(max, base * 2**attempt))
+RETRY_BASE_DELAY_MS = float(os.environ.get("RETRY_BASE_DELAY_MS", "100"))
+RETRY_MAX_DELAY_MS = float(os.environ.get("RETRY_MAX_DELAY_MS", "2000"))
+# A hedged duplicate is sent once an attempt runs past this latency percentile of recent calls
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", "0.95"))
+# Hedge delay until enough latencies have been seen, and a floor so fast calls aren't doubled
+HEDGE_DEFAULT_DELAY_MS = float(os.environ.get("HEDGE_DEFAULT_DELAY_MS", "500"))
+HEDGE_MIN_DELAY_MS = float(os.environ.get("HEDGE_MIN_DELAY_MS", "20"))
+HEDGE_MIN_SAMPLES = int(os.environ.get("HEDGE_MIN_SAMPLES", "20"))
+# Hedges per call name are capped at this fraction of calls, with at most HEDGE_BURST saved up
+HEDGE_MAX_RATIO = float(os.environ.get("HEDGE_MAX_RATIO", "0.05"))
+HEDGE_BURST = float(os.environ.get("HEDGE_BURST", "5"))
+LATENCY_WINDOW = int(os.environ.get("LATENCY_WINDOW", "500"))
+UPSTREAM_MAX_WORKERS = int(os.environ.get("UPSTREAM_MAX_WORKERS", "32"))
+
+_current = ContextVar("request_deadline", default=None)
+_executor = ThreadPoolExecutor(max_workers=UPSTREAM_MAX_WORKERS, thread_name_prefix="upstream")
+# Attempts queued or running on _executor; hedging only uses the pool while it has idle workers
+_pool_busy = 0
+_pool_lock = threading.Lock()
+
+upstream_hedges = Counter("upstream_hedges_total", "Hedged duplicate requests sent.", "call")
+upstream_retries = Counter("upstream_retries_total", "Upstream attempts retried after a failure.", "call")
+register_collector(upstream_hedges.render)
+register_collector(upstream_retries.render)
+
+
+class DeadlineExceeded(TimeoutError):
+    """The request's time budget ran out before the upstream call finished."""
+
+
+class Deadline:
+    """Absolute point in time (monotonic) by which a request must be answered."""
+
+    def __init__(self, seconds):
+        self.at = time.monotonic() + seconds
+
+    def remaining(self):
+        return self.at - time.monotonic()
+
+    def timeout(self, cap=None):
+        """Seconds left, at most `cap`; raises DeadlineExceeded when none are left."""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded("Request deadline exceeded")
+        return remaining if cap is None else min(cap, remaining)
+
+
+def current_deadline():
+    """The Deadline of the request being handled on this thread, or None outside a request."""
+    return _current.get()
+
+
+def register_deadline(app, seconds=REQUEST_DEADLINE_SECONDS, min_seconds=REQUEST_DEADLINE_MIN_SECONDS):
+    """Give every request of a Flask app a Deadline, shortened by an `X-Request-Timeout: <seconds>` header.
+
+    The header can only shorten the budget down to `min_seconds`; values that
+    are not positive numbers are ignored. Work handed to other threads does
+    not see the context variable; read `current_deadline()` on the request
+    thread and pass it along.
+    """
+
+    @app.before_request
+    def start_deadline():
+        _current.set(Deadline(_budget(request.headers.get("X-Request-Timeout"), seconds, min_seconds)))
+
+
+def register_async_deadline(app, seconds=REQUEST_DEADLINE_SECONDS, min_seconds=REQUEST_DEADLINE_MIN_SECONDS):
+    """`register_deadline` for a Quart app; the hook is a coroutine so the view's task sees the Deadline."""
+    from quart import request as quart_request
+
+    @app.before_request
+    async def start_deadline():
+        _current.set(Deadline(_budget(quart_request.headers.get("X-Request-Timeout"), seconds, min_seconds)))
+
+
+def _budget(header, seconds, min_seconds):
+    try:
+        requested = float(header) if header is not None else seconds
+    except ValueError:
+        requested = seconds
+    # NaN fails this comparison too
+    if requested > 0:
+        return min(seconds, max(requested, min_seconds))
+    return seconds
+
+
+class LatencyTracker:
+    """Recent successful latencies per call name, for picking hedge delays."""
+
+    def __init__(self, window=LATENCY_WINDOW, min_samples=HEDGE_MIN_SAMPLES):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds):
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None:
+                samples = self._samples[name] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def percentile(self, name, q):
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None or len(samples) < self.min_samples:
+                return None
+            ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+latencies = LatencyTracker()
+
+
+class HedgeBudget:
+    """Token bucket per call name: every call earns `ratio` of a hedge and a hedge spends one."""
+
+    def __init__(self, ratio=HEDGE_MAX_RATIO, burst=HEDGE_BURST):
+        self.ratio = ratio
+        self.burst = burst
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def earn(self, name):
+        with self._lock:
+            self._tokens[name] = min(self.burst, self._tokens.get(name, 0.0) + self.ratio)
+
+    def available(self, name):
+        with self._lock:
+            return self._tokens.get(name, 0.0) >= 1
+
+    def spend(self, name):
+        with self._lock:
+            if self._tokens.get(name, 0.0) < 1:
+                return False
+            self._tokens[name] -= 1
+            return True
+
+
+hedge_budget = HedgeBudget()
+
+
+def backoff_delay(attempt, base=RETRY_BASE_DELAY_MS / 1000, cap=RETRY_MAX_DELAY_MS / 1000):
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def _attempt(name, fn, deadline, started=None):
+    if started is not None:
+        started.set()
+    start = time.perf_counter()
+    result = fn(deadline.timeout() if deadline is not None else None)
+    latencies.observe(name, time.perf_counter() - start)
+    return result
+
+
+def _reserve_workers(count):
+    global _pool_busy
+    with _pool_lock:
+        if _pool_busy + count > UPSTREAM_MAX_WORKERS:
+            return False
+        _pool_busy += count
+        return True
+
+
+def _release_worker(future=None):
+    global _pool_busy
+    with _pool_lock:
+        _pool_busy -= 1
+
+
+def _submit(name, fn, deadline, started=None):
+    """Run an attempt on a worker reserved with _reserve_workers, freeing it when the attempt ends."""
+    future = _executor.submit(_attempt, name, fn, deadline, started)
+    future.add_done_callback(_release_worker)
+    return future
+
+
+def _hedged(name, fn, deadline):
+    hedge_budget.earn(name)
+    # Both attempts need an idle worker up front; without a hedge to spend, or with a backlog where
+    # queueing would only add delay and a hedge would add load, the attempt runs on the caller's thread
+    if not hedge_budget.available(name) or not _reserve_workers(2):
+        return _attempt(name, fn, deadline)
+    hedge_slot = True
+    try:
+        started = threading.Event()
+        futures = [_submit(name, fn, deadline, started)]
+        delay = latencies.percentile(name, HEDGE_PERCENTILE)
+        delay = max(HEDGE_MIN_DELAY_MS / 1000, HEDGE_DEFAULT_DELAY_MS / 1000 if delay is None else delay)
+        # The delay counts from when the first attempt starts running, not from when it was queued
+        started.wait(deadline.timeout())
+        done, _ = wait(futures, timeout=deadline.timeout(delay))
+        if not done and hedge_budget.spend(name):
+            upstream_hedges.inc(name)
+            hedge_slot = False
+            futures.append(_submit(name, fn, deadline))
+    finally:
+        if hedge_slot:
+            _release_worker()
+
+    # First success wins; the loser finishes in the background and its result is dropped
+    pending, error = set(futures), None
+    while pending:
+        done, pending = wait(pending, timeout=max(deadline.remaining(), 0), return_when=FIRST_COMPLETED)
+        if not done:
+            raise DeadlineExceeded(f"{name} did not finish before the request deadline")
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+def call_upstream(name, fn, deadline=None, hedge=False, retryable=None, max_attempts=UPSTREAM_MAX_ATTEMPTS,
+                  breaker=None):
+    """Call `fn(timeout)` against a request deadline, with hedging and jittered retries.
+
+    `timeout` is the seconds left before `deadline` (None without one), to be
+    used as the call's own timeout. With `hedge=True` (idempotent calls only)
+    and a deadline, a duplicate attempt is started once the first runs past
+    the HEDGE_PERCENTILE latency of recent `name` calls and the first to
+    succeed is returned; hedges are capped at HEDGE_MAX_RATIO of calls and
+    skipped, with the attempt made on the caller's thread, while the upstream
+    pool has no idle workers. Failures for which `retryable(e)` is true (any, when
+    None) are retried after a full-jitter exponential backoff, or the
+    exception's `retry_after` seconds if longer, unless that would overrun the
+    deadline. The deadline defaults to the current request's. With a
+    CircuitBreaker, the call fails fast with CircuitOpen while the circuit is
+    open, and its final outcome (after retries) is recorded on the breaker.
+    """
+    deadline = deadline if deadline is not None else current_deadline()
+    if breaker is None:
+        return _retrying(name, fn, deadline, hedge, retryable, max_attempts, None)
+    breaker.allow()
+    with breaker.track():
+        return _retrying(name, fn, deadline, hedge, retryable, max_attempts, breaker)
+
+
+async def acall_upstream(name, fn, deadline=None, retryable=None, max_attempts=UPSTREAM_MAX_ATTEMPTS, breaker=None):
+    """Async `call_upstream` for the ASGI app: `await fn(timeout)` with the same deadline,
+    jittered retries and breaker; attempts are not hedged."""
+    deadline = deadline if deadline is not None else current_deadline()
+    if breaker is None:
+        return await _aretrying(name, fn, deadline, retryable, max_attempts, None)
+    breaker.allow()
+    with breaker.track():
+        return await _aretrying(name, fn, deadline, retryable, max_attempts, breaker)
+
+
+async def _aretrying(name, fn, deadline, retryable, max_attempts, breaker):
+    for attempt in range(max_attempts):
+        try:
+            start = time.perf_counter()
+            result = await fn(deadline.timeout() if deadline is not None else None)
+            latencies.observe(name, time.perf_counter() - start)
+            return result
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            delay = _retry_delay(e, attempt, deadline, retryable, max_attempts, breaker)
+            if delay is None:
+                raise
+            upstream_retries.inc(name)
+            await asyncio.sleep(delay)
+
+
+def _retry_delay(e, attempt, deadline, retryable, max_attempts, breaker):
+    """Seconds to back off before retrying after `e`, or None when it should be raised."""
+    if attempt + 1 >= max_attempts or (retryable is not None and not retryable(e)):
+        return None
+    # Other calls have opened the circuit meanwhile: stop adding load to the outage
+    if breaker is not None and breaker.state == OPEN:
+        return None
+    delay = max(backoff_delay(attempt), getattr(e, "retry_after", None) or 0)
+    if deadline is not None and delay >= deadline.remaining():
+        return None
+    return delay
+
+
+def _retrying(name, fn, deadline, hedge, retryable, max_attempts, breaker):
+    for attempt in range(max_attempts):
+        try:
+            if hedge and deadline is not None:
+                return _hedged(name, fn, deadline)
+            return _attempt(name, fn, deadline)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            delay = _retry_delay(e, attempt, deadline, retryable, max_attempts, breaker)
+            if delay is None:
+                raise
+            upstream_retries.inc(name)
+            time.sleep(delay)
@@ -0,0 +1,72 @@
+import os
+import array
+import sqlite3
+import hashlib
+import threading
+
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH", "output/embeddings.sqlite")
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class EmbeddingCache:
+    """Persistent image embedding cache keyed by content hash and model version.
+
+    Vectors are stored as packed float32 blobs in SQLite, so a re-run of the
+    ingestion only calls the Vision API for images whose bytes have changed.
+    """
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH):
+        self.path = path
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " content_hash TEXT NOT NULL,"
+            " model_version TEXT NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " PRIMARY KEY (content_hash, model_version))"
+        )
+        self._conn.commit()
+
+    def get(self, digest, model_version):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT vector FROM embeddings WHERE content_hash = ? AND model_version = ?",
+                (digest, model_version),
+            ).fetchone()
+        if row is None:
+            return None
+        return array.array("f", row[0]).tolist()
+
+    def put(self, digest, model_version, vector):
+        blob = array.array("f", vector).tobytes()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO embeddings (content_hash, model_version, vector) VALUES (?, ?, ?)",
+                (digest, model_version, blob),
+            )
+            self._conn.commit()
+
+    def items(self, model_version):
+        """Yield (content_hash, vector) for every cached embedding of a model version."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT content_hash, vector FROM embeddings WHERE model_version = ?",
+                (model_version,),
+            ).fetchall()
+        for digest, blob in rows:
+            yield digest, array.array("f", blob).tolist()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,85 @@
+import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from context_builder import score_passages
+
+# Vector field of the text index holding question-comparable embeddings; unset disables hybrid retrieval
+HYBRID_VECTOR_FIELD = os.environ.get("HYBRID_VECTOR_FIELD")
+# Candidates fetched from each retriever before fusion
+HYBRID_CANDIDATES = int(os.environ.get("HYBRID_CANDIDATES", "20"))
+# Constant of reciprocal rank fusion: higher values flatten the advantage of top ranks
+RRF_K = int(os.environ.get("RRF_K", "60"))
+# Fused candidates passed to the re-rank stage; 0 disables re-ranking
+HYBRID_RERANK_TOP = int(os.environ.get("HYBRID_RERANK_TOP", "0"))
+# Re-ranked documents scoring below this are dropped
+HYBRID_RERANK_MIN_SCORE = float(os.environ.get("HYBRID_RERANK_MIN_SCORE", "0"))
+HYBRID_MAX_WORKERS = int(os.environ.get("HYBRID_MAX_WORKERS", "16"))
+
+_executor = ThreadPoolExecutor(max_workers=HYBRID_MAX_WORKERS, thread_name_prefix="hybrid")
+
+
+def _timed(timings, stage, fn, *args):
+    start = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        timings[stage] = round((time.perf_counter() - start) * 1000, 2)
+
+
+def reciprocal_rank_fusion(result_lists, key, k=RRF_K):
+    """Fuse ranked lists of documents: each document scores sum(1 / (k + rank)).
+
+    Documents are matched across lists by `key(doc)`; the first list a
+    document appears in supplies its fields. Returns documents best first,
+    each carrying its fused score under "@rrf_score".
+    """
+    fused = {}
+    for results in result_lists:
+        for rank, doc in enumerate(results, start=1):
+            doc_key = key(doc)
+            entry = fused.get(doc_key)
+            if entry is None:
+                entry = fused[doc_key] = {**doc, "@rrf_score": 0.0}
+            entry["@rrf_score"] += 1.0 / (k + rank)
+    return sorted(fused.values(), key=lambda doc: doc["@rrf_score"], reverse=True)
+
+
+def rerank(question, documents, content_field, top=HYBRID_RERANK_TOP, min_score=HYBRID_RERANK_MIN_SCORE):
+    """Re-order the first `top` fused documents by passage score and drop those under `min_score`."""
+    head = documents[:top]
+    scores = score_passages(question, [doc.get(content_field) or "" for doc in head])
+    for doc, score in zip(head, scores):
+        doc["@rerank_score"] = score
+    # Stable sort: equal scores keep their fused order
+    head.sort(key=lambda doc: doc["@rerank_score"], reverse=True)
+    return [doc for doc in head if doc["@rerank_score"] >= min_score]
+
+
+def hybrid_search(question, text_search, vector_search, key, content_field, top=3,
+                  candidates=HYBRID_CANDIDATES, rerank_top=HYBRID_RERANK_TOP, timings=None):
+    """Run a BM25 and a vector retriever concurrently and fuse them with RRF.
+
+    `text_search(n)` and `vector_search(n)` return up to `n` ranked documents
+    as dicts; either may query Azure Search or a local index. Milliseconds
+    spent in each stage ("text", "vector", "fusion", "rerank") are written
+    into `timings` when a dict is given. Returns the best `top` documents.
+
+    A failing vector retriever (e.g. the embeddings upstream is down or the
+    deadline ran out while embedding) degrades to BM25-only results; a
+    failing text retriever raises.
+    """
+    timings = {} if timings is None else timings
+    text_future = _executor.submit(_timed, timings, "text", text_search, candidates)
+    vector_future = _executor.submit(_timed, timings, "vector", vector_search, candidates)
+    text_results = text_future.result()
+    try:
+        vector_results = vector_future.result()
+    except Exception as e:
+        logging.warning(f"Vector retrieval failed, using BM25 results only: {e}")
+        vector_results = []
+
+    documents = _timed(timings, "fusion", reciprocal_rank_fusion, [text_results, vector_results], key)
+    if rerank_top:
+        documents = _timed(timings, "rerank", rerank, question, documents, content_field, rerank_top)
+    return documents[:top]
@@ -1,8 +1,5 @@
 import os
 import json
-import requests
-import http.client, urllib.parse
-import base64
 import re
 from dotenv import load_dotenv
 from flask import Flask, request, jsonify
@@ -11,7 +8,15 @@ from azure.search.documents import SearchClient
 from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents.indexes.models import SearchIndex, SimpleField, SearchField, SearchFieldDataType
 from azure.search.documents.models import VectorSearch, VectorizedQuery
-from tenacity import retry, stop_after_attempt, wait_fixed
+from clients import get_search_client, warm_up_in_background, search_options, is_transient_search_error, is_search_outage
+from vision import get_vision_client, get_embedding_cache, MODEL_VERSION, MAX_IMAGE_BYTES
+from index_sync import image_documents
+from batch_upload import upload_in_batches
+from thumbnails import ThumbnailCache, build_thumbnails, image_result, register_image_routes
+from profiler import register_profiler
+from deadline import register_deadline, current_deadline, call_upstream
+from circuit_breaker import get_breaker, CircuitOpen
+from metrics import register_metrics, stage_timer, timed
 
 # Load environment variables
 load_dotenv()
@@ -23,78 +28,71 @@ aiVisionApiKey = os.getenv("AZURE_AI_VISION_API_KEY")
 aiVisionRegion = os.getenv("AZURE_AI_VISION_REGION")
 aiVisionEndpoint = os.getenv("AZURE_AI_VISION_ENDPOINT")
 
-# Set up Azure Cognitive Search client
-credential = AzureKeyCredential(key)
-search_client = SearchClient(endpoint=service_endpoint, index_name=index_name, credential=credential)
+# Set up Azure Cognitive Search client from the shared, pooled registry
+search_client = get_search_client(service_endpoint, index_name, key)
+# While the index's circuit is open, searches fail fast instead of waiting out timeouts and retries
+image_index_breaker = get_breaker("image_index", is_failure=is_search_outage)
+warm_up_in_background([search_client])
 
 # Set up Flask app
 app = Flask(__name__)
+app.config['MAX_CONTENT_LENGTH'] = MAX_IMAGE_BYTES
 
 # Path to images folder in your project
 FILE_PATH = 'images'
 
+# Optional in-process vector index answering /search without a round trip to Azure
+LOCAL_IMAGE_INDEX = os.getenv("LOCAL_IMAGE_INDEX", "false").lower() == "true"
+local_image_index = None
+if LOCAL_IMAGE_INDEX:
+    from local_index import LocalIndexHolder, load_local_index
+    local_image_index = LocalIndexHolder(lambda: load_local_index(FILE_PATH, get_embedding_cache(), MODEL_VERSION))
+
+# Search hits are served as precomputed thumbnails, inline from an LRU or via /images
+thumbnail_cache = ThumbnailCache(FILE_PATH)
+register_image_routes(app, FILE_PATH)
+
+# Per-stage latency histograms on /metrics; SERVER_TIMING=true also sets a Server-Timing header
+register_metrics(app)
+
+# Opt-in sampling profiler: PROFILE_REQUESTS=true honours X-Profile / ?profile=1, PROFILE_SAMPLE_RATE samples traffic
+# Hedged upstream calls and uploads run on pool threads, so sample every thread
+register_profiler(app, all_threads=True)
+
+# Every request gets a time budget (REQUEST_DEADLINE_SECONDS, or less via X-Request-Timeout) shared by its upstream calls
+register_deadline(app)
+
 # Sanitize file names to conform to Azure Cognitive Search ID constraints
 def sanitize_id(filename):
     return re.sub(r'[^a-zA-Z0-9_-]', '_', filename)
 
 # Function to get image vector using Azure Vision API
-@retry(stop=stop_after_attempt(5), wait=wait_fixed(1))
-def get_image_vector(image_path, key, region):
-    headers = {'Ocp-Apim-Subscription-Key': key}
-    params = urllib.parse.urlencode({'model-version': '2023-04-15'})
-    
-    try:
-        if image_path.startswith(('http://', 'https://')):
-            headers['Content-Type'] = 'application/json'
-            body = json.dumps({"url": image_path})
-        else:
-            headers['Content-Type'] = 'application/octet-stream'
-            with open(image_path, "rb") as filehandler:
-                image_data = filehandler.read()
-                body = image_data
-
-        conn = http.client.HTTPSConnection(f'{region}.api.cognitive.microsoft.com', timeout=3)
-        conn.request("POST", "/computervision/retrieval:vectorizeImage?api-version=2023-04-01-preview&%s" % params, body, headers)
-        response = conn.getresponse()
-        data = json.load(response)
-        conn.close()
-
-        if response.status != 200:
-            raise Exception(f"Error processing image {image_path}: {data.get('message', '')}")
-        
-        return data.get("vector")
-
-    except (requests.exceptions.Timeout, http.client.HTTPException) as e:
-        print(f"Timeout/Error for {image_path}. Retrying...")
-        raise
-
-# Function to convert an image to base64 encoding
-def image_to_base64(image_path):
-    with open(image_path, "rb") as img_file:
-        return base64.b64encode(img_file.read()).decode('utf-8')
+@timed("get_image_vector")
+def get_image_vector(image, key, region):
+    return get_vision_client(key, region).vectorize(image, deadline=current_deadline())
 
 # Upload images and vectors to Azure Search
 def upload_images_to_search():
     files = os.listdir(FILE_PATH)
-    image_embeddings = {}
-
-    for file in files:
-        file_path = os.path.join(FILE_PATH, file)
-        image_embeddings[file] = get_image_vector(file_path, aiVisionApiKey, aiVisionRegion)
-
-    documents = []
-    for counter, file in enumerate(files):
-        sanitized_id = sanitize_id(file)
-        document = {
-            "id": sanitized_id,
-            "description": file,
-            "image_vector": image_embeddings[file]
-        }
-        documents.append(document)
-
-    # Upload documents to Azure Search
-    result = search_client.upload_documents(documents)
-    print(f"Uploaded {len(documents)} documents successfully.")
+    errors = []
+
+    # Stream documents from the vectorizer into batched uploads to Azure Search
+    vision_client = get_vision_client(aiVisionApiKey, aiVisionRegion)
+    documents = image_documents(vision_client, FILE_PATH, files, errors)
+    with stage_timer("upload_documents"):
+        report = upload_in_batches(search_client, documents)
+    build_thumbnails(FILE_PATH, files)
+    if local_image_index:
+        local_image_index.reload()
+
+    for error in errors:
+        print(f"Failed to vectorize {error['message']}")
+    print(f"Uploaded {report['succeeded']} documents successfully, {report['failed'] + len(errors)} failed.")
+
+# Vision or the image index is down: fail fast rather than let the request wait out the outage
+@app.errorhandler(CircuitOpen)
+def upstream_unavailable(e):
+    return jsonify({"error": str(e)}), 503, {"Retry-After": str(e.retry_after)}
 
 @app.route('/search', methods=['POST'])
 def search_similar_images():
@@ -103,38 +101,41 @@ def search_similar_images():
     if not file:
         return jsonify({"error": "No image file provided"}), 400
     
-    # Save the uploaded file temporarily
-    uploaded_image_path = os.path.join('uploads', file.filename)
-    file.save(uploaded_image_path)
-
-    # Get vector for the uploaded image
-    query_vector = get_image_vector(uploaded_image_path, aiVisionApiKey, aiVisionRegion)
-
-    # Create VectorizedQuery for similarity search
-    vectorized_query = VectorizedQuery(
-        kind="vector",
-        vector=query_vector,
-        k_nearest_neighbors=2,  # Limit to top 2 similar images
-        fields="image_vector",  # Field in the index that stores image vectors
-        exhaustive=True,
-    )
-
-    # Perform the search using VectorizedQuery
-    results = search_client.search(
-        search_text=None, 
-        vector_queries=[vectorized_query],
-        select=["description"]
-    )
-
-    # Return similar images as base64 encoded images
-    similar_images = []
-    for result in results:
-        image_path = os.path.join(FILE_PATH, result["description"])
-        encoded_image = image_to_base64(image_path)  # Convert image to base64
-        similar_images.append({
-            "image_name": result["description"],
-            "image_base64": encoded_image
-        })
+    # Werkzeug spools uploads to a SpooledTemporaryFile; read it (bounded by MAX_CONTENT_LENGTH)
+    query_vector = get_image_vector(file.read(), aiVisionApiKey, aiVisionRegion)
+
+    index = local_image_index.get() if local_image_index else None
+    if index is not None and len(index):
+        with stage_timer("local_image_search"):
+            results = index.search(query_vector, k=2)
+    else:
+        # Create VectorizedQuery for similarity search
+        vectorized_query = VectorizedQuery(
+            kind="vector",
+            vector=query_vector,
+            k_nearest_neighbors=2,  # Limit to top 2 similar images
+            fields="image_vector",  # Field in the index that stores image vectors
+            exhaustive=True,
+        )
+
+        # Perform the search using VectorizedQuery; the pager is read here so the timing covers the call
+        with stage_timer("image_search"):
+            results = call_upstream(
+                "image_search",
+                lambda timeout: list(search_client.search(
+                    search_text=None, 
+                    vector_queries=[vectorized_query],
+                    select=["description"],
+                    **search_options(timeout)
+                )),
+                hedge=True,
+                retryable=is_transient_search_error,
+                breaker=image_index_breaker,
+            )
+
+    # Return similar images as cached base64 thumbnails, or as URLs to /images when ?mode=url
+    mode = request.args.get("mode", "inline")
+    similar_images = [image_result(result["description"], thumbnail_cache, mode) for result in results]
     
     return jsonify({"similar_images": similar_images})
 
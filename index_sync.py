@@ -0,0 +1,119 @@
+import os
+import re
+import json
+import logging
+from embedding_cache import content_hash
+from vision import vectorize_images
+from batch_upload import upload_in_batches
+
+INDEX_MANIFEST_PATH = os.environ.get("INDEX_MANIFEST_PATH", "output/index_manifest.json")
+
+
+def sanitize_id(filename):
+    return re.sub(r'[^a-zA-Z0-9_-]', '_', filename)
+
+
+def load_manifest(path=INDEX_MANIFEST_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(manifest, path=INDEX_MANIFEST_PATH):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+def file_hash(path):
+    with open(path, "rb") as f:
+        return content_hash(f.read())
+
+
+def image_documents(vision_client, image_dir, files, errors):
+    """Vectorize `files` concurrently and yield index documents as vectors arrive.
+
+    Files that fail to vectorize are appended to `errors` instead of raising.
+    """
+    paths = [os.path.join(image_dir, file) for file in files]
+    for path, vector, error in vectorize_images(vision_client, paths):
+        file = os.path.basename(path)
+        if error is not None:
+            errors.append({"key": sanitize_id(file), "status_code": None, "message": f"{file}: {error}"})
+            continue
+        yield {"id": sanitize_id(file), "description": file, "image_vector": vector}
+
+
+def diff_images(image_dir, manifest):
+    """Compare the image folder with the manifest.
+
+    Returns (changed, unchanged, removed): `changed` maps file name to
+    (entry, is_new) for files that must be re-uploaded, `unchanged` maps file
+    name to its refreshed manifest entry, and `removed` lists manifest entries
+    whose files are gone. Files whose mtime and size match are skipped without
+    being hashed.
+    """
+    changed, unchanged = {}, {}
+    files = os.listdir(image_dir)
+
+    for file in files:
+        stat = os.stat(os.path.join(image_dir, file))
+        previous = manifest.get(file)
+        entry = {"id": sanitize_id(file), "mtime": stat.st_mtime, "size": stat.st_size}
+
+        if previous and previous["mtime"] == entry["mtime"] and previous["size"] == entry["size"]:
+            unchanged[file] = previous
+            continue
+
+        entry["hash"] = file_hash(os.path.join(image_dir, file))
+        if previous and previous.get("hash") == entry["hash"]:
+            unchanged[file] = entry
+        else:
+            changed[file] = (entry, previous is None)
+
+    removed = [entry for file, entry in manifest.items() if file not in unchanged and file not in changed]
+    return changed, unchanged, removed
+
+
+def sync_images(search_client, image_dir, vision_client, manifest_path=INDEX_MANIFEST_PATH):
+    """Bring the image index in line with `image_dir`, touching only what changed.
+
+    New and modified images are vectorized and sent with
+    `merge_or_upload_documents`, documents for deleted files are removed, and
+    the manifest is rewritten to reflect what the index now holds.
+    Returns counts of added, updated, deleted, skipped and failed files.
+    """
+    manifest = load_manifest(manifest_path)
+    changed, unchanged, removed = diff_images(image_dir, manifest)
+    counts = {"added": 0, "updated": 0, "deleted": 0, "skipped": len(unchanged), "failed": 0}
+    new_manifest = dict(unchanged)
+
+    errors = []
+    documents = image_documents(vision_client, image_dir, list(changed), errors)
+    report = upload_in_batches(search_client, documents, action="merge_or_upload")
+    errors.extend(report["errors"])
+
+    failed_ids = {error["key"] for error in errors}
+    for file, (entry, is_new) in changed.items():
+        if entry["id"] in failed_ids:
+            counts["failed"] += 1
+            # Keep the old entry so a failed file is retried next run without being deleted
+            if file in manifest:
+                new_manifest[file] = manifest[file]
+        else:
+            new_manifest[file] = entry
+            counts["added" if is_new else "updated"] += 1
+
+    if removed:
+        report = upload_in_batches(search_client, ({"id": entry["id"]} for entry in removed), action="delete")
+        counts["deleted"] += report["succeeded"]
+        counts["failed"] += report["failed"]
+        failed_ids = {error["key"] for error in report["errors"]}
+        new_manifest.update({file: entry for file, entry in manifest.items() if entry["id"] in failed_ids})
+
+    save_manifest(new_manifest, manifest_path)
+    return counts
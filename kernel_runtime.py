@@ -0,0 +1,79 @@
+import os
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+FUNCTION_CACHE_SIZE = int(os.environ.get("FUNCTION_CACHE_SIZE", "256"))
+
+
+class BackgroundLoop:
+    """One asyncio event loop running forever on a daemon thread.
+
+    Sync request handlers submit coroutines with `run(coro)` and block on
+    the result, instead of `asyncio.run` creating and tearing down a loop
+    (and the kernel's HTTP sessions with it) on every request.
+    """
+
+    def __init__(self, name="kernel-loop"):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, coro):
+        """Schedule `coro` on the loop and return a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+def template_hash(template):
+    return hashlib.sha256(template.encode("utf-8")).hexdigest()
+
+
+class FunctionRegistry:
+    """LRU cache of compiled kernel functions keyed by prompt template hash.
+
+    `build(template, name)` compiles a function once per distinct template;
+    later requests with the same template reuse it. The least recently used
+    function is dropped once `max_size` templates are cached.
+    """
+
+    def __init__(self, build, max_size=FUNCTION_CACHE_SIZE):
+        self.build = build
+        self.max_size = max_size
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._functions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, template):
+        key = template_hash(template)
+        with self._lock:
+            function = self._functions.get(key)
+            if function is not None:
+                self._functions.move_to_end(key)
+                self.stats["hits"] += 1
+                return function
+            self.stats["misses"] += 1
+            function = self.build(template, f"fn_{key[:16]}")
+            self._functions[key] = function
+            while len(self._functions) > self.max_size:
+                self._functions.popitem(last=False)
+                self.stats["evictions"] += 1
+            return function
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.stats, "functions": len(self._functions)}
@@ -1,13 +1,54 @@
 import os
+from typing import Any
 from dotenv import load_dotenv
 from langchain.memory import ConversationBufferWindowMemory
 from langchain.chains import ConversationChain
 from langchain.chat_models import AzureChatOpenAI
 from langchain.prompts import ChatPromptTemplate
+from langchain.schema import SystemMessage
+from conversation_summary import RollingSummarizer
 
 # Load environment variables from .env file
 load_dotenv()
 
+
+class SummarizingWindowMemory(ConversationBufferWindowMemory):
+    """Window memory whose evicted turns are folded into a rolling summary.
+
+    The last `k` turns are kept verbatim as before; older turns are handed to
+    the summarizer and dropped from the buffer, so the prompt carries the
+    window plus one bounded summary however long the conversation runs.
+    """
+
+    summarizer: Any = None
+    session_key: str = "default"
+    # Seconds to wait for an in-flight summary before building the next prompt
+    summary_wait: float = 0
+
+    def save_context(self, inputs, outputs):
+        super().save_context(inputs, outputs)
+        messages = self.chat_memory.messages
+        evicted = messages[:-2 * self.k] if self.k else messages[:]
+        if evicted:
+            self.summarizer.add(self.session_key, [
+                (evicted[i].content, evicted[i + 1].content) for i in range(0, len(evicted) - 1, 2)
+            ])
+            self.chat_memory.messages = messages[len(evicted):]
+
+    def load_memory_variables(self, inputs):
+        if self.summary_wait:
+            self.summarizer.wait(self.session_key, self.summary_wait)
+        variables = super().load_memory_variables(inputs)
+        summary = self.summarizer.summary(self.session_key)
+        if summary:
+            history = variables[self.memory_key]
+            if isinstance(history, str):
+                variables[self.memory_key] = f"Summary of earlier conversation: {summary}\n{history}"
+            else:
+                variables[self.memory_key] = [SystemMessage(content=f"Summary of earlier conversation: {summary}")] + history
+        return variables
+
+
 try:
     # Get Azure OpenAI environment variables
     azure_openai_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
@@ -32,8 +73,11 @@ try:
         ('user', 'Question : {input}'),
     ])
 
-    # Create a ConversationBufferWindowMemory with k=1
-    window_memory = ConversationBufferWindowMemory(k=1)
+    # Keep the last turn verbatim (k=1) and a rolling summary of everything before it.
+    # Prompts use the last completed summary; SUMMARY_WAIT_SECONDS bounds any wait for one in flight
+    summarizer = RollingSummarizer(lambda summary_prompt: model.invoke(summary_prompt).content)
+    summary_wait = float(os.getenv("SUMMARY_WAIT_SECONDS", "0"))
+    window_memory = SummarizingWindowMemory(k=1, summarizer=summarizer, summary_wait=summary_wait)
 
     # Create a conversation chain
     window_memory_chain = ConversationChain(
@@ -0,0 +1,162 @@
+import os
+import json
+import logging
+import threading
+import numpy as np
+from embedding_cache import content_hash
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+DOC_VECTORS_PATH = os.environ.get("DOC_VECTORS_PATH", "output/docVectors.json")
+
+# Below this many vectors an exact matmul scan is faster than any index
+BRUTE_FORCE_MAX = int(os.environ.get("LOCAL_INDEX_BRUTE_FORCE_MAX", "20000"))
+IVF_PROBES = int(os.environ.get("LOCAL_INDEX_IVF_PROBES", "8"))
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def _top_k(scores, k):
+    k = min(k, len(scores))
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+class LocalVectorIndex:
+    """In-memory cosine similarity index over image vectors.
+
+    Rows are stored as L2-normalized float32 so a dot product is the cosine
+    similarity. Small catalogs are scanned exactly; larger ones use HNSW when
+    hnswlib is installed and a coarse IVF partition otherwise.
+    """
+
+    def __init__(self, descriptions, vectors):
+        self.descriptions = list(descriptions)
+        self.matrix = _normalize(np.asarray(vectors, dtype=np.float32))
+        self._hnsw = None
+        self._centroids = None
+        self._lists = None
+
+        if len(self.descriptions) > BRUTE_FORCE_MAX:
+            if hnswlib is not None:
+                self._build_hnsw()
+            else:
+                self._build_ivf()
+
+    def __len__(self):
+        return len(self.descriptions)
+
+    def _build_hnsw(self):
+        count, dim = self.matrix.shape
+        self._hnsw = hnswlib.Index(space="ip", dim=dim)
+        self._hnsw.init_index(max_elements=count, ef_construction=200, M=16)
+        self._hnsw.add_items(self.matrix, np.arange(count))
+        self._hnsw.set_ef(64)
+
+    def _build_ivf(self, iterations=10):
+        count = len(self.matrix)
+        nlist = max(1, int(np.sqrt(count)))
+        rng = np.random.default_rng(0)
+        centroids = self.matrix[rng.choice(count, nlist, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(self.matrix @ centroids.T, axis=1)
+            for i in range(nlist):
+                members = self.matrix[assignment == i]
+                if len(members):
+                    centroids[i] = members.mean(axis=0)
+            centroids = _normalize(centroids)
+        assignment = np.argmax(self.matrix @ centroids.T, axis=1)
+        self._centroids = centroids
+        self._lists = [np.flatnonzero(assignment == i) for i in range(nlist)]
+
+    def search(self, vector, k=2):
+        """Return up to `k` nearest neighbours as dicts with description and score."""
+        if not len(self):
+            return []
+        query = _normalize(np.asarray(vector, dtype=np.float32))
+
+        if self._hnsw is not None:
+            labels, distances = self._hnsw.knn_query(query, k=min(k, len(self)))
+            rows, scores = labels[0], 1 - distances[0]
+        elif self._centroids is not None:
+            probes = _top_k(self._centroids @ query, IVF_PROBES)
+            candidates = np.concatenate([self._lists[i] for i in probes])
+            candidate_scores = self.matrix[candidates] @ query
+            order = _top_k(candidate_scores, k)
+            rows, scores = candidates[order], candidate_scores[order]
+        else:
+            all_scores = self.matrix @ query
+            rows = _top_k(all_scores, k)
+            scores = all_scores[rows]
+
+        return [
+            {"description": self.descriptions[row], "score": float(score)}
+            for row, score in zip(rows, scores)
+        ]
+
+    @classmethod
+    def from_doc_vectors(cls, path=DOC_VECTORS_PATH):
+        """Build the index from the JSON written by create_embeddings.py."""
+        with open(path) as f:
+            documents = json.load(f)
+        return cls([doc["description"] for doc in documents], [doc["image_vector"] for doc in documents])
+
+    @classmethod
+    def from_embedding_cache(cls, cache, image_dir, model_version):
+        """Build the index for the files in `image_dir` whose vectors are already cached."""
+        descriptions, vectors = [], []
+        for file in sorted(os.listdir(image_dir)):
+            with open(os.path.join(image_dir, file), "rb") as f:
+                vector = cache.get(content_hash(f.read()), model_version)
+            if vector is not None:
+                descriptions.append(file)
+                vectors.append(vector)
+        return cls(descriptions, vectors)
+
+
+class LocalIndexHolder:
+    """Thread-safe holder so the index can be rebuilt after an upload without blocking searches."""
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._index = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def get(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._load()
+        return self._index
+
+    def reload(self):
+        with self._lock:
+            self._load()
+        return self._index
+
+    def _load(self):
+        # Searches keep using the previous index until the new one is swapped in
+        try:
+            index = self._loader()
+            logging.info(f"Loaded local image index with {len(index)} vectors")
+            self._index = index
+        except Exception as e:
+            logging.error(f"Failed to load local image index, keeping the previous one: {e}")
+        self._loaded = True
+
+
+def load_local_index(image_dir, cache=None, model_version=None, doc_vectors_path=DOC_VECTORS_PATH):
+    """Prefer the embedding cache for the current image folder, else docVectors.json."""
+    if cache is not None:
+        index = LocalVectorIndex.from_embedding_cache(cache, image_dir, model_version)
+        if len(index):
+            return index
+    return LocalVectorIndex.from_doc_vectors(doc_vectors_path)
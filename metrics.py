@@ -0,0 +1,187 @@
+import os
+import time
+import bisect
+import functools
+import threading
+from contextvars import ContextVar
+
+# Adds a Server-Timing header with the stages measured before the response is returned
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "false").lower() == "true"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_request_timings = ContextVar("request_timings", default=None)
+
+
+def _labels(label_name, value):
+    escaped = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return f'{label_name}="{escaped}"'
+
+
+class Histogram:
+    """Prometheus-style cumulative histogram with one label (e.g. the stage name)."""
+
+    def __init__(self, name, help, label_name="stage", buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_name = label_name
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label, seconds):
+        with self._lock:
+            series = self._series.get(label)
+            if series is None:
+                series = self._series[label] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            index = bisect.bisect_left(self.buckets, seconds)
+            if index < len(self.buckets):
+                series["counts"][index] += 1
+            series["sum"] += seconds
+            series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label, series in sorted(self._series.items()):
+                labels = _labels(self.label_name, label)
+                cumulative = 0
+                for bound, count in zip(self.buckets, series["counts"]):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {series["count"]}')
+                lines.append(f"{self.name}_sum{{{labels}}} {series['sum']}")
+                lines.append(f"{self.name}_count{{{labels}}} {series['count']}")
+        return lines
+
+
+class Counter:
+    """Prometheus-style counter with one label."""
+
+    def __init__(self, name, help, label_name):
+        self.name = name
+        self.help = help
+        self.label_name = label_name
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label, amount=1):
+        with self._lock:
+            self._values[label] = self._values.get(label, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{{{_labels(self.label_name, label)}}} {value}")
+        return lines
+
+
+stage_seconds = Histogram("rag_stage_duration_seconds", "Time spent in each request stage.")
+stage_errors = Counter("rag_stage_errors_total", "Stages that ended with an exception.", "stage")
+_metrics = [stage_seconds, stage_errors]
+_collectors = []
+
+
+def register_collector(collect):
+    """Add a callable returning extra exposition lines (e.g. gauges) to /metrics."""
+    _collectors.append(collect)
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for collect in _collectors:
+        lines.extend(collect())
+    return "\n".join(lines) + "\n"
+
+
+def observe_stage(stage, seconds):
+    """Record a stage duration in the histogram and in the current request's Server-Timing."""
+    stage_seconds.observe(stage, seconds)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+
+class stage_timer:
+    """Context manager timing one stage: `with stage_timer("search"): ...`.
+
+    The elapsed seconds are available as `.elapsed` afterwards.
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.elapsed = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.elapsed = time.perf_counter() - self._start
+        observe_stage(self.stage, self.elapsed)
+        if exc_type is not None:
+            stage_errors.inc(self.stage)
+        return False
+
+
+def timed(stage):
+    """Decorator form of `stage_timer`."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage_timer(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _start_request_timings():
+    _request_timings.set([])
+
+
+def _add_server_timing(response):
+    timings = _request_timings.get()
+    if timings:
+        response.headers["Server-Timing"] = ", ".join(
+            f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings
+        )
+    return response
+
+
+def register_metrics(app, server_timing=SERVER_TIMING):
+    """Expose GET /metrics on a Flask app and collect per-request stage timings.
+
+    Histograms are per process: with several workers, scrape each one.
+    """
+
+    def metrics():
+        return app.response_class(render(), mimetype="text/plain; version=0.0.4")
+
+    if server_timing:
+        app.before_request(_start_request_timings)
+        app.after_request(_add_server_timing)
+    app.add_url_rule("/metrics", "metrics", metrics, methods=["GET"])
+
+
+def register_async_metrics(app, server_timing=SERVER_TIMING):
+    """`register_metrics` for a Quart app.
+
+    The hooks are coroutines so they share the view's context; Quart runs sync
+    hooks in a thread on a copy of it, where the timings list would be lost.
+    """
+
+    async def start_request_timings():
+        _start_request_timings()
+
+    async def add_server_timing(response):
+        return _add_server_timing(response)
+
+    async def metrics():
+        return app.response_class(render(), mimetype="text/plain; version=0.0.4")
+
+    if server_timing:
+        app.before_request(start_request_timings)
+        app.after_request(add_server_timing)
+    app.add_url_rule("/metrics", "metrics", metrics, methods=["GET"])
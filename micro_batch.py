@@ -0,0 +1,141 @@
+import os
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from deadline import DeadlineExceeded
+
+EMBED_BATCH_MAX_SIZE = int(os.environ.get("EMBED_BATCH_MAX_SIZE", "16"))
+EMBED_BATCH_MAX_WAIT_MS = float(os.environ.get("EMBED_BATCH_MAX_WAIT_MS", "5"))
+# Batches (or single calls, for unbatched backends) in flight at once per batcher
+EMBED_BATCH_MAX_CONCURRENCY = int(os.environ.get("EMBED_BATCH_MAX_CONCURRENCY", "8"))
+
+
+class MicroBatcher:
+    """Coalesce concurrent embedding requests into batched upstream calls.
+
+    Requests arriving within `max_wait` seconds of each other (up to
+    `max_batch`) are collected by a background thread. With `dispatch_batch`
+    they are sent together as one call, which must return one result per item
+    in order. Backends without a batch API pass `dispatch_one` instead: the
+    collected items then run on the batcher's persistent worker threads, so
+    every call reuses a warm keep-alive connection rather than opening one
+    from the short-lived request thread. Results are fanned back to each
+    waiting caller; a failed batch call fails every item in it.
+
+    Items may carry a request `deadline`. Calling the batcher waits no longer
+    than it, and the dispatch function is passed `deadline=` (for a batch,
+    the latest of its items') so the upstream call is bounded too; items whose
+    deadline ran out while queued are failed without being sent.
+    """
+
+    def __init__(self, dispatch_batch=None, dispatch_one=None, max_batch=EMBED_BATCH_MAX_SIZE,
+                 max_wait=EMBED_BATCH_MAX_WAIT_MS / 1000, max_concurrency=EMBED_BATCH_MAX_CONCURRENCY,
+                 name="micro-batch"):
+        if (dispatch_batch is None) == (dispatch_one is None):
+            raise ValueError("Pass exactly one of dispatch_batch or dispatch_one")
+        self.dispatch_batch = dispatch_batch
+        self.dispatch_one = dispatch_one
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.name = name
+        self.stats = {"items": 0, "batches": 0, "largest_batch": 0, "errors": 0}
+        self._queue = queue.SimpleQueue()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._collector = None
+
+    def submit(self, item, deadline=None):
+        """Queue `item` and return a Future for its result."""
+        future = Future()
+        if self._collector is None:
+            with self._lock:
+                if self._collector is None:
+                    self._collector = threading.Thread(target=self._collect, name=f"{self.name}-collector", daemon=True)
+                    self._collector.start()
+        self._queue.put((item, future, deadline))
+        return future
+
+    def __call__(self, item, deadline=None):
+        future = self.submit(item, deadline)
+        if deadline is None:
+            return future.result()
+        try:
+            return future.result(timeout=deadline.timeout())
+        except TimeoutError:
+            if future.done():
+                raise
+            raise DeadlineExceeded(f"{self.name}: no result within the request deadline")
+
+    def _collect(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            with self._lock:
+                self.stats["items"] += len(batch)
+                self.stats["batches"] += 1
+                self.stats["largest_batch"] = max(self.stats["largest_batch"], len(batch))
+
+            if self.dispatch_batch is not None:
+                self._executor.submit(self._run_batch, batch)
+            else:
+                for item, future, deadline in batch:
+                    self._executor.submit(self._run_one, item, future, deadline)
+
+    def _run_batch(self, batch):
+        batch = [entry for entry in batch if not self._expired(entry[1], entry[2])]
+        if not batch:
+            return
+        deadlines = [deadline for _, _, deadline in batch]
+        kwargs = {}
+        if None not in deadlines:
+            kwargs["deadline"] = max(deadlines, key=lambda deadline: deadline.at)
+        try:
+            results = self.dispatch_batch([item for item, _, _ in batch], **kwargs)
+            if len(results) != len(batch):
+                raise RuntimeError(f"{self.name}: expected {len(batch)} results, got {len(results)}")
+        except Exception as e:
+            logging.error(f"{self.name} batch of {len(batch)} failed: {e}")
+            self._failed(len(batch))
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        for (_, future, _), result in zip(batch, results):
+            future.set_result(result)
+
+    def _run_one(self, item, future, deadline):
+        if self._expired(future, deadline):
+            return
+        try:
+            if deadline is None:
+                future.set_result(self.dispatch_one(item))
+            else:
+                future.set_result(self.dispatch_one(item, deadline=deadline))
+        except Exception as e:
+            self._failed(1)
+            future.set_exception(e)
+
+    def _expired(self, future, deadline):
+        # The caller has stopped waiting; don't spend an upstream call on it
+        if deadline is not None and deadline.remaining() <= 0:
+            future.set_exception(DeadlineExceeded(f"{self.name}: request deadline ran out while queued"))
+            return True
+        return False
+
+    def _failed(self, count):
+        with self._lock:
+            self.stats["errors"] += count
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats)
@@ -0,0 +1,180 @@
+import os
+import sys
+import time
+import uuid
+import random
+import logging
+import threading
+import tracemalloc
+from collections import Counter
+from flask import g, request
+
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "output/profiles")
+# Honour the X-Profile header / ?profile=1 flag; off by default so clients can't switch it on
+PROFILE_REQUESTS = os.environ.get("PROFILE_REQUESTS", "false").lower() == "true"
+# Fraction of all requests profiled regardless of flags, e.g. 0.01
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "5"))
+PROFILE_MAX_CONCURRENT = int(os.environ.get("PROFILE_MAX_CONCURRENT", "4"))
+# Frames kept per tracemalloc traceback; more is slower
+PROFILE_TRACEMALLOC_FRAMES = int(os.environ.get("PROFILE_TRACEMALLOC_FRAMES", "10"))
+
+_active = threading.BoundedSemaphore(PROFILE_MAX_CONCURRENT)
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+_tracemalloc_owned = False
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler(threading.Thread):
+    """Samples thread stacks every `interval` seconds into collapsed-stack counts.
+
+    Only the threads in `thread_ids` are sampled, or every thread but the
+    sampler itself when it is None (each stack is then prefixed with the
+    thread's name).
+    """
+
+    def __init__(self, thread_ids=None, interval=PROFILE_INTERVAL_MS / 1000):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.thread_ids = thread_ids
+        self.interval = interval
+        self.counts = Counter()
+        self.samples = 0
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()} if self.thread_ids is None else None
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident or (self.thread_ids is not None and thread_id not in self.thread_ids):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                if names is not None:
+                    stack.append(names.get(thread_id, str(thread_id)))
+                self.counts[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+    def collapsed(self):
+        """Stacks in the collapsed format read by flamegraph.pl and speedscope."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.counts.most_common())
+
+
+def _start_tracemalloc():
+    global _tracemalloc_users, _tracemalloc_owned
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+            _tracemalloc_owned = True
+        _tracemalloc_users += 1
+
+
+def _stop_tracemalloc():
+    global _tracemalloc_users, _tracemalloc_owned
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        # Leave tracing alone if something else (e.g. PYTHONTRACEMALLOC) started it
+        if _tracemalloc_users == 0 and _tracemalloc_owned:
+            tracemalloc.stop()
+            _tracemalloc_owned = False
+
+
+class RequestProfile:
+    """Stack samples and a tracemalloc snapshot for one request, written under `directory`.
+
+    Produces <id>.collapsed, <id>.tracemalloc (load with
+    tracemalloc.Snapshot.load) and <id>.txt with the top allocation sites.
+    tracemalloc is process-wide, so allocations of concurrent requests are
+    included in the snapshot.
+    """
+
+    def __init__(self, name, all_threads=False, directory=PROFILE_DIR):
+        self.id = f"{time.strftime('%Y%m%d-%H%M%S')}-{name}-{uuid.uuid4().hex[:8]}"
+        self.all_threads = all_threads
+        self.directory = directory
+        self._sampler = None
+
+    def start(self):
+        self._start = time.perf_counter()
+        _start_tracemalloc()
+        self._sampler = StackSampler(None if self.all_threads else {threading.get_ident()})
+        self._sampler.start()
+        return self
+
+    def stop(self):
+        self._sampler.stop()
+        elapsed = time.perf_counter() - self._start
+        try:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            _stop_tracemalloc()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            base = os.path.join(self.directory, self.id)
+            with open(base + ".collapsed", "w") as f:
+                f.write(self._sampler.collapsed())
+            snapshot.dump(base + ".tracemalloc")
+            with open(base + ".txt", "w") as f:
+                f.write(f"elapsed_s {elapsed:.3f}\nsamples {self._sampler.samples}\n"
+                        f"traced_current_bytes {current}\ntraced_peak_bytes {peak}\n\n")
+                for stat in snapshot.statistics("lineno")[:25]:
+                    f.write(f"{stat}\n")
+        except OSError as e:
+            logging.error(f"Could not write profile {self.id}: {e}")
+
+
+def should_profile(flag, sample_rate=PROFILE_SAMPLE_RATE, allow_flag=PROFILE_REQUESTS):
+    """Cheap per-request check: the request's flag when allowed, else the sampled fraction."""
+    if allow_flag and flag and flag.lower() in ("1", "true", "yes"):
+        return True
+    return sample_rate > 0 and random.random() < sample_rate
+
+
+def register_profiler(app, all_threads=False):
+    """Profile selected requests of a Flask app.
+
+    A request is profiled when PROFILE_REQUESTS=true and it carries an
+    `X-Profile: 1` header or `?profile=1`, or when it falls in the
+    PROFILE_SAMPLE_RATE fraction. At most PROFILE_MAX_CONCURRENT requests are
+    profiled at once. Profiling runs until the response has been fully sent,
+    so streamed answers are covered; the profile ID is returned in an
+    X-Profile-Id header. Pass `all_threads=True` for apps that do their work
+    on other threads (e.g. an event-loop thread).
+    """
+    if not PROFILE_REQUESTS and PROFILE_SAMPLE_RATE <= 0:
+        return
+
+    @app.before_request
+    def start_profile():
+        if not should_profile(request.headers.get("X-Profile") or request.args.get("profile")):
+            return
+        if not _active.acquire(blocking=False):
+            return
+        g.request_profile = RequestProfile(request.endpoint or "unknown", all_threads).start()
+
+    @app.after_request
+    def tag_profile(response):
+        profile = g.get("request_profile")
+        if profile is not None:
+            response.headers["X-Profile-Id"] = profile.id
+        return response
+
+    @app.teardown_request
+    def stop_profile(error=None):
+        profile = g.pop("request_profile", None)
+        if profile is not None:
+            try:
+                profile.stop()
+            finally:
+                _active.release()
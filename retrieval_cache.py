@@ -0,0 +1,251 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import itertools
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from deadline import DeadlineExceeded
+
+RETRIEVAL_CACHE_TTL = float(os.environ.get("RETRIEVAL_CACHE_TTL", "300"))
+RETRIEVAL_CACHE_MAX_ENTRIES = int(os.environ.get("RETRIEVAL_CACHE_MAX_ENTRIES", "4096"))
+# e.g. redis://localhost:6379/0 to share cached results between worker processes
+RETRIEVAL_CACHE_REDIS_URL = os.environ.get("RETRIEVAL_CACHE_REDIS_URL")
+# Without Redis, index versions live in small files here so every worker on the host sees an invalidation
+RETRIEVAL_CACHE_VERSION_DIR = os.environ.get("RETRIEVAL_CACHE_VERSION_DIR", "output/retrieval_versions")
+
+
+class RetrievalCache:
+    """Cache of materialized search results keyed by index, query text, filter and top.
+
+    Every key embeds the index's current version, so `invalidate(index_name)`
+    makes all older entries unreachable; entries also expire after `ttl`
+    seconds. Only text-index searches are cached, and nothing in this repo
+    re-uploads that index: the job that does should POST /cache/invalidate
+    (api.py, wsgi.py, asgi.py) when it finishes, else results are up to `ttl`
+    seconds stale. Concurrent requests
+    for the same key are coalesced so only one of them calls Azure Search.
+    With a Redis URL, results and index versions are shared across processes;
+    otherwise versions are shared through files in `version_dir`, so an
+    invalidation reaches every worker on the host while results stay per process.
+    The latest results per query are also kept past expiry and invalidation
+    (in this process, up to `max_entries` queries) for `last_results`, the
+    fallback served while the index's circuit breaker is open.
+    """
+
+    def __init__(self, ttl=RETRIEVAL_CACHE_TTL, max_entries=RETRIEVAL_CACHE_MAX_ENTRIES,
+                 redis_url=RETRIEVAL_CACHE_REDIS_URL, version_dir=RETRIEVAL_CACHE_VERSION_DIR):
+        self.ttl = ttl
+        self.version_dir = version_dir
+        self.max_entries = max_entries
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "invalidations": 0, "fallbacks": 0}
+        self._entries = OrderedDict()
+        self._last_good = OrderedDict()
+        self._versions = {}
+        self._version_files = {}
+        self._in_flight = {}
+        self._async_in_flight = {}
+        self._lock = threading.Lock()
+        self._redis = None
+        if redis_url:
+            import redis
+            self._redis = redis.Redis.from_url(redis_url)
+
+    def _version(self, index_name):
+        if self._redis is not None:
+            try:
+                return int(self._redis.get(f"retrieval:version:{index_name}") or 0)
+            except Exception as e:
+                logging.error(f"Redis unavailable for retrieval cache: {e}")
+        if self.version_dir:
+            return self._file_version(index_name)
+        return self._versions.get(index_name, 0)
+
+    def _version_path(self, index_name):
+        return os.path.join(self.version_dir, hashlib.sha256(index_name.encode("utf-8")).hexdigest()[:32])
+
+    def _file_version(self, index_name):
+        # One stat per lookup; the file is only re-read after another worker replaced it
+        try:
+            stat = os.stat(self._version_path(index_name))
+        except FileNotFoundError:
+            return 0
+        except OSError as e:
+            logging.error(f"Retrieval cache version file unavailable: {e}")
+            return self._versions.get(index_name, 0)
+        signature = (stat.st_ino, stat.st_mtime_ns)
+        cached = self._version_files.get(index_name)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        try:
+            with open(self._version_path(index_name)) as f:
+                version = int(f.read() or 0)
+        except (OSError, ValueError) as e:
+            logging.error(f"Retrieval cache version file unreadable: {e}")
+            return cached[1] if cached is not None else 0
+        self._version_files[index_name] = (signature, version)
+        return version
+
+    def _bump_file_version(self, index_name):
+        path = self._version_path(index_name)
+        os.makedirs(self.version_dir, exist_ok=True)
+        # Written to a new file and renamed, so readers never see a partial write and the inode always changes
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(self._file_version(index_name) + 1))
+        os.replace(tmp_path, path)
+
+    def _key(self, index_name, query, filter, top, extra):
+        raw = json.dumps([index_name, self._version(index_name), query, filter, top, extra], sort_keys=True, default=str)
+        return "retrieval:" + hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _fallback_key(self, index_name, query, filter, top, extra):
+        raw = json.dumps([index_name, query, filter, top, extra], sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] >= now:
+                    self._entries.move_to_end(key)
+                    return entry[1]
+                del self._entries[key]
+        if self._redis is not None:
+            try:
+                raw = self._redis.get(key)
+                if raw is not None:
+                    return json.loads(raw)
+            except Exception as e:
+                logging.error(f"Redis unavailable for retrieval cache: {e}")
+        return None
+
+    def _put(self, key, documents, fallback_key):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, documents)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._last_good[fallback_key] = documents
+            self._last_good.move_to_end(fallback_key)
+            while len(self._last_good) > self.max_entries:
+                self._last_good.popitem(last=False)
+        if self._redis is not None:
+            try:
+                self._redis.set(key, json.dumps(documents, default=str), ex=int(self.ttl))
+            except Exception as e:
+                logging.error(f"Redis unavailable for retrieval cache: {e}")
+
+    def get_or_search(self, index_name, query, filter, top, search, **extra):
+        """Return cached documents for the query, or run `search()` once and cache its results.
+
+        `search` is a zero-argument callable returning an iterable of documents
+        (e.g. a SearchClient pager); the first `top` are materialized as dicts.
+        Exceptions from `search` propagate to every coalesced caller, except the
+        leader's own DeadlineExceeded: its budget may be shorter than theirs, so
+        they search again.
+        """
+        key = self._key(index_name, query, filter, top, extra)
+        documents = self._get(key)
+        if documents is not None:
+            self.stats["hits"] += 1
+            return documents
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._in_flight[key] = future
+
+        if not leader:
+            self.stats["coalesced"] += 1
+            try:
+                return future.result()
+            except DeadlineExceeded:
+                return self.get_or_search(index_name, query, filter, top, search, **extra)
+
+        self.stats["misses"] += 1
+        try:
+            # Stop at `top` so the pager never fetches a page beyond the results we use
+            documents = [dict(doc) for doc in itertools.islice(search(), top)]
+            self._put(key, documents, self._fallback_key(index_name, query, filter, top, extra))
+        except BaseException as e:
+            # Unregistered before followers wake, so one that searches again starts a fresh call
+            self._finish(key)
+            future.set_exception(e)
+            raise
+        self._finish(key)
+        future.set_result(documents)
+        return documents
+
+    def _finish(self, key):
+        with self._lock:
+            self._in_flight.pop(key, None)
+
+    async def aget_or_search(self, index_name, query, filter, top, search, **extra):
+        """Async variant of `get_or_search` for the ASGI app; `search` is an async callable
+        returning the list of documents."""
+        key = self._key(index_name, query, filter, top, extra)
+        documents = self._get(key)
+        if documents is not None:
+            self.stats["hits"] += 1
+            return documents
+
+        task = self._async_in_flight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+            try:
+                return await asyncio.shield(task)
+            except DeadlineExceeded:
+                return await self.aget_or_search(index_name, query, filter, top, search, **extra)
+
+        async def run():
+            try:
+                documents = [dict(doc) for doc in await search()]
+                self._put(key, documents, self._fallback_key(index_name, query, filter, top, extra))
+                return documents
+            finally:
+                self._async_in_flight.pop(key, None)
+
+        self.stats["misses"] += 1
+        # Shielded so a disconnecting leader does not cancel the search for its followers
+        task = asyncio.ensure_future(run())
+        self._async_in_flight[key] = task
+        return await asyncio.shield(task)
+
+    def last_results(self, index_name, query, filter, top, **extra):
+        """The most recent results fetched for the query, however old, or None."""
+        key = self._fallback_key(index_name, query, filter, top, extra)
+        with self._lock:
+            documents = self._last_good.get(key)
+            if documents is not None:
+                self.stats["fallbacks"] += 1
+            return documents
+
+    def invalidate(self, index_name):
+        """Drop every cached result for `index_name` by bumping its version."""
+        with self._lock:
+            self._versions[index_name] = self._versions.get(index_name, 0) + 1
+            self.stats["invalidations"] += 1
+        if self._redis is None and self.version_dir:
+            try:
+                self._bump_file_version(index_name)
+            except OSError as e:
+                logging.error(f"Could not share retrieval cache invalidation: {e}")
+        if self._redis is not None:
+            try:
+                self._redis.incr(f"retrieval:version:{index_name}")
+            except Exception as e:
+                logging.error(f"Redis unavailable for retrieval cache: {e}")
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.stats, "entries": len(self._entries)}
+
+
+retrieval_cache = RetrievalCache()
@@ -0,0 +1,233 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from context_builder import count_tokens
+
+SESSION_MAX_TURNS = int(os.environ.get("SESSION_MAX_TURNS", "3"))
+SESSION_MAX_TOKENS = int(os.environ.get("SESSION_MAX_TOKENS", "2000"))
+# Sessions untouched for this many seconds are moved from memory to disk
+SESSION_IDLE_SECONDS = float(os.environ.get("SESSION_IDLE_SECONDS", "300"))
+SESSION_MAX_IN_MEMORY = int(os.environ.get("SESSION_MAX_IN_MEMORY", "1000"))
+SESSION_STORE_PATH = os.environ.get("SESSION_STORE_PATH", "output/sessions.sqlite")
+SESSION_DISK_MAX_SESSIONS = int(os.environ.get("SESSION_DISK_MAX_SESSIONS", "100000"))
+# The disk store may overshoot its cap by this fraction before it is pruned back, so pruning is amortized
+SESSION_DISK_PRUNE_MARGIN = float(os.environ.get("SESSION_DISK_PRUNE_MARGIN", "0.1"))
+
+
+class SessionHistory:
+    """Ring buffer of (user, assistant) turns bounded by turn count and tokens.
+
+    Appending is O(1); once `max_turns` or `max_tokens` is exceeded the oldest
+    turns are evicted from the left, also O(1) each. `summary` holds a running
+    summary of evicted turns when the caller maintains one.
+    """
+
+    def __init__(self, max_turns=SESSION_MAX_TURNS, max_tokens=SESSION_MAX_TOKENS, turns=(), summary=""):
+        self.max_tokens = max_tokens
+        self.summary = summary
+        self.turns = deque(maxlen=max_turns)
+        self.tokens = 0
+        for user, assistant in turns:
+            self.append(user, assistant)
+
+    def append(self, user, assistant):
+        """Add a turn and return the turns evicted to make room for it."""
+        evicted = []
+        if len(self.turns) == self.turns.maxlen:
+            evicted.append(self._popleft())
+        tokens = count_tokens(user) + count_tokens(assistant)
+        self.turns.append((user, assistant, tokens))
+        self.tokens += tokens
+        # Always keep the latest turn, even when it alone is over budget
+        while self.tokens > self.max_tokens and len(self.turns) > 1:
+            evicted.append(self._popleft())
+        return evicted
+
+    def _popleft(self):
+        user, assistant, tokens = self.turns.popleft()
+        self.tokens -= tokens
+        return user, assistant
+
+    def messages(self):
+        """Yield (role, content) in conversation order."""
+        for user, assistant, _ in self.turns:
+            yield "user", user
+            yield "assistant", assistant
+
+    def to_json(self):
+        return json.dumps({
+            "summary": self.summary,
+            "turns": [[user, assistant] for user, assistant, _ in self.turns],
+        })
+
+    @classmethod
+    def from_json(cls, raw, max_turns=SESSION_MAX_TURNS, max_tokens=SESSION_MAX_TOKENS):
+        data = json.loads(raw)
+        return cls(max_turns, max_tokens, data["turns"], data.get("summary", ""))
+
+
+class _Entry:
+    __slots__ = ("history", "lock", "last_used", "users")
+
+    def __init__(self, history):
+        self.history = history
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.users = 0
+
+
+class SessionStore:
+    """Per-session chat histories kept in memory, with idle sessions spilled to SQLite.
+
+    `with store.session(session_id) as history:` holds that session's lock,
+    so concurrent requests for one session are serialized while different
+    sessions proceed in parallel. Sessions idle for `idle_seconds`, or the
+    least recently used once `max_in_memory` is exceeded, are written to disk
+    and reloaded on their next request; the disk store keeps the
+    `disk_max_sessions` most recently used sessions, pruned once it grows
+    `prune_margin` past that. Memory is per process:
+    with several worker processes, route a session to one worker or keep
+    `max_in_memory` small so histories are read back from the shared file.
+    """
+
+    def __init__(self, path=SESSION_STORE_PATH, max_turns=SESSION_MAX_TURNS, max_tokens=SESSION_MAX_TOKENS,
+                 idle_seconds=SESSION_IDLE_SECONDS, max_in_memory=SESSION_MAX_IN_MEMORY,
+                 disk_max_sessions=SESSION_DISK_MAX_SESSIONS, prune_margin=SESSION_DISK_PRUNE_MARGIN):
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.idle_seconds = idle_seconds
+        self.max_in_memory = max_in_memory
+        self.disk_max_sessions = disk_max_sessions
+        self.prune_at = disk_max_sessions + max(1, int(disk_max_sessions * prune_margin))
+        self._sessions = OrderedDict()
+        # Histories removed from memory whose disk write has not finished yet
+        self._spilling = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " session_id TEXT PRIMARY KEY,"
+            " turns TEXT NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_last_used ON sessions (last_used)")
+        self._conn.commit()
+        # Upper bound on the rows on disk (rewrites of a spilled session are counted again)
+        self._disk_rows = self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def _load(self, session_id):
+        with self._db_lock:
+            # The row stays until LRU eviction; the next spill overwrites it
+            row = self._conn.execute("SELECT turns FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        if row is None:
+            return SessionHistory(self.max_turns, self.max_tokens)
+        return SessionHistory.from_json(row[0], self.max_turns, self.max_tokens)
+
+    def _spill(self, spilled):
+        try:
+            self._write(spilled)
+        finally:
+            with self._lock:
+                for session_id, history in spilled:
+                    if self._spilling.get(session_id) is history:
+                        del self._spilling[session_id]
+
+    def _write(self, spilled):
+        with self._db_lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO sessions (session_id, turns, last_used) VALUES (?, ?, ?)",
+                [(session_id, history.to_json(), time.time()) for session_id, history in spilled],
+            )
+            self._disk_rows += len(spilled)
+            if self._disk_rows >= self.prune_at:
+                self._prune()
+            self._conn.commit()
+
+    def _prune(self):
+        # Only counted once the upper bound says the cap may be overshot; other workers may share the file
+        self._disk_rows = self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+        if self._disk_rows < self.prune_at:
+            return
+        self._conn.execute(
+            "DELETE FROM sessions WHERE session_id IN"
+            " (SELECT session_id FROM sessions ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.disk_max_sessions,),
+        )
+        self._disk_rows = self.disk_max_sessions
+
+    def _checkout(self, session_id):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is not None:
+                self._sessions.move_to_end(session_id)
+                entry.users += 1
+                return entry
+            spilling = self._spilling.get(session_id)
+        # Read from disk outside the store lock so other sessions are not held up
+        history = spilling if spilling is not None else self._load(session_id)
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                entry = self._sessions[session_id] = _Entry(history)
+            self._sessions.move_to_end(session_id)
+            entry.users += 1
+            return entry
+
+    def _evict(self):
+        now = time.monotonic()
+        spilled = []
+        with self._lock:
+            sweep = now - self._last_sweep >= min(self.idle_seconds, 60)
+            if sweep:
+                self._last_sweep = now
+            excess = len(self._sessions) - self.max_in_memory
+            # Least recently used first; stop at the first fresh session unless over capacity
+            for session_id, entry in list(self._sessions.items()):
+                idle = sweep and now - entry.last_used >= self.idle_seconds
+                if not idle and excess <= 0:
+                    break
+                if entry.users:
+                    continue
+                del self._sessions[session_id]
+                excess -= 1
+                spilled.append((session_id, entry.history))
+                self._spilling[session_id] = entry.history
+        if spilled:
+            self._spill(spilled)
+
+    @contextmanager
+    def session(self, session_id):
+        entry = self._checkout(session_id)
+        try:
+            with entry.lock:
+                yield entry.history
+        finally:
+            with self._lock:
+                entry.users -= 1
+                entry.last_used = time.monotonic()
+            self._evict()
+
+    def flush(self):
+        """Write every idle in-memory session to disk, e.g. on shutdown."""
+        with self._lock:
+            spilled = [(session_id, entry.history) for session_id, entry in self._sessions.items() if not entry.users]
+            for session_id, history in spilled:
+                del self._sessions[session_id]
+                self._spilling[session_id] = history
+        if spilled:
+            self._spill(spilled)
+
+    def close(self):
+        self.flush()
+        with self._db_lock:
+            self._conn.close()
@@ -1,48 +1,24 @@
 import os
 import json
 import logging
-from semantic_kernel import Kernel
-from semantic_kernel.ai.openai.services.azure_openai import AzureOpenAIService
-from semantic_kernel.memory.azure_cognitive_search import AzureCognitiveSearchMemory
-from semantic_kernel.core.memory.memory_record import MemoryRecord
+import tempfile
 from flask import Flask, request, jsonify
+from kernel_runtime import BackgroundLoop
+from profiler import register_profiler
+from sk_kernel import search_memory, call, vectorize_and_save, find_similar_images
 
 # Initialize Flask App
 app = Flask(__name__)
-
-# Initialize Semantic Kernel
-sk = Kernel()
+app.config["MAX_CONTENT_LENGTH"] = int(os.environ.get("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
-# Azure Cognitive Search configuration
-SEARCH_ENDPOINT = os.environ["AZURE_SEARCH_ENDPOINT"]
-SEARCH_API_KEY = os.environ["AZURE_SEARCH_KEY"]
-INDEX_NAME_TEXT = os.environ["INDEX_NAME_TEXT"]
-INDEX_NAME_IMAGE = os.environ["INDEX_NAME_IMAGE"]
-
-# Azure OpenAI configuration
-OPENAI_DEPLOYMENT_ID = os.environ["OPENAI_DEPLOYMENT_ID"]
-OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
-OPENAI_ENDPOINT = os.environ["OPENAI_ENDPOINT"]
-
-# Initialize Azure Cognitive Search Memory
-search_memory = AzureCognitiveSearchMemory(
-    endpoint=SEARCH_ENDPOINT,
-    api_key=SEARCH_API_KEY,
-    index_name=INDEX_NAME_TEXT,
-)
-
-# Initialize Azure OpenAI Service
-sk.add_service(
-    "azure_openai",
-    AzureOpenAIService(
-        deployment_id=OPENAI_DEPLOYMENT_ID,
-        api_key=OPENAI_API_KEY,
-        endpoint=OPENAI_ENDPOINT,
-    ),
-)
+# Every kernel and memory call runs on this one event loop; Flask handlers block on the result
+kernel_loop = BackgroundLoop()
+
+# Opt-in sampling profiler; the work happens on the loop and its worker threads, so sample every thread
+register_profiler(app, all_threads=True)
 
 
 @app.route("/text_search", methods=["POST"])
@@ -53,8 +29,8 @@ def text_search():
         return jsonify({"error": "Question is required"}), 400
 
     try:
-        # Perform search in Azure Cognitive Search
-        results = search_memory.search(user_input, top=3)
+        # Perform search in Azure Cognitive Search on the shared loop
+        results = kernel_loop.run(call(search_memory.search, user_input, top=3))
         search_results = [
             {
                 "source": result.metadata["sourcepage"],
@@ -73,30 +49,15 @@ def upload_images():
     """Upload image embeddings to Azure Cognitive Search."""
     image_dir = os.getenv("FILE_PATH_IMG", "./images")
     files = os.listdir(image_dir)
-    documents = []
-
-    for file in files:
-        file_path = os.path.join(image_dir, file)
-        try:
-            # Convert image to embeddings
-            vector = sk.services["azure_openai"].vectorize_image(file_path)
-            sanitized_id = re.sub(r"[^a-zA-Z0-9_-]", "_", file)
-
-            # Create memory record
-            memory_record = MemoryRecord(
-                id=sanitized_id,
-                metadata={"description": file},
-                vector=vector,
-            )
-            documents.append(memory_record)
-
-        except Exception as e:
-            logging.error(f"Failed to process {file}: {e}")
-            continue
-
-    if documents:
-        search_memory.save_batch(documents)
-        return jsonify({"message": f"Uploaded {len(documents)} documents."}), 200
+
+    try:
+        uploaded, failed = kernel_loop.run(vectorize_and_save(image_dir, files))
+    except Exception as e:
+        logging.error(f"Error in upload_images: {e}")
+        return jsonify({"error": str(e)}), 500
+
+    if uploaded:
+        return jsonify({"message": f"Uploaded {uploaded} documents.", "failed": failed}), 200
     else:
         return jsonify({"message": "No valid images to upload."}), 400
 
@@ -109,15 +70,14 @@ def image_search():
         if not file:
             return jsonify({"error": "Image file is required"}), 400
 
-        # Save uploaded file temporarily
-        temp_path = os.path.join("./uploads", file.filename)
-        file.save(temp_path)
-
-        # Generate image vector
-        vector = sk.services["azure_openai"].vectorize_image(temp_path)
-
-        # Perform vector search
-        results = search_memory.vector_search(vector, top=5)
+        # The kernel service only accepts a path, so spool the upload to a
+        # temporary file that is removed as soon as the vector is generated
+        suffix = os.path.splitext(file.filename or "")[1]
+        with tempfile.NamedTemporaryFile(suffix=suffix) as temp_file:
+            file.save(temp_file)
+            temp_file.flush()
+            # Vectorize and search in one hop to the shared loop
+            results = kernel_loop.run(find_similar_images(temp_file.name, top=5))
         similar_images = [
             {"image_name": result.metadata["description"]} for result in results
         ]
@@ -1,15 +1,22 @@
 import os
+import uuid
 from dotenv import load_dotenv
 from flask import Flask, request, jsonify
 from semantic_kernel.kernel import Kernel
 from semantic_kernel.connectors.ai.openai.chat_completion import AzureChatCompletion
 from semantic_kernel.chat_history import ChatHistory
+from session_memory import SessionStore
+from conversation_summary import RollingSummarizer
+from profiler import register_profiler
 
 # Load environment variables from .env
 load_dotenv()
 
 app = Flask(__name__)
 
+# Opt-in sampling profiler: PROFILE_REQUESTS=true honours X-Profile / ?profile=1, PROFILE_SAMPLE_RATE samples traffic
+register_profiler(app)
+
 # Initialize Semantic Kernel
 def setup_kernel():
     # Load Azure OpenAI credentials from environment variables
@@ -35,26 +42,33 @@ def setup_kernel():
 
     return kernel
 
-# Truncate chat history based on the number of conversations
-def truncate_chat_history_by_conversations(chat_history, max_conversations):
-    """
-    Truncate chat history to retain only the last `max_conversations` conversations.
-    A conversation is a pair of user input and assistant response.
-    """
-    num_messages = len(chat_history.messages)
-    num_conversations = num_messages // 2
-
-    if num_conversations > max_conversations:
-        # Calculate the number of messages to keep (each conversation is 2 messages)
-        messages_to_keep = max_conversations * 2
-        chat_history.messages = chat_history.messages[-messages_to_keep:]
-
-# Initialize the Kernel and Chat History
+# Initialize the Kernel and the per-session chat histories
 kernel = setup_kernel()
-chat_history = ChatHistory()
 
-# Define the maximum number of conversations to retain in memory
-max_conversations = 3
+# Each session keeps its last SESSION_MAX_TURNS conversations (default 3), trimmed to SESSION_MAX_TOKENS
+session_store = SessionStore()
+
+
+def summarize(prompt):
+    summary_history = ChatHistory()
+    summary_history.add_user_message(prompt)
+    return kernel.chat_completion.complete(summary_history)
+
+# Turns that fall out of a session's window are folded into its summary in the background
+summarizer = RollingSummarizer(summarize)
+
+
+def build_chat_history(history, user_input):
+    chat_history = ChatHistory()
+    if history.summary:
+        chat_history.add_system_message(f"Summary of the earlier conversation: {history.summary}")
+    for role, content in history.messages():
+        if role == "user":
+            chat_history.add_user_message(content)
+        else:
+            chat_history.add_assistant_message(content)
+    chat_history.add_user_message(user_input)
+    return chat_history
 
 @app.route("/ask", methods=["POST"])
 def ask():
@@ -65,20 +79,24 @@ def ask():
         if not user_input:
             return jsonify({"error": "No input provided"}), 400
 
-        # Add the user input to the chat history
-        chat_history.add_user_message(user_input)
+        # Conversations are keyed by the X-Session-ID header or "session_id"; a new one is issued if absent
+        session_id = request.headers.get("X-Session-ID") or request.json.get("session_id") or uuid.uuid4().hex
 
-        # Get the assistant's response
-        response = kernel.chat_completion.complete(chat_history)
+        # Requests for the same session run one at a time; other sessions are not blocked
+        with session_store.session(session_id) as history:
+            # The summary lives with the session so it is spilled to disk along with it
+            summarizer.load(session_id, history.summary)
+            history.summary = summarizer.summary(session_id)
+            chat_history = build_chat_history(history, user_input)
 
-        # Add the assistant's response to the chat history
-        chat_history.add_assistant_message(response)
+            # Get the assistant's response
+            response = kernel.chat_completion.complete(chat_history)
 
-        # Truncate the chat history based on the number of conversations
-        truncate_chat_history_by_conversations(chat_history, max_conversations)
+            # Record the turn; the oldest turns fall out once the turn or token limit is hit
+            summarizer.add(session_id, history.append(user_input, str(response)))
 
         # Return the assistant's response
-        return jsonify({"response": response}), 200
+        return jsonify({"response": response, "session_id": session_id}), 200
 
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
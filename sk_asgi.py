@@ -0,0 +1,88 @@
+import os
+import asyncio
+import logging
+import tempfile
+from quart import Quart, request, jsonify
+from sk_kernel import search_memory, call, vectorize_and_save, find_similar_images
+
+# Async server mode for sk.py: same routes and payloads, served with
+#   hypercorn sk_asgi:app   (or uvicorn sk_asgi:app)
+# Kernel and memory coroutines are awaited on the server's own event loop, so
+# requests don't each hold a thread while blocked on sk.py's background loop.
+
+app = Quart(__name__)
+app.config["MAX_CONTENT_LENGTH"] = int(os.environ.get("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+
+logging.basicConfig(level=logging.INFO)
+
+
+@app.route("/text_search", methods=["POST"])
+async def text_search():
+    """Perform text search using Azure Cognitive Search."""
+    payload = (await request.get_json()) or {}
+    user_input = payload.get("question")
+    if not user_input:
+        return jsonify({"error": "Question is required"}), 400
+
+    try:
+        results = await call(search_memory.search, user_input, top=3)
+        search_results = [
+            {
+                "source": result.metadata["sourcepage"],
+                "content": result.text,
+            }
+            for result in results
+        ]
+        return jsonify({"results": search_results}), 200
+    except Exception as e:
+        logging.error(f"Error in text_search: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/upload_images", methods=["POST"])
+async def upload_images():
+    """Upload image embeddings to Azure Cognitive Search."""
+    image_dir = os.getenv("FILE_PATH_IMG", "./images")
+    files = await asyncio.to_thread(os.listdir, image_dir)
+
+    try:
+        uploaded, failed = await vectorize_and_save(image_dir, files)
+    except Exception as e:
+        logging.error(f"Error in upload_images: {e}")
+        return jsonify({"error": str(e)}), 500
+
+    if uploaded:
+        return jsonify({"message": f"Uploaded {uploaded} documents.", "failed": failed}), 200
+    else:
+        return jsonify({"message": "No valid images to upload."}), 400
+
+
+@app.route("/image_search", methods=["POST"])
+async def image_search():
+    """Search for similar images using vectorized queries."""
+    try:
+        file = (await request.files).get("image")
+        if not file:
+            return jsonify({"error": "Image file is required"}), 400
+
+        # The kernel service only accepts a path; the spooled upload (bounded by
+        # MAX_CONTENT_LENGTH) is written to a temporary file off the event loop
+        suffix = os.path.splitext(file.filename or "")[1]
+        with tempfile.NamedTemporaryFile(suffix=suffix) as temp_file:
+            def spool():
+                temp_file.write(file.read())
+                temp_file.flush()
+            await asyncio.to_thread(spool)
+            results = await find_similar_images(temp_file.name, top=5)
+        similar_images = [
+            {"image_name": result.metadata["description"]} for result in results
+        ]
+        return jsonify({"similar_images": similar_images}), 200
+
+    except Exception as e:
+        logging.error(f"Error in image_search: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+if __name__ == "__main__":
+    app.run()
@@ -0,0 +1,105 @@
+import os
+import re
+import asyncio
+import inspect
+import logging
+from semantic_kernel import Kernel
+from semantic_kernel.ai.openai.services.azure_openai import AzureOpenAIService
+from semantic_kernel.memory.azure_cognitive_search import AzureCognitiveSearchMemory
+from semantic_kernel.core.memory.memory_record import MemoryRecord
+
+# Kernel, memory and coroutines shared by the Flask (sk.py) and Quart (sk_asgi.py)
+# entry points; importing this module starts no app and no event loop
+
+# Initialize Semantic Kernel
+sk = Kernel()
+
+# Images vectorized at once during /upload_images, and records per save_batch call
+SK_VECTORIZE_CONCURRENCY = int(os.environ.get("SK_VECTORIZE_CONCURRENCY", "8"))
+SK_UPLOAD_BATCH_SIZE = int(os.environ.get("SK_UPLOAD_BATCH_SIZE", "100"))
+
+# Azure Cognitive Search configuration
+SEARCH_ENDPOINT = os.environ["AZURE_SEARCH_ENDPOINT"]
+SEARCH_API_KEY = os.environ["AZURE_SEARCH_KEY"]
+INDEX_NAME_TEXT = os.environ["INDEX_NAME_TEXT"]
+INDEX_NAME_IMAGE = os.environ["INDEX_NAME_IMAGE"]
+
+# Azure OpenAI configuration
+OPENAI_DEPLOYMENT_ID = os.environ["OPENAI_DEPLOYMENT_ID"]
+OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
+OPENAI_ENDPOINT = os.environ["OPENAI_ENDPOINT"]
+
+# Initialize Azure Cognitive Search Memory
+search_memory = AzureCognitiveSearchMemory(
+    endpoint=SEARCH_ENDPOINT,
+    api_key=SEARCH_API_KEY,
+    index_name=INDEX_NAME_TEXT,
+)
+
+# Initialize Azure OpenAI Service
+sk.add_service(
+    "azure_openai",
+    AzureOpenAIService(
+        deployment_id=OPENAI_DEPLOYMENT_ID,
+        api_key=OPENAI_API_KEY,
+        endpoint=OPENAI_ENDPOINT,
+    ),
+)
+
+
+async def call(fn, *args, **kwargs):
+    """Await a kernel or memory call, pushing it to a thread when the SDK method is synchronous."""
+    if inspect.iscoroutinefunction(fn):
+        return await fn(*args, **kwargs)
+    return await asyncio.to_thread(fn, *args, **kwargs)
+
+
+async def vectorize_image(path):
+    return await call(sk.services["azure_openai"].vectorize_image, path)
+
+
+async def vectorize_and_save(image_dir, files):
+    """Vectorize images concurrently and save them in batches while the rest are still vectorizing.
+
+    At most SK_VECTORIZE_CONCURRENCY images are in flight; each full batch of
+    SK_UPLOAD_BATCH_SIZE records is handed to save_batch immediately.
+    """
+    semaphore = asyncio.Semaphore(SK_VECTORIZE_CONCURRENCY)
+
+    async def to_record(file):
+        try:
+            async with semaphore:
+                # Convert image to embeddings
+                vector = await vectorize_image(os.path.join(image_dir, file))
+        except Exception as e:
+            logging.error(f"Failed to process {file}: {e}")
+            return None
+        sanitized_id = re.sub(r"[^a-zA-Z0-9_-]", "_", file)
+        return MemoryRecord(
+            id=sanitized_id,
+            metadata={"description": file},
+            vector=vector,
+        )
+
+    batch, saves, uploaded, failed = [], [], 0, 0
+    for task in asyncio.as_completed([to_record(file) for file in files]):
+        record = await task
+        if record is None:
+            failed += 1
+            continue
+        batch.append(record)
+        if len(batch) >= SK_UPLOAD_BATCH_SIZE:
+            saves.append(asyncio.ensure_future(call(search_memory.save_batch, batch)))
+            uploaded += len(batch)
+            batch = []
+    if batch:
+        saves.append(asyncio.ensure_future(call(search_memory.save_batch, batch)))
+        uploaded += len(batch)
+    await asyncio.gather(*saves)
+    return uploaded, failed
+
+
+async def find_similar_images(path, top):
+    vector = await vectorize_image(path)
+    # Perform vector search
+    return await call(search_memory.vector_search, vector, top=top)
@@ -0,0 +1,121 @@
+import os
+import base64
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from PIL import Image
+from flask import abort, request, send_from_directory, url_for
+from werkzeug.security import safe_join
+
+THUMBNAIL_DIR = os.environ.get("THUMBNAIL_DIR", "output/thumbnails")
+THUMBNAIL_SIZE = int(os.environ.get("THUMBNAIL_SIZE", "320"))
+THUMBNAIL_QUALITY = int(os.environ.get("THUMBNAIL_QUALITY", "80"))
+THUMBNAIL_CACHE_BYTES = int(os.environ.get("THUMBNAIL_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+
+def thumbnail_name(image_name):
+    # Keep the original extension so foo.png and foo.jpg get separate thumbnails
+    return f"{image_name}.jpg"
+
+
+def thumbnail_path(image_dir, image_name, thumbnail_dir=THUMBNAIL_DIR):
+    """Return the path of the resized JPEG for an image, creating it if it is missing or stale."""
+    source = os.path.join(image_dir, image_name)
+    target = os.path.join(thumbnail_dir, thumbnail_name(image_name))
+    if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(source):
+        return target
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with Image.open(source) as image:
+        image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        if image.mode != "RGB":
+            # JPEG has no alpha channel; flatten transparent product shots onto white
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.convert("RGBA").getchannel("A"))
+            image = background
+        # A unique temporary file per build, so concurrent builds of one thumbnail don't interleave writes
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                image.save(tmp_file, "JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+            os.replace(tmp_path, target)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    return target
+
+
+def build_thumbnails(image_dir, files, thumbnail_dir=THUMBNAIL_DIR):
+    """Precompute thumbnails at ingest time so search responses never resize on the hot path."""
+    for file in files:
+        try:
+            thumbnail_path(image_dir, file, thumbnail_dir)
+        except Exception as e:
+            logging.error(f"Failed to create thumbnail for {file}: {e}")
+
+
+class ThumbnailCache:
+    """LRU of base64-encoded thumbnails bounded by total encoded size."""
+
+    def __init__(self, image_dir, max_bytes=THUMBNAIL_CACHE_BYTES, thumbnail_dir=THUMBNAIL_DIR):
+        self.image_dir = image_dir
+        self.thumbnail_dir = thumbnail_dir
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, image_name):
+        path = thumbnail_path(self.image_dir, image_name, self.thumbnail_dir)
+        mtime = os.path.getmtime(path)
+        with self._lock:
+            entry = self._entries.get(image_name)
+            if entry is not None and entry[0] == mtime:
+                self._entries.move_to_end(image_name)
+                return entry[1]
+
+        with open(path, "rb") as img_file:
+            encoded = base64.b64encode(img_file.read()).decode('utf-8')
+
+        with self._lock:
+            previous = self._entries.pop(image_name, None)
+            if previous is not None:
+                self.size -= len(previous[1])
+            self._entries[image_name] = (mtime, encoded)
+            self.size += len(encoded)
+            while self.size > self.max_bytes and len(self._entries) > 1:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+        return encoded
+
+
+def register_image_routes(app, image_dir, thumbnail_dir=THUMBNAIL_DIR):
+    """Serve originals and thumbnails from /images/<name>; ?size=thumb selects the thumbnail.
+
+    send_from_directory answers with ETag/Last-Modified and honours Range and
+    conditional requests, so clients can cache and resume downloads.
+    """
+    @app.route('/images/<path:image_name>', methods=['GET'])
+    def serve_image(image_name):
+        source = safe_join(image_dir, image_name)
+        if source is None or not os.path.isfile(source):
+            abort(404)
+        if request.args.get("size", "thumb") == "thumb":
+            thumbnail_path(image_dir, image_name, thumbnail_dir)
+            return send_from_directory(os.path.abspath(thumbnail_dir), thumbnail_name(image_name),
+                                       conditional=True, max_age=86400)
+        return send_from_directory(os.path.abspath(image_dir), image_name, conditional=True, max_age=86400)
+
+    return serve_image
+
+
+def image_result(image_name, cache, mode="inline", url_for=url_for):
+    """Build one search hit: a URL to the image endpoint, or the inline base64 thumbnail."""
+    if mode == "url":
+        return {
+            "image_name": image_name,
+            "image_url": url_for('serve_image', image_name=image_name, size="thumb", _external=True),
+            "original_url": url_for('serve_image', image_name=image_name, size="original", _external=True),
+        }
+    return {"image_name": image_name, "image_base64": cache.get(image_name)}
@@ -0,0 +1,301 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+import http.client, urllib.parse
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from embedding_cache import EmbeddingCache, EMBEDDING_CACHE_PATH, content_hash
+from micro_batch import MicroBatcher
+from deadline import call_upstream, DeadlineExceeded
+from circuit_breaker import get_breaker
+
+MODEL_VERSION = '2023-04-15'
+API_VERSION = '2023-04-01-preview'
+
+# Number of images vectorized concurrently during ingestion
+VISION_MAX_WORKERS = int(os.environ.get("VISION_MAX_WORKERS", "8"))
+# Socket timeout of one attempt; a request deadline shortens it further
+VISION_TIMEOUT = float(os.environ.get("VISION_TIMEOUT", "3"))
+# Attempts per image, including the first
+VISION_MAX_RETRIES = int(os.environ.get("VISION_MAX_RETRIES", "5"))
+
+# Vision rejects images over 20 MB; uploads above this are refused before any call
+MAX_IMAGE_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+STREAM_CHUNK_BYTES = 64 * 1024
+
+# Status codes worth retrying; everything else fails immediately
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+
+VectorResult = namedtuple("VectorResult", ["path", "vector", "error"])
+
+
+class VisionUnavailable(ConnectionError):
+    """A failed attempt worth retrying; `retry_after` carries the service's hint in seconds.
+
+    `status` is the HTTP status, or None when no response was received.
+    """
+
+    def __init__(self, message, retry_after=None, status=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.status = status
+
+
+def is_vision_outage(e):
+    # A 429 is the service pacing a burst (usually ingestion), already handled by the shared throttle;
+    # like the caller's own deadline running out it says nothing about whether Vision is up
+    if isinstance(e, DeadlineExceeded) or (isinstance(e, VisionUnavailable) and e.status == 429):
+        return None
+    return isinstance(e, (VisionUnavailable, TimeoutError))
+
+
+class VisionClient:
+    """Azure AI Vision `vectorizeImage` client with keep-alive connections.
+
+    Each worker thread keeps its own HTTPS connection open between calls.
+    Calls go through `deadline.call_upstream`: given a request deadline,
+    every attempt's timeout is bounded by it, in-memory images are hedged
+    with a duplicate request once an attempt runs past the recent p95, and
+    retries back off with jitter until the deadline runs out. A 429 with
+    Retry-After from any thread pushes back every thread sharing the client,
+    and repeated outages (not 429s) open the shared "vision" circuit breaker
+    so calls fail fast with CircuitOpen until a probe succeeds.
+    When an EmbeddingCache is given, local images whose content was already
+    vectorized with the same model version are served from it.
+    """
+
+    def __init__(self, key, region=None, endpoint=None, timeout=VISION_TIMEOUT,
+                 max_retries=VISION_MAX_RETRIES, model_version=MODEL_VERSION, cache=None, breaker=None):
+        self.key = key
+        self.cache = cache
+        self.breaker = breaker or get_breaker("vision", is_failure=is_vision_outage)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.model_version = model_version
+
+        endpoint = endpoint or f"https://{region}.api.cognitive.microsoft.com"
+        parsed = urllib.parse.urlparse(endpoint)
+        self.host = parsed.netloc
+        self.secure = parsed.scheme != "http"
+        self.base_path = parsed.path.rstrip("/")
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._throttled_until = 0.0
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if self.secure:
+                conn = http.client.HTTPSConnection(self.host, timeout=self.timeout)
+            else:
+                conn = http.client.HTTPConnection(self.host, timeout=self.timeout)
+            self._local.conn = conn
+        return conn
+
+    def _reset_connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _wait_for_throttle(self, timeout):
+        delay = self._throttled_until - time.monotonic()
+        if delay > 0:
+            if timeout is not None and delay >= timeout:
+                raise DeadlineExceeded("Vision is throttled past the request deadline")
+            time.sleep(delay)
+
+    def _throttle(self, retry_after):
+        # Every thread sharing the client holds off until the service's Retry-After has passed
+        with self._lock:
+            self._throttled_until = max(self._throttled_until, time.monotonic() + retry_after)
+
+    def vectorize(self, image, deadline=None):
+        """Return the embedding for an image path, URL, bytes-like object or binary stream.
+
+        Buffers and streams are sent as-is, so an image never has to be written
+        to disk first. Only in-memory bodies can be hedged, so query uploads
+        should be passed as bytes (e.g. `file.read()`). `deadline` bounds the
+        whole call, retries included.
+        """
+        if isinstance(image, str):
+            if image.startswith(('http://', 'https://')):
+                return self._post(json.dumps({"url": image}), 'application/json', image, deadline=deadline)
+            try:
+                with open(image, "rb") as filehandler:
+                    data = filehandler.read()
+            except FileNotFoundError:
+                raise FileNotFoundError(f"Image not found {image}")
+            return self._vectorize_bytes(data, image, deadline)
+
+        if hasattr(image, "getbuffer"):
+            # BytesIO: borrow its buffer instead of copying the upload
+            return self._vectorize_bytes(image.getbuffer(), "<upload>", deadline)
+        if hasattr(image, "read"):
+            return self._vectorize_stream(image, deadline)
+        return self._vectorize_bytes(image, "<upload>", deadline)
+
+    def _vectorize_bytes(self, data, label, deadline=None):
+        fetch = lambda: self._post(data, 'application/octet-stream', label, deadline=deadline)
+        if self.cache is None:
+            return fetch()
+        return self._cached(content_hash(data), fetch)
+
+    def _vectorize_stream(self, stream, deadline=None):
+        # Large uploads are spooled to a temporary file by Werkzeug, which removes
+        # it when the request ends; hash it in chunks and stream it to Vision.
+        stream.seek(0)
+        hasher = hashlib.sha256()
+        for chunk in iter(lambda: stream.read(STREAM_CHUNK_BYTES), b""):
+            hasher.update(chunk)
+        size = stream.tell()
+        if size > MAX_IMAGE_BYTES:
+            raise ValueError(f"Image exceeds {MAX_IMAGE_BYTES} bytes")
+        fetch = lambda: self._post(stream, 'application/octet-stream', "<upload>", content_length=size, deadline=deadline)
+        if self.cache is None:
+            return fetch()
+        return self._cached(hasher.hexdigest(), fetch)
+
+    def _cached(self, digest, fetch):
+        vector = self.cache.get(digest, self.model_version)
+        if vector is None:
+            vector = fetch()
+            self.cache.put(digest, self.model_version, vector)
+        return vector
+
+    def _post(self, body, content_type, image, content_length=None, deadline=None):
+        headers = {'Ocp-Apim-Subscription-Key': self.key, 'Content-Type': content_type}
+        if content_length is not None:
+            headers['Content-Length'] = str(content_length)
+        params = urllib.parse.urlencode({'api-version': API_VERSION, 'model-version': self.model_version})
+        url = f"{self.base_path}/computervision/retrieval:vectorizeImage?{params}"
+        # Two attempts can't read one stream at once, so only in-memory bodies are hedged
+        return call_upstream(
+            "vectorize",
+            lambda timeout: self._send(url, body, headers, image, timeout),
+            deadline=deadline,
+            hedge=not hasattr(body, "read"),
+            retryable=lambda e: isinstance(e, VisionUnavailable),
+            max_attempts=self.max_retries,
+            breaker=self.breaker,
+        )
+
+    def _send(self, url, body, headers, image, timeout):
+        self._wait_for_throttle(timeout)
+        timeout = self.timeout if timeout is None else min(self.timeout, timeout)
+        if hasattr(body, "seek"):
+            body.seek(0)
+        try:
+            conn = self._connection()
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            conn.request("POST", url, body, headers)
+            response = conn.getresponse()
+            payload = response.read()
+        except (http.client.HTTPException, OSError) as e:
+            # Stale keep-alive connections and timeouts surface here; reconnect on the next attempt
+            self._reset_connection()
+            raise VisionUnavailable(f"HTTP Error: {str(e)}")
+
+        if response.getheader("Connection", "").lower() == "close":
+            self._reset_connection()
+
+        if response.status == 200:
+            return json.loads(payload).get("vector")
+        if response.status in RETRYABLE_STATUS:
+            retry_after = response.getheader("Retry-After")
+            retry_after = float(retry_after) if retry_after and retry_after.isdigit() else None
+            if response.status == 429 and retry_after is not None:
+                self._throttle(retry_after)
+            message = "Too many requests" if response.status == 429 else f"Service Unavailable: {response.status}"
+            raise VisionUnavailable(message, retry_after, response.status)
+
+        if response.status == 401:
+            raise PermissionError("Unauthorized: Check API Key")
+        elif response.status == 400:
+            raise ValueError(f"Bad Request: {image}")
+        else:
+            raise Exception(f"Unexpected Error:{response.status} {response.reason}")
+
+
+_clients = {}
+_batchers = {}
+_clients_lock = threading.Lock()
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    """Return the shared on-disk embedding cache, or None if EMBEDDING_CACHE_PATH is empty."""
+    global _cache
+    with _cache_lock:
+        if _cache is None and EMBEDDING_CACHE_PATH:
+            _cache = EmbeddingCache(EMBEDDING_CACHE_PATH)
+        return _cache
+
+
+def get_vision_client(key, region=None, endpoint=None):
+    """Return a shared VisionClient so connections are reused across callers."""
+    endpoint = endpoint or os.environ.get("AZURE_AI_VISION_ENDPOINT") or None
+    with _clients_lock:
+        client = _clients.get((key, region, endpoint))
+        if client is None:
+            client = VisionClient(key, region=region, endpoint=endpoint, cache=get_embedding_cache())
+            _clients[(key, region, endpoint)] = client
+        return client
+
+
+def get_vision_batcher(key, region=None, endpoint=None):
+    """Return the shared MicroBatcher for query-time `vectorize` calls.
+
+    vectorizeImage takes one image per call, so concurrent requests are not
+    merged; they run on the batcher's long-lived threads and their warm
+    connections instead of each request thread opening its own.
+    """
+    client = get_vision_client(key, region, endpoint)
+    with _clients_lock:
+        batcher = _batchers.get(client)
+        if batcher is None:
+            batcher = MicroBatcher(dispatch_one=client.vectorize, name="vision-vectorize")
+            _batchers[client] = batcher
+        return batcher
+
+
+def log_progress(done, total, path, error):
+    if error is not None:
+        logging.error(f"Vectorized {done}/{total}: {path} failed: {error}")
+    else:
+        logging.info(f"Vectorized {done}/{total}: {path}")
+
+
+def vectorize_images(client, paths, max_workers=VISION_MAX_WORKERS, on_progress=log_progress):
+    """Vectorize images concurrently, yielding a VectorResult as each one finishes.
+
+    At most `max_workers` requests are in flight at once. Failures are yielded
+    with `error` set rather than raised so one bad image does not stop the batch.
+    """
+    paths = list(paths)
+    total = len(paths)
+    if not total:
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="vectorize") as executor:
+        futures = {executor.submit(client.vectorize, path): path for path in paths}
+        try:
+            for done, future in enumerate(as_completed(futures), start=1):
+                path = futures[future]
+                try:
+                    result = VectorResult(path, future.result(), None)
+                except Exception as e:
+                    result = VectorResult(path, None, e)
+                if on_progress:
+                    on_progress(done, total, path, result.error)
+                yield result
+        finally:
+            for future in futures:
+                future.cancel()
@@ -1,10 +1,17 @@
 from flask import Flask, request, jsonify
 import os
 import logging
-from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
 from azure.search.documents.models import QueryType
 from azure.core.exceptions import HttpResponseError, ServiceRequestError
+from retrieval_cache import retrieval_cache
+from context_builder import build_context, count_tokens, COMPLETION_MAX_TOKENS
+from admission import admission_controller, estimate_tokens, AdmissionRejected
+from profiler import register_profiler
+from deadline import register_deadline, current_deadline, call_upstream, DeadlineExceeded
+from circuit_breaker import get_breaker, CircuitOpen
+from metrics import register_metrics, stage_timer
+from clients import get_search_client, warm_up_in_background, search_options, is_transient_search_error
+from clients import is_search_outage, is_openai_outage
 from azure_openai import *  # Ensure this has `create_prompt` and `generate_answer` functions
 from config import *        # Ensure config has `searchservice`, `searchkey`, and `index`
 
@@ -14,6 +21,31 @@ app = Flask(__name__)
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
+# Per-stage latency histograms on /metrics; SERVER_TIMING=true also sets a Server-Timing header
+register_metrics(app)
+
+# Opt-in sampling profiler: PROFILE_REQUESTS=true honours X-Profile / ?profile=1, PROFILE_SAMPLE_RATE samples traffic
+# Hedged searches run on pool threads, so sample every thread
+register_profiler(app, all_threads=True)
+
+# Every request gets a time budget (REQUEST_DEADLINE_SECONDS, or less via X-Request-Timeout) shared by its upstream calls
+register_deadline(app)
+
+# Azure Search client shared by every request in this worker
+index_name = index
+# AZURE_SEARCH_SERVICE_ENDPOINT overrides the public endpoint, e.g. for a local stand-in
+endpoint = os.environ.get("AZURE_SEARCH_SERVICE_ENDPOINT") or f"https://{searchservice}.search.windows.net/"
+search_client = get_search_client(endpoint, index_name, searchkey)
+# While an upstream's circuit is open, calls fail fast instead of waiting out timeouts and retries
+text_index_breaker = get_breaker("text_index", is_failure=is_search_outage)
+openai_breaker = get_breaker("openai", is_failure=is_openai_outage)
+warm_up_in_background([search_client])
+
+# Define field mappings for Azure Search
+KB_FIELDS_CONTENT = os.environ.get("KB_FIELDS_CONTENT", "content")
+KB_FIELDS_CATEGORY = os.environ.get("KB_FIELDS_CATEGORY", "category")
+KB_FIELDS_SOURCEPAGE = os.environ.get("KB_FIELDS_SOURCEPAGE", "sourcepage")
+
 @app.route('/search', methods=['POST'])
 def search_document():
     try:
@@ -22,51 +54,83 @@ def search_document():
         if not user_input:
             return jsonify({"error": "Missing 'question' parameter in request body"}), 400
 
-        # Initialize Azure Search Service parameters
-        service_name = searchservice
-        key = searchkey
-        endpoint = f"https://{searchservice}.search.windows.net/"
-        index_name = index
-
-        azure_credential = AzureKeyCredential(key)
-        search_client = SearchClient(endpoint=endpoint, index_name=index_name, credential=azure_credential)
-
-        # Define field mappings for Azure Search
-        KB_FIELDS_CONTENT = os.environ.get("KB_FIELDS_CONTENT", "content")
-        KB_FIELDS_CATEGORY = os.environ.get("KB_FIELDS_CATEGORY", "category")
-        KB_FIELDS_SOURCEPAGE = os.environ.get("KB_FIELDS_SOURCEPAGE", "sourcepage")
         exclude_category = None
         filter_condition = f"category ne '{exclude_category.replace("'", "''")}'" if exclude_category else None
 
         # Search query to Azure Search with error handling
         try:
-            results = search_client.search(
-                user_input,
-                filter=filter_condition,
-                query_type=QueryType.SEMANTIC,
-                query_language="en-us",
-                query_speller="lexicon",
-                semantic_configuration_name="default",
-                top=3
-            )
+            with stage_timer("text_search"):
+                results = retrieval_cache.get_or_search(index_name, user_input, filter_condition, 3, lambda: call_upstream(
+                    "search",
+                    lambda timeout: list(search_client.search(
+                        user_input,
+                        filter=filter_condition,
+                        query_type=QueryType.SEMANTIC,
+                        query_language="en-us",
+                        query_speller="lexicon",
+                        semantic_configuration_name="default",
+                        top=3,
+                        **search_options(timeout)
+                    )),
+                    hedge=True,
+                    retryable=is_transient_search_error,
+                    breaker=text_index_breaker,
+                ))
+        except CircuitOpen as e:
+            # Search is down: answer from the last results fetched for this question, else fail fast
+            logging.warning(f"Serving fallback: {e}")
+            results = retrieval_cache.last_results(index_name, user_input, filter_condition, 3)
+            if results is None:
+                return jsonify({"error": str(e)}), 503, {"Retry-After": str(e.retry_after)}
         except HttpResponseError as e:
             logging.error(f"Azure Search API error: {e.message}")
             return jsonify({"error": "Failed to retrieve search results from Azure Search API"}), 500
         except ServiceRequestError as e:
             logging.error(f"Service request error: {e}")
             return jsonify({"error": "Connection issue with Azure Search API"}), 500
+        except DeadlineExceeded as e:
+            logging.error(f"Search deadline exceeded: {e}")
+            return jsonify({"error": "Azure Search API did not answer in time"}), 504
 
-        # Process results
-        content = "\n".join([f"{doc[KB_FIELDS_SOURCEPAGE]}: {doc[KB_FIELDS_CONTENT].replace('\n', '').replace('\r', '')}" for doc in results])
-        references = list(set(doc[KB_FIELDS_SOURCEPAGE] for doc in results))
+        # Process results in a single pass
+        references = []
+        for doc in results:
+            if doc[KB_FIELDS_SOURCEPAGE] not in references:
+                references.append(doc[KB_FIELDS_SOURCEPAGE])
+        # Chunk, rank, dedupe and pack the retrieved passages into the prompt's token budget
+        with stage_timer("build_context"):
+            content = build_context(user_input, results, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT)
 
         # Use OpenAI to generate a response based on the content and user input
         try:
             conversation = [{"role": "system", "content": "Assistant is a great language model formed by OpenAI."}]
-            prompt = create_prompt(content, user_input)
+            with stage_timer("create_prompt"):
+                prompt = create_prompt(content, user_input)
             conversation.append({"role": "assistant", "content": prompt})
             conversation.append({"role": "user", "content": user_input})
-            reply = generate_answer(conversation)
+            # Shared TPM/RPM budget: queue briefly by X-Priority, else shed with a 429
+            reserved = estimate_tokens(conversation)
+            with stage_timer("admission"):
+                ticket = admission_controller.acquire(reserved, request.headers.get("X-Priority", "normal"),
+                                                      max_wait=current_deadline().remaining())
+            # The prompt is charged once the call is made; the unused part of max_tokens is handed back
+            used = reserved - COMPLETION_MAX_TOKENS
+            try:
+                # Not streamed here, so the whole completion is one stage
+                with stage_timer("completion"):
+                    reply = openai_breaker.call(generate_answer, conversation)
+                used += count_tokens(str(reply))
+            except CircuitOpen:
+                used = 0
+                raise
+            finally:
+                ticket.settle(used)
+        except AdmissionRejected as e:
+            logging.warning(f"Shedding request: {e}")
+            return jsonify({"error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
+        except CircuitOpen as e:
+            logging.warning(f"Failing fast: {e}")
+            return jsonify({"error": str(e)}), 503, {"Retry-After": str(e.retry_after)}
         except Exception as e:
             logging.error(f"Error generating response with OpenAI: {e}")
             return jsonify({"error": "Failed to generate answer from OpenAI model"}), 500
@@ -82,5 +146,12 @@ def search_document():
         logging.error(f"Unexpected error: {e}")
         return jsonify({"error": "An unexpected error occurred"}), 500
 
+@app.route('/cache/invalidate', methods=['POST'])
+def cache_invalidate():
+    # Called by the indexing job after the text index is re-uploaded; reaches every worker on the host
+    invalidated = (request.get_json(silent=True) or {}).get("index", index_name)
+    retrieval_cache.invalidate(invalidated)
+    return jsonify({"message": f"Retrieval cache invalidated for {invalidated}."})
+
 if __name__ == '__main__':
     app.run(debug=True)